@@ -1,101 +1,193 @@
-import sys
-import pylab as lb
-import numpy
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 - Francesco de Gasperin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Usage: closure.py [-p 0] [-a] vis.MS
+# Compute closure phases of every triangle (and optionally log closure
+# amplitudes of every quadrangle) in a single streaming pass over the MS.
+# Output is a compact npz with per-triangle statistics in time and frequency
+# and a per-station summary is logged to spot bad stations.
+# Data are processed in blocks of timeslots and channels to limit the memory.
+# Closure phase: arg(V_ij V_jk V_ik^*)
+# Closure amplitude: |V_ij V_kl| / |V_ik V_jl|
+
+import os, sys, itertools
+import optparse
+import logging
+import numpy as np
 import pyrap.tables as pt
-import lib_coordinates_mode as co
-from numpy import *
-from scipy import *
-import matplotlib.font_manager as font_manager 
-
-#Print closure phase vs time/elevation for three selected antennas and channel range/polarisation
-
-pol=0
-start_chan=0
-end_chan=14
-ant1=0
-ant2=1
-ant3=2
-RAdeg=123.40025 #phase centre RA,DEC in degrees. Needed for elevation calculation
-DECdeg=48.2179139
-xaxis='time'
-
-#Open table
-t=pt.table(sys.argv[1])
-
-lb.figure(1)
-lb.clf()
-
-def phase(antenna1,antenna2):
-	t1=t.query('ANTENNA1= '+str(antenna1) +' '+'AND ANTENNA2= '+str(antenna2))
-	print '***FLAG ANALYSIS***'
-	datapoint=0
-	noflags=0
-	flag=t1.getcolslice("FLAG", [start_chan,pol], [end_chan,pol])
-	phase = t1.getcolslice("DATA", [start_chan,pol], [end_chan,pol])
-	time=t1.getcol("TIME")
-	timed = time/(24*3600) #Convert MJD in seconds to days
-	timehr=(timed-timed[0])*24 #Hours since observation start
-	ant1=t1.getcell("ANTENNA1",0)
-	ant2=t1.getcell("ANTENNA2",0)
-	print 'Baseline = '+str(ant1)+' ' +str(ant2)
-	length=len(flag)
-	mphase=[]
-	elevation=[]
-		   
-	for x in range(len(time)):
-            total=0+0j
-	    count=0
-	    tmpflag=flag[x]
-	    tmpphase=phase[x]	
-	    altaz=co.altaz(time[x].item(),RAdeg,DECdeg)
-	    alt=altaz[0]
-	    elevation.append(alt) 
-	    for i in range(0, end_chan):    
-                if tmpflag[i]:
-                    noflags=noflags+1
-		    datapoint=datapoint+1
-		else:  
-                    test=tmpphase[i].item()
-		    total=test+total  
-		    count=count+1
-		    datapoint=datapoint+1
-			   
-	    if (count !=0):
-                spectral_mean=total/count
-		phase_element=arctan2(spectral_mean.imag,spectral_mean.real)
-		mphase.append(phase_element)
-	    else: mphase.append(nan)   
-	print len(mphase)
-	print len(time)	
-	print len(elevation)
-	print 'Total number of datapoints = '+str(datapoint)
-	print 'Total number of flags = '+str(noflags)
-	percentage=(float(noflags)/float(datapoint))*100
-	print 'Percentage baseline flagged for correlation '+str(pol)+' = '+str(percentage)+'%'
-
-	return elevation,timehr,mphase
-
-elev,timehr,mphase01=phase(ant1,ant2)
-elev2,timehr2,mphase12=phase(ant2,ant3)
-elev3,timehr3,mphase02=phase(ant1,ant3)
-
-#The closure phase is reduced modulo 360deg to the range -180 to +180. 
-#The closure phase is undefined (NaN) if any of the constituent visibility phases is absent or flagged
-
-closure = (array(mphase01) + array(mphase12) - array(mphase02))%(2*pi) 
-closure[where(closure > pi)] = closure[where(closure > pi)] - (2*pi)
-closure[where(closure<-pi)]=closure[where(closure<-pi)]+(2*pi)
-
-titlestring = "Closure Phase Analysis" 
-ylabelstring = "Closure Phase/Radians"
-if xaxis=='time':
-	xlabelstring="Time Since Obs Start/hours"
-	lb.plot(timehr,closure,',')
-elif xaxis=='elevation':
-	xlabelstring="Elevation Angle/degrees"
-	lb.plot(elev,closure,',')
-lb.ylabel(ylabelstring)
-lb.xlabel(xlabelstring)
-lb.title(titlestring)
-	   	   
-lb.show()
+logging.basicConfig(level=logging.DEBUG)
+
+
+def circ_std(phasor_sum, n):
+    """
+    Circular standard deviation (rad) from the sum of unit phasors
+    """
+    R = np.abs(phasor_sum) / np.where(n > 0, n, 1)
+    R = np.clip(R, 1e-10, 1)
+    std = np.sqrt(-2*np.log(R))
+    std[n == 0] = np.nan
+    return std
+
+
+opt = optparse.OptionParser(usage="%prog [options] MS", version="%prog 0.1")
+opt.add_option('-c', '--col', help='Column to use [default: DATA]', type='string', default='DATA')
+opt.add_option('-p', '--pol', help='Polarization index (0-3) [default: 0]', type='int', default=0)
+opt.add_option('-t', '--tbin', help='Number of timeslots in each time bin of the output statistics [default: 60]', type='int', default=60)
+opt.add_option('-n', '--ntimes', help='Number of timeslots read per chunk [default: 10]', type='int', default=10)
+opt.add_option('-b', '--nchans', help='Number of channels processed together, limits the memory [default: 8]', type='int', default=8)
+opt.add_option('-a', '--amp', help='Compute also closure amplitudes on channel-averaged data [default: False]', action="store_true", default=False)
+opt.add_option('-s', '--sigma', help='Report stations whose closure phase scatter is this times the median [default: 2]', type='float', default=2.)
+opt.add_option('-o', '--output', help='Output npz file [default: MS-closure.npz]', type='string', default='')
+(options, msfile) = opt.parse_args()
+
+if msfile == []:
+    opt.print_help()
+    sys.exit(0)
+msfile = msfile[0].rstrip('/')
+
+if not os.path.exists(msfile):
+    logging.error("Cannot find MS file.")
+    sys.exit(1)
+if options.output == '': options.output = msfile+'-closure.npz'
+
+with pt.table(msfile+'/ANTENNA', ack=False) as t:
+    antnames = t.getcol('NAME')
+nant = len(antnames)
+
+ms = pt.table(msfile, ack=False)
+mstimes = ms.getcol('TIME')
+if np.any(np.diff(mstimes) < 0):
+    logging.critical('This code cannot handle MS that are not time-sorted.')
+    sys.exit(1)
+utimes, tstart = np.unique(mstimes, return_index=True)
+tstart = np.append(tstart, len(mstimes))
+nchan = ms.getcell(options.col, 0).shape[0]
+
+# only antennas present in the data (in any timeslot)
+ants_present = np.unique(np.concatenate([ms.getcol('ANTENNA1'), ms.getcol('ANTENNA2')]))
+tri = np.array(list(itertools.combinations(ants_present, 3)))
+I, J, K = tri.T
+ntri = len(tri)
+ntbin = int(np.ceil(len(utimes)/float(options.tbin)))
+logging.info('%i antennas: %i triangles, %i timeslots, %i channels.' % (len(ants_present), ntri, len(utimes), nchan))
+
+# accumulators of unit phasors
+chan_sum = np.zeros((ntri, nchan), dtype=np.complex128)
+chan_n = np.zeros((ntri, nchan))
+time_sum = np.zeros((ntri, ntbin), dtype=np.complex128)
+time_n = np.zeros((ntri, ntbin))
+
+if options.amp:
+    quad = np.array(list(itertools.combinations(ants_present, 4)))
+    Q1, Q2, Q3, Q4 = quad.T
+    logging.info('%i quadrangles.' % len(quad))
+    ant_lca_sum = np.zeros(nant); ant_lca_sum2 = np.zeros(nant); ant_lca_n = np.zeros(nant)
+
+for t in xrange(0, len(utimes), options.ntimes):
+    startrow = tstart[t]
+    nrow = tstart[min(t+options.ntimes, len(utimes))] - startrow
+    nt = min(options.ntimes, len(utimes)-t)
+    logging.debug('Processing timeslots %i-%i...' % (t, t+nt))
+
+    ant1 = ms.getcol('ANTENNA1', startrow, nrow)
+    ant2 = ms.getcol('ANTENNA2', startrow, nrow)
+    ti = np.searchsorted(utimes, mstimes[startrow:startrow+nrow]) - t
+    data = ms.getcolslice(options.col, [0,options.pol], [nchan-1,options.pol], startrow, nrow)[:,:,0]
+    flag = ms.getcolslice('FLAG', [0,options.pol], [nchan-1,options.pol], startrow, nrow)[:,:,0]
+    data[flag] = np.nan
+
+    tbins = (t + np.arange(nt)) // options.tbin
+    if options.amp:
+        Vsum = np.zeros((nt, nant, nant), dtype=np.complex128)
+        Vcnt = np.zeros((nt, nant, nant))
+
+    # the visibility cube and the triangle products are large: do a block of channels at a time
+    for c0 in xrange(0, nchan, options.nchans):
+        c1 = min(c0+options.nchans, nchan)
+
+        # visibility cube (time, ant, ant, chan), missing baselines are nan
+        V = np.empty((nt, nant, nant, c1-c0), dtype=np.complex128)
+        V[:] = np.nan
+        V[ti, ant1, ant2] = data[:, c0:c1]
+        V[ti, ant2, ant1] = np.conj(data[:, c0:c1])
+
+        cp = V[:,I,J] * V[:,J,K] * np.conj(V[:,I,K]) # (time, tri, chan)
+        ph = cp / np.abs(cp)
+        valid = ~np.isnan(ph)
+        ph[~valid] = 0
+
+        chan_sum[:, c0:c1] += ph.sum(axis=0)
+        chan_n[:, c0:c1] += valid.sum(axis=0)
+        for b in np.unique(tbins):
+            time_sum[:, b] += ph[tbins == b].sum(axis=(0,2))
+            time_n[:, b] += valid[tbins == b].sum(axis=(0,2))
+        del cp, ph, valid
+
+        if options.amp:
+            good = ~np.isnan(V)
+            Vsum += np.where(good, V, 0).sum(axis=3)
+            Vcnt += good.sum(axis=3)
+
+    if options.amp:
+        Vavg = np.where(Vcnt > 0, Vsum / np.maximum(Vcnt, 1), np.nan) # (time, ant, ant), channel average
+        lca = np.log10(np.abs(Vavg[:,Q1,Q2] * Vavg[:,Q3,Q4]) / np.abs(Vavg[:,Q1,Q3] * Vavg[:,Q2,Q4]))
+        valid = np.isfinite(lca)
+        lca[~valid] = 0
+        for q in [Q1, Q2, Q3, Q4]:
+            ant_lca_sum += np.bincount(q, weights=lca.sum(axis=0), minlength=nant)
+            ant_lca_sum2 += np.bincount(q, weights=(lca**2).sum(axis=0), minlength=nant)
+            ant_lca_n += np.bincount(q, weights=valid.sum(axis=0), minlength=nant)
+
+ms.close()
+
+# statistics
+tot_sum = chan_sum.sum(axis=1); tot_n = chan_n.sum(axis=1)
+tri_mean = np.angle(tot_sum)
+tri_std = circ_std(tot_sum, tot_n)
+chan_std = circ_std(chan_sum, chan_n)
+time_std = circ_std(time_sum, time_n)
+
+# per-station summary: median scatter of all triangles containing the station
+ant_std = np.zeros(nant)*np.nan
+for a in ants_present:
+    ant_std[a] = np.nanmedian(tri_std[(I == a) | (J == a) | (K == a)])
+median_std = np.nanmedian(ant_std)
+logging.info('Closure phase scatter (median over triangles per station):')
+for a in ants_present:
+    if ant_std[a] > options.sigma*median_std:
+        logging.warning('%s: %.1f deg (BAD)' % (antnames[a], np.degrees(ant_std[a])))
+    else:
+        logging.info('%s: %.1f deg' % (antnames[a], np.degrees(ant_std[a])))
+
+out = dict(antnames=antnames, triangles=tri, tri_mean=tri_mean, tri_std=tri_std, tri_n=tot_n, \
+        chan_std=chan_std, time_std=time_std, time_bins=utimes[::options.tbin], ant_std=ant_std)
+
+if options.amp:
+    ant_lca_n[ant_lca_n == 0] = np.nan
+    ant_lca_mean = ant_lca_sum/ant_lca_n
+    ant_lca_rms = np.sqrt(ant_lca_sum2/ant_lca_n - ant_lca_mean**2)
+    logging.info('Log10 closure amplitude rms per station:')
+    for a in ants_present:
+        logging.info('%s: %.3f' % (antnames[a], ant_lca_rms[a]))
+    out.update(ant_lca_mean=ant_lca_mean, ant_lca_rms=ant_lca_rms)
+
+logging.info('Writing %s...' % options.output)
+np.savez(options.output, **out)
+
+logging.info("Done.")
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 - Francesco de Gasperin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Usage: ddsub.py -c MODEL_DATA_Dir00,MODEL_DATA_Dir01 -d Dir00,Dir01 -p cal.h5 vis.MS
+# Corrupt the model of each direction with its own DD solutions and subtract
+# (or add back) all of them from a data column in a single pass over the MS:
+# OUT = IN -/+ sum_d g_p,d M_pq,d g_q,d^*
+# Solutions (e.g. from DDECal) are taken nearest-neighbour in time/freq,
+# flagged solutions are replaced by unit gains.
+
+import os, sys
+import optparse
+import logging
+import numpy as np
+import pyrap.tables as pt
+logging.basicConfig(level=logging.DEBUG)
+
+
+def addcol(ms, incol, outcol):
+    if outcol not in ms.colnames():
+        logging.info('Adding column: '+outcol)
+        coldmi = ms.getdminfo(incol)
+        coldmi['NAME'] = outcol
+        ms.addcols(pt.makecoldesc(outcol, ms.getcoldesc(incol)), coldmi)
+
+
+def load_solutions(h5parmfile, solset, soltabs, direction, antnames, chan_freq):
+    """
+    Load and combine the requested soltabs for one direction
+    Return times and gains with shape (time, chan, ant, pol) where pol is 1 (scalar) or 2 (diagonal)
+    solutions are evaluated on the MS channels and on the times of all soltabs (nearest neighbour on the
+    axes of each soltab), flagged or NaN solutions are replaced by unit gains
+    """
+    import losoto.h5parm as lh5
+    from losoto.lib_operations import reorderAxes
+
+    h5 = lh5.h5parm(h5parmfile)
+    ss = h5.getSolset(solset)
+    sols = []
+
+    for soltabname in soltabs:
+        st = ss.getSoltab(soltabname)
+        soltype = st.getType()
+        if not soltype in ['tec', 'phase', 'scalarphase', 'amplitude', 'scalaramplitude']:
+            logging.error('%s: cannot apply soltab of type %s.' % (h5parmfile, soltype))
+            sys.exit(1)
+        vals, axes = st.getValues(retAxesVals=True)
+        weights = st.getValues(retAxesVals=False, weight=True)
+        axesnames = st.getAxesNames()
+
+        # select direction
+        if 'dir' in axesnames:
+            dirs = [d.strip('[]') for d in axes['dir']]
+            if not direction in dirs:
+                logging.error('%s: direction %s not found in %s.' % (h5parmfile, direction, soltabname))
+                sys.exit(1)
+            vals = np.take(vals, dirs.index(direction), axis=axesnames.index('dir'))
+            weights = np.take(weights, dirs.index(direction), axis=axesnames.index('dir'))
+            axesnames.remove('dir')
+
+        # bring every soltab to (time, freq, ant, pol)
+        for axis in ['freq', 'pol']:
+            if not axis in axesnames:
+                vals = vals[..., np.newaxis]
+                weights = weights[..., np.newaxis]
+                axesnames.append(axis)
+        vals = reorderAxes(vals, axesnames, ['time','freq','ant','pol'])
+        weights = reorderAxes(weights, axesnames, ['time','freq','ant','pol'])
+
+        # antenna order as in the MS and freq on the MS channels
+        h5ants = list(axes['ant'])
+        antidx = [h5ants.index(a) for a in antnames]
+        vals, weights = vals[:, :, antidx, :], weights[:, :, antidx, :]
+        if 'freq' in axes:
+            chanidx = nearest(axes['freq'], chan_freq)
+            vals, weights = vals[:, chanidx, :, :], weights[:, chanidx, :, :]
+
+        # flagged solutions leave the model of this soltab unchanged
+        bad = (weights == 0) | np.isnan(vals)
+        if bad.any():
+            logging.warning('%s: %i of %i flagged solutions in %s, replaced by unit gains.' % (h5parmfile, bad.sum(), bad.size, soltabname))
+            vals = np.where(bad, 1. if 'amplitude' in soltype else 0., vals)
+
+        sols.append([soltype, axes['time'], vals])
+
+    h5.close()
+
+    # soltabs may have different time axes (e.g. fast phases and slow amplitudes)
+    times = np.unique(np.concatenate([soltimes for soltype, soltimes, vals in sols]))
+    gains = 1.
+    for soltype, soltimes, vals in sols:
+        vals = vals[nearest(soltimes, times)]
+        if soltype == 'tec':
+            gains = gains * np.exp(1j * -8.44797245e9 * vals / chan_freq[np.newaxis,:,np.newaxis,np.newaxis])
+        elif soltype in ['phase', 'scalarphase']:
+            gains = gains * np.exp(1j * vals)
+        else:
+            gains = gains * vals
+
+    # make sure every channel is present also if no soltab had a freq axis
+    gains = gains * np.ones((1, len(chan_freq), 1, 1))
+    return times, gains
+
+
+def nearest(grid, values):
+    """
+    Index of the nearest point of grid for every value
+    """
+    if len(grid) == 1: return np.zeros(len(values), dtype=int)
+    idx = np.clip(np.searchsorted(grid, values), 1, len(grid)-1)
+    left = grid[idx-1]; right = grid[idx]
+    idx -= (values - left) < (right - values)
+    return idx
+
+
+def corrupt(model, gains, tidx, ant1, ant2):
+    """
+    Apply g_p M_pq g_q^* to the model of a chunk of rows
+    model : (row, chan, 4)
+    gains : (time, chan, ant, pol) with pol = 1 or 2
+    """
+    g1 = gains[tidx, :, ant1, :] # (row, chan, pol)
+    g2 = np.conj(gains[tidx, :, ant2, :])
+    if gains.shape[-1] == 1:
+        return g1 * model * g2
+    # XX, XY, YX, YY
+    pa = [0, 0, 1, 1]; pb = [0, 1, 0, 1]
+    return g1[:,:,pa] * model * g2[:,:,pb]
+
+
+opt = optparse.OptionParser(usage="%prog [options] MS", version="%prog 0.1")
+opt.add_option('-i', '--incol', help='Input column [default: DATA]', type='string', default='DATA')
+opt.add_option('-o', '--outcol', help='Output column [default: SUBTRACTED_DATA]', type='string', default='SUBTRACTED_DATA')
+opt.add_option('-c', '--modelcols', help='Comma-separated list of model columns, one per direction', type='string', default='')
+opt.add_option('-d', '--directions', help='Comma-separated list of directions names in the H5parm, one per model column', type='string', default='')
+opt.add_option('-p', '--h5parm', help='H5parm with the solutions, or comma-separated list with one per direction', type='string', default='')
+opt.add_option('-s', '--solset', help='Solset name [default: sol000]', type='string', default='sol000')
+opt.add_option('-t', '--soltabs', help='Comma-separated soltabs to apply [default: tec000,scalarphase000]', type='string', default='tec000,scalarphase000')
+opt.add_option('-a', '--add', help='Add back the corrupted models instead of subtracting them [default: False]', action="store_true", default=False)
+opt.add_option('-n', '--ntimes', help='Number of timeslots per chunk [default: 10]', type='int', default=10)
+(options, msfile) = opt.parse_args()
+
+if msfile == []:
+    opt.print_help()
+    sys.exit(0)
+msfile = msfile[0]
+
+if not os.path.exists(msfile):
+    logging.error("Cannot find MS file.")
+    sys.exit(1)
+
+modelcols = options.modelcols.split(',')
+directions = options.directions.split(',')
+h5parms = options.h5parm.split(',')
+if len(h5parms) == 1: h5parms *= len(directions)
+if options.modelcols == '' or len(modelcols) != len(directions) or len(h5parms) != len(directions):
+    logging.error("Need one model column, one direction and one (or a common) H5parm per direction.")
+    sys.exit(1)
+
+with pt.table(msfile+'/ANTENNA', ack=False) as t:
+    antnames = list(t.getcol('NAME'))
+with pt.table(msfile+'/SPECTRAL_WINDOW', ack=False) as t:
+    chan_freq = t.getcol('CHAN_FREQ')[0]
+
+# solutions are small, keep all of them in memory
+sols = []
+for modelcol, direction, h5parm in zip(modelcols, directions, h5parms):
+    logging.info('Loading solutions for %s (%s)...' % (direction, h5parm))
+    times, gains = load_solutions(h5parm, options.solset, options.soltabs.split(','), direction, antnames, chan_freq)
+    sols.append([modelcol, gains, times])
+
+ms = pt.table(msfile, readonly=False, ack=False)
+addcol(ms, options.incol, options.outcol)
+
+mstimes = ms.getcol('TIME')
+if np.any(np.diff(mstimes) < 0):
+    logging.critical('This code cannot handle MS that are not time-sorted.')
+    sys.exit(1)
+utimes, tstart = np.unique(mstimes, return_index=True)
+tstart = np.append(tstart, len(mstimes))
+
+sign = 1. if options.add else -1.
+for t in xrange(0, len(utimes), options.ntimes):
+    startrow = tstart[t]
+    nrow = tstart[min(t+options.ntimes, len(utimes))] - startrow
+    logging.debug('Processing rows %i-%i...' % (startrow, startrow+nrow))
+
+    ant1 = ms.getcol('ANTENNA1', startrow, nrow)
+    ant2 = ms.getcol('ANTENNA2', startrow, nrow)
+    rowtimes = mstimes[startrow:startrow+nrow]
+    data = ms.getcol(options.incol, startrow, nrow)
+    for modelcol, gains, times in sols:
+        tidx = nearest(times, rowtimes)
+        data += sign * corrupt(ms.getcol(modelcol, startrow, nrow), gains, tidx, ant1, ant2)
+    ms.putcol(options.outcol, data, startrow, nrow)
+
+ms.close()
+logging.info("Done.")
@@ -20,7 +20,70 @@ def check_rm(regexp):
             os.system('rm -r '+f)
 
 
-def run_losoto(s, c, mss, parsets, outtab='', inglobaldb='globaldb', outglobaldb='globaldb', ininstrument='instrument', outinstrument='instrument', putback=False):
+def get_size(path):
+    """
+    Size in bytes of a file or directory (e.g. an MS), 0 if it does not exist
+    """
+    if os.path.isfile(path): return os.path.getsize(path)
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files: size += os.lstat(os.path.join(root, f)).st_size
+    return size
+
+
+def stage_table(src, dst):
+    """
+    Make dst a copy of the table (or any dir/file) src without copying data if possible:
+    a tree of hard links, or a symlink if hard links are not possible (e.g. different filesystems)
+    and a real copy as last resort
+    Return the method used: 'link', 'symlink' or 'copy'
+    """
+    try:
+        if os.path.isfile(src):
+            os.link(src, dst)
+        else:
+            for root, dirs, files in os.walk(src):
+                d = os.path.normpath(os.path.join(dst, os.path.relpath(root, src)))
+                os.makedirs(d)
+                for f in files: os.link(os.path.join(root, f), os.path.join(d, f))
+        return 'link'
+    except OSError:
+        check_rm(dst)
+    try:
+        os.symlink(os.path.abspath(src), dst)
+        return 'symlink'
+    except OSError:
+        check_rm(dst)
+    if os.path.isfile(src): shutil.copy2(src, dst)
+    else: shutil.copytree(src, dst, symlinks=True)
+    return 'copy'
+
+
+def stage_tables(pairs, ncpu=8):
+    """
+    Stage a list of [src, dst] in parallel (copies are io bound, threads are enough)
+    """
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(ncpu)
+    methods = pool.map(lambda p: stage_table(*p), pairs)
+    pool.close()
+    logger.debug('Staged %i tables (%s).' % (len(pairs), ', '.join('%s: %i' % (m, methods.count(m)) for m in sorted(set(methods)))))
+
+
+def get_gbinst(ms, i):
+    """
+    Name of the instrument table of ms in the globaldb
+    """
+    # necessary for self step
+    try:
+        tnum = re.findall(r't\d+', ms)[0][1:]
+        sbnum = re.findall(r'SB\d+', ms)[0][2:]
+        return 'instrument-'+str(tnum)+'-'+str(sbnum)
+    except:
+        return 'instrument-'+str(i)
+
+
+def run_losoto(s, c, mss, parsets, outtab='', inglobaldb='globaldb', outglobaldb='globaldb', ininstrument='instrument', outinstrument='instrument', putback=False, parallel_import=True):
     """
     s : scheduler
     c : cycle name, e.g. "final"
@@ -28,6 +91,8 @@ def run_losoto(s, c, mss, parsets, outtab='', inglobaldb='globaldb', outglobaldb
     parsets : lists of parsets to execute
     outtab : strings with soltab to output e.g. 'amplitudeSmooth000,phaseOrig000'
     putback : put back in MS the instrument tables
+    parallel_import : import every instrument table in its own H5parm in parallel and then concatenate them
+    NOTE: the globaldbs are made of links to the MS tables (see stage_table), they are only read by losoto
     """
 
     logger.info('Running LoSoTo...')
@@ -35,35 +100,43 @@ def run_losoto(s, c, mss, parsets, outtab='', inglobaldb='globaldb', outglobaldb
     # prepare globaldbs
     check_rm('plots-'+c)
     check_rm(inglobaldb)
-    os.system('mkdir '+inglobaldb)
+    os.makedirs(inglobaldb)
     if inglobaldb != outglobaldb: 
         check_rm(outglobaldb)
-        os.system('mkdir '+outglobaldb)
+        os.makedirs(outglobaldb)
 
+    tostage = []
+    gbinsts = []
     for i, ms in enumerate(mss):
-        if i == 0: os.system('cp -r '+ms+'/ANTENNA '+ms+'/FIELD '+ms+'/sky '+inglobaldb)
+        for globaldb in set([inglobaldb, outglobaldb]):
+            if i == 0: tostage += [[ms+'/'+t, globaldb+'/'+t] for t in ['ANTENNA', 'FIELD', 'sky']]
+        gbinst = get_gbinst(ms, i)
+        gbinsts.append(gbinst)
+        tostage.append([ms+'/'+ininstrument, inglobaldb+'/'+gbinst])
         if inglobaldb != outglobaldb:
-            if i == 0: os.system('cp -r '+ms+'/ANTENNA '+ms+'/FIELD '+ms+'/sky '+outglobaldb)
-        
-        # necessary for self step
-        try:
-            tnum = re.findall(r't\d+', ms)[0][1:]
-            sbnum = re.findall(r'SB\d+', ms)[0][2:]
-            gbinst = 'instrument-'+str(tnum)+'-'+str(sbnum)
-        except:
-            gbinst = 'instrument-'+str(i)
-
-        os.system('cp -r '+ms+'/'+ininstrument+' '+inglobaldb+'/'+gbinst)
-       
-        if inglobaldb != outglobaldb:
-            os.system('cp -r '+ms+'/'+outinstrument+' '+outglobaldb+'/'+gbinst)
+            tostage.append([ms+'/'+outinstrument, outglobaldb+'/'+gbinst])
+    stage_tables(tostage)
     
     check_rm('plots')
     os.makedirs('plots')
     check_rm('cal-'+c+'.h5')
     
-    s.add('H5parm_importer.py -v cal-'+c+'.h5 globaldb', log='losoto-'+c+'.log', cmd_type='python', processors='max')
-    s.run(check=True)
+    if parallel_import and len(gbinsts) > 1:
+        # a globaldb with a single instrument table for each importer
+        for gbinst in gbinsts:
+            check_rm(inglobaldb+'-'+gbinst)
+            os.makedirs(inglobaldb+'-'+gbinst)
+            for t in ['ANTENNA', 'FIELD', 'sky', gbinst]:
+                os.symlink(os.path.abspath(inglobaldb+'/'+t), inglobaldb+'-'+gbinst+'/'+t)
+            s.add('H5parm_importer.py -v cal-'+c+'-'+gbinst+'.h5 '+inglobaldb+'-'+gbinst, log='losoto-'+c+'-'+gbinst+'.log', cmd_type='python')
+        s.run(check=True)
+        s.add('h5parm_concat.py -o cal-'+c+'.h5 '+' '.join(['cal-'+c+'-'+gbinst+'.h5' for gbinst in gbinsts]), log='losoto-'+c+'.log', cmd_type='python')
+        s.run(check=True)
+        for gbinst in gbinsts:
+            check_rm(inglobaldb+'-'+gbinst+' cal-'+c+'-'+gbinst+'.h5')
+    else:
+        s.add('H5parm_importer.py -v cal-'+c+'.h5 '+inglobaldb, log='losoto-'+c+'.log', cmd_type='python', processors='max')
+        s.run(check=True)
     
     for parset in parsets:
         logger.debug('-- executing '+parset+'...')
@@ -78,25 +151,704 @@ def run_losoto(s, c, mss, parsets, outtab='', inglobaldb='globaldb', outglobaldb
 
     if putback:
         for i, ms in enumerate(mss):
-            try:
-                tnum = re.findall(r't\d+', ms)[0][1:]
-                sbnum = re.findall(r'SB\d+', ms)[0][2:]
-                gbinst = 'instrument-'+str(tnum)+'-'+str(sbnum)
-            except:
-                gbinst = 'instrument-'+str(i)
-
+            gbinst = get_gbinst(ms, i)
             check_rm(ms+'/'+outinstrument)
-            os.system('cp -r '+outglobaldb+'/sol000_'+gbinst+' '+ms+'/'+outinstrument)
+            shutil.move(outglobaldb+'/sol000_'+gbinst, ms+'/'+outinstrument)
+
+
+class StepCache(object):
+    # files up to this size (bytes) are fingerprinted by content, larger ones and dirs by stamp
+    hash_max = 16*1024**2
+
+    def __init__(self, filename):
+        """
+        Record of the completed steps, to skip them when a pipeline is re-run
+        filename: json file where fingerprints of completed steps are saved
+        """
+        import json
+        self.filename = filename
+        if os.path.exists(filename):
+            with open(filename) as f: self.steps = json.load(f)
+        else:
+            self.steps = {}
+
+    def fingerprint(self, cmd, inputs=[], outputs=[]):
+        """
+        Hash of the command line, of any file in the command line (parsets, skymodels...) but the outputs
+        and of the input files/dirs: small files by content, large files and dirs (e.g. MSs) by stamp (mtime, size)
+        """
+        import hashlib
+        h = hashlib.sha1(cmd.encode('utf-8'))
+        outputs = [os.path.abspath(o) for o in outputs]
+        for token in re.split(r'[\s=]+', cmd):
+            if os.path.isfile(token) and not os.path.abspath(token) in outputs: self.update(h, token)
+        for i in sorted(inputs):
+            h.update(i.encode('utf-8'))
+            self.update(h, i)
+        return h.hexdigest()
+
+    def update(self, h, path):
+        """
+        Add a file/dir to the hash h, files are read in blocks
+        """
+        if not os.path.isfile(path) or os.path.getsize(path) > self.hash_max:
+            h.update(str(self.stamp(path)).encode('utf-8'))
+            return
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024**2), b''): h.update(block)
+
+    def stamp(self, path):
+        """
+        Last modification time and total size of a file or directory (e.g. an MS)
+        """
+        if not os.path.exists(path): return None
+        if os.path.isfile(path): return (os.path.getmtime(path), os.path.getsize(path))
+        mtime = os.path.getmtime(path); size = 0
+        for root, dirs, files in os.walk(path):
+            for f in files:
+                st = os.stat(os.path.join(root, f))
+                mtime = max(mtime, st.st_mtime); size += st.st_size
+        return (mtime, size)
+
+    def is_done(self, fingerprint, outputs):
+        return fingerprint in self.steps and all(os.path.exists(o) for o in outputs)
+
+    def set_done(self, fingerprint, outputs):
+        import json
+        self.steps[fingerprint] = outputs
+        with open(self.filename+'.tmp', 'w') as f: json.dump(self.steps, f)
+        os.rename(self.filename+'.tmp', self.filename) # atomic, a crash never leaves a broken cache
+
+
+class ConcurrencyProfile(object):
+    def __init__(self, filename, host=None):
+        """
+        Throughput of each step at the concurrency levels used in previous runs, to choose how many
+        jobs of a step run at the same time on this host
+        filename: json file shared by all the runs, {host: {step: {concurrency: [samples]}}}
+        host: machines with different cores/memory/disks have separate profiles (default: hostname)
+        Samples are [jobs/h, mean job time in s, I/O in MB/s, max memory of a job in GB], the throughput of a level is the median of its samples
+        NOTE: runs on different data sizes are compared directly, the profile assumes the same kind of data
+        """
+        import json, socket
+        self.filename = filename
+        self.host = socket.gethostname() if host is None else host
+        if os.path.exists(filename):
+            with open(filename) as f: self.profiles = json.load(f)
+        else:
+            self.profiles = {}
+        self.steps = self.profiles.setdefault(self.host, {})
+
+    def throughput(self, step):
+        """
+        Return {concurrency: median jobs/h} for a step
+        """
+        return self.median(step, 0)
+
+    def median(self, step, i):
+        """
+        Return {concurrency: median of the i-th value of the samples} for a step (levels without that value are left out)
+        """
+        levels = {}
+        for level, samples in self.steps.get(step, {}).items():
+            v = sorted([sample[i] for sample in samples if len(sample) > i and sample[i] != None])
+            if v != []: levels[int(level)] = v[len(v)//2]
+        return levels
+
+    def io_max(self, skip=None):
+        """
+        Highest I/O rate (MB/s) measured on this host by any step (but skip), taken as what the disks can do
+        """
+        rates = [sample[2] for step, levels in self.steps.items() if step != skip \
+                for samples in levels.values() for sample in samples if len(sample) > 2]
+        return max(rates) if rates != [] else 0.
+
+    def choose(self, step, limit, mem=None):
+        """
+        Concurrency for a step, at most limit, and the reason of the choice
+        The limit is lowered so that the jobs fit in mem (GB, per job memory from the samples) and do not need more
+        I/O than the highest rate measured on this host by the other steps (per job I/O from the samples).
+        The level with the best throughput is used, if the levels around it were never tried they are tried first:
+        the midpoint towards the next level tried above (or the limit), and only if the disks were saturated
+        (I/O close to io_max) the midpoint towards the next level tried below (or half), never reaching a level
+        already measured as slower.
+        Return None if the step was never run
+        """
+        caps = []
+        rss = self.median(step, 3)
+        if mem != None and rss != {}:
+            job_mem = max(rss.values()) # GB
+            if job_mem > 0 and int(mem/job_mem) < limit: caps.append((max(int(mem/job_mem), 1), 'memory %.1f GB per job' % job_mem))
+        io = self.median(step, 2)
+        io_max = self.io_max(skip=step) # a step alone cannot tell its own saturation
+        if io_max > 0 and io != {}:
+            io_max = max([io_max]+io.values())
+            job_io = min([io[l]/l for l in io]) # optimistic: no level already run is excluded
+            if job_io > 0 and int(io_max/job_io) < limit: caps.append((max(int(io_max/job_io), 1), 'I/O %.1f MB/s per job of max %.1f' % (job_io, io_max)))
+        capped = ''
+        if caps != []:
+            limit, why = min(caps)
+            capped = ', capped by '+why
+
+        levels = dict((l, t) for l, t in self.throughput(step).items() if l <= limit)
+        if levels == {}:
+            if caps != [] and self.throughput(step) != {}: return limit, capped[2:]
+            return None, 'never run'
+        best = max(sorted(levels.keys()), key=lambda l: levels[l])
+        higher = [l for l in levels if l > best]
+        lower = [l for l in levels if l < best]
+        trying = 'trying (best so far %i: %.1f jobs/h%s)' % (best, levels[best], capped)
+        if higher != [] and (best+min(higher))//2 > best:
+            return (best+min(higher))//2, trying
+        if higher == [] and limit > best:
+            return limit, trying
+        if best in io and io_max > 0 and io[best] >= 0.8*io_max:
+            below = (best+max(lower))//2 if lower != [] else best//2
+            if below >= 1 and below < best and not below in lower:
+                return below, trying+', I/O saturated'
+        return best, 'best (%.1f jobs/h%s)' % (levels[best], capped)
+
+    def record(self, jobs):
+        """
+        Add a sample for every step run at least twice in jobs (finished jobs of a run)
+        The concurrency is the max number of jobs of the step that run together, the throughput
+        is that concurrency over the mean job time (the tail of the run, with fewer jobs, is not counted)
+        """
+        import json
+        steps = {}
+        for job in jobs:
+            if job.status == 'done' and not job.cached and not job.micro and job.t_start != None:
+                steps.setdefault(job.step, []).append(job)
+        for step, sjobs in steps.items():
+            if len(sjobs) < 2: continue
+            events = sorted([(j.t_start, 1) for j in sjobs] + [(j.t_end, -1) for j in sjobs], key=lambda e: (e[0], e[1]))
+            level = n = 0
+            for t, e in events:
+                n += e; level = max(level, n)
+            mean = sum([j.t_end-j.t_start for j in sjobs])/len(sjobs)
+            io = sum([(j.rusage.ru_inblock+j.rusage.ru_oublock)*512 for j in sjobs if j.rusage]) / 1024.**2 / max(mean*len(sjobs), 1e-3) * level
+            rss = [j.rusage.ru_maxrss/1024.**2 for j in sjobs if j.rusage] # GB
+            logger.debug('Profile of %s: %i jobs, concurrency %i, %.1fs per job' % (step, len(sjobs), level, mean))
+            self.steps.setdefault(step, {}).setdefault(str(level), []).append([3600.*level/max(mean, 1e-3), mean, io, max(rss) if rss != [] else None])
+
+        # other pipelines may have written the file in the meantime
+        if os.path.exists(self.filename):
+            with open(self.filename) as f: profiles = json.load(f)
+        else: profiles = {}
+        profiles[self.host] = self.steps
+        self.profiles = profiles
+        with open(self.filename+'.tmp', 'w') as f: json.dump(profiles, f)
+        os.rename(self.filename+'.tmp', self.filename)
+
+
+class LogScanner(object):
+    # regexps matched on every line of the logs, for each command type:
+    # error: the job failed, warning: reported at the end, required: must appear before the end of the job (i.e. it did not crash)
+    patterns = {
+        'BBS': {'error': [], 'warning': [], 'required': ['success']},
+        'NDPPP': {'error': ['Exception', r'\*\*\*\* uncaught exception \*\*\*\*'], 'warning': ['(?i)warning'], 'required': ['Finishing processing']},
+        'CASA': {'error': ['[a-z]Error', 'An error occurred running', r'\*\*\* Error \*\*\*'], 'warning': ['WARN'], 'required': []},
+        'wsclean': {'error': ['exception occurred'], 'warning': ['(?i)warning'], 'required': ['Cleaning up temporary files...']},
+        'python': {'error': [r'Traceback \(most recent call last\):', '(?i)Error', '(?i)Critical'], 'warning': ['(?i)warning'], 'required': []},
+        'general': {'error': ['(?i)error'], 'warning': [], 'required': []}
+        }
+
+    def __init__(self, log, cmd_type, patterns=None, offset=0):
+        """
+        Incremental check of a log file while it is written
+        log: log file name
+        cmd_type: command type, a key of patterns
+        patterns: dict as LogScanner.patterns (default: LogScanner.patterns)
+        offset: start reading from this byte (e.g. the log size before a job that appends)
+        """
+        if patterns is None: patterns = self.patterns
+        p = patterns[cmd_type]
+        self.log = log
+        self.cmd_type = cmd_type
+        self.error = [re.compile(r) for r in p.get('error', [])]
+        self.warning = [re.compile(r) for r in p.get('warning', [])]
+        self.required = [re.compile(r) for r in p.get('required', [])]
+        self.offset = offset
+        self.partial = '' # last line, not yet terminated
+        self.warnings = []
+
+    def scan(self, final=False):
+        """
+        Read what was added to the log since the last call
+        if final=True the last line is checked also if not terminated and required patterns are checked
+        Return the list of problems found (empty if none)
+        """
+        problems = []
+        if os.path.exists(self.log):
+            with open(self.log) as f:
+                f.seek(self.offset)
+                text = f.read()
+                self.offset = f.tell()
+            lines = (self.partial+text).split('\n')
+            self.partial = lines.pop() # incomplete line, or '' if text ends with newline
+            if final and self.partial != '':
+                lines.append(self.partial); self.partial = ''
+            for line in lines:
+                if any(r.search(line) for r in self.error): problems.append(line)
+                elif any(r.search(line) for r in self.warning): self.warnings.append(line)
+                self.required = [r for r in self.required if not r.search(line)]
+        if final:
+            problems += ['missing "%s"' % r.pattern for r in self.required]
+        return problems
+
+
+class Node(object):
+    def __init__(self, name='localhost', cores=None, mem=None):
+        """
+        Description of the resources of the node where jobs are packed
+        cores: number of cores (default: all cores of this machine)
+        mem: memory in GB (default: all memory of this machine)
+        """
+        import multiprocessing
+        self.name = name
+        if cores is None: cores = multiprocessing.cpu_count()
+        if mem is None: mem = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024.**3
+        self.cores = cores
+        self.mem = mem
+
+    def __str__(self):
+        return '%s (cores: %i, mem: %.1f GB)' % (self.name, self.cores, self.mem)
+
+
+class Backend(object):
+    """
+    Run jobs locally: the command is executed as it is
+    Other backends wrap the command so that it runs on a cluster and returns when the job is done
+    queue: the resources are handled by a queue, jobs are not packed on the local node
+    overhead: seconds lost to submit a job, if > 0 micro jobs are batched in a single submission
+    sentinel: the backend can submit a job and return at once, the job writes its exit status in a sentinel
+    file when done (see wrap and SentinelWatcher)
+    """
+    name = 'local'
+    queue = False
+    overhead = 0.
+    sentinel = False
+
+    def wrap(self, cmd, cores=1, sentinel=None):
+        """
+        Return the command that runs cmd on the backend
+        sentinel: if given (only backends with sentinel=True) the command returns after the submission
+        printing the job id, and the job writes its exit status in this file
+        """
+        return cmd
+
+    def finished(self, ids):
+        """
+        Return the ids (as printed by the submission) of the jobs that are not in the queue anymore
+        used to find jobs that died without writing their sentinel, with a single call for all jobs
+        """
+        return set()
+
+    def __str__(self):
+        return self.name
+
+
+def sentinel_cmd(cmd, sentinel):
+    """
+    Shell command that runs cmd and then writes its exit status in the sentinel file (atomically)
+    also if the job is terminated (e.g. walltime)
+    """
+    import pipes
+    s = pipes.quote(sentinel)
+    return "trap 'echo 143 > "+s+".tmp; mv "+s+".tmp "+s+"; exit 143' TERM; "+\
+            "sh -c "+pipes.quote(cmd)+"; echo $? > "+s+".tmp; mv "+s+".tmp "+s
+
+
+class PBSBackend(Backend):
+    name = 'pbs'
+    queue = True
+
+    def __init__(self, waiter='qsub_waiter_lei.sh', sentinel=True):
+        """
+        waiter: script that submits a job with qsub and waits for it (args: [-s sentinel] processors cmd)
+        sentinel: submit and return, completion is watched by the Scheduler (see SentinelWatcher)
+        """
+        self.waiter = waiter
+        self.sentinel = sentinel
+        self.overhead = 3. if sentinel else 10. # qsub (+ qstat polling)
+
+    def wrap(self, cmd, cores=1, sentinel=None):
+        import pipes
+        if sentinel is not None: return self.waiter+' -s '+pipes.quote(sentinel)+' '+str(cores)+' '+pipes.quote(cmd)
+        return self.waiter+' '+str(cores)+' '+pipes.quote(cmd)
+
+    def finished(self, ids):
+        import subprocess
+        try: out = subprocess.Popen('qstat', stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0]
+        except OSError: return set()
+        # Job id  Name  User  Time Use  S  Queue
+        running = set([l.split()[0].split('.')[0] for l in out.splitlines() if len(l.split()) > 4 and l.split()[4] != 'C'])
+        return set([i for i in ids if not i in running])
+
+
+class SlurmBackend(Backend):
+    name = 'slurm'
+    queue = True
+    overhead = 5.
+    sentinel = True
+
+    def __init__(self, options='--job-name LBApipe --time=24:00:00'):
+        """
+        options: salloc/sbatch options, e.g. to run in priority nodes add "--reservation=important_science"
+        """
+        self.options = options
+
+    def wrap(self, cmd, cores=1, sentinel=None):
+        import pipes
+        if sentinel is not None:
+            return 'sbatch --parsable --output=/dev/null '+self.options+' --nodes=1 --ntasks-per-node='+str(cores)+\
+                    ' --wrap '+pipes.quote(sentinel_cmd(cmd, sentinel))
+        return 'salloc '+self.options+' --nodes=1 --tasks-per-node='+str(cores)+\
+                ' /usr/bin/srun --ntasks=1 --nodes=1 --preserve-env sh -c '+pipes.quote(cmd)
+
+    def finished(self, ids):
+        import subprocess
+        try: out = subprocess.Popen(['squeue', '-h', '-o', '%i'], stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0]
+        except OSError: return set()
+        running = set(out.split())
+        return set([i for i in ids if not i in running])
+
+
+class FakeClusterBackend(Backend):
+    name = 'fake'
+    queue = True
+
+    def __init__(self, delay=2., sentinel=False):
+        """
+        Local backend that behaves like a queue, for testing: every submission waits delay seconds
+        sentinel: jobs are started in background and write a sentinel as on a real queue
+        """
+        self.overhead = delay
+        self.sentinel = sentinel
+
+    def wrap(self, cmd, cores=1, sentinel=None):
+        import pipes
+        if sentinel is not None:
+            return '( sleep '+str(self.overhead)+'; '+sentinel_cmd(cmd, sentinel)+' ) > /dev/null 2>&1 & echo $!'
+        return 'sleep '+str(self.overhead)+'; sh -c '+pipes.quote(cmd)
+
+    def finished(self, ids):
+        done = set()
+        for i in ids:
+            try: os.kill(int(i), 0)
+            except OSError: done.add(i)
+        return done
+
+
+class SentinelWatcher(object):
+    def __init__(self, directory, backend=None, interval=1., check_interval=300.):
+        """
+        Wait for the sentinel files written by jobs when they end, for any number of jobs with a single thread
+        that lists the directory every interval seconds (a job never polls the queue)
+        directory: where sentinels are written, must be visible from the nodes
+        backend: every check_interval seconds the jobs without sentinel are checked with backend.finished(),
+        the ones found finished twice in a row died without writing it and fail
+        """
+        from threading import Thread, Lock
+        self.dir = os.path.abspath(directory)
+        if not os.path.isdir(self.dir): os.makedirs(self.dir)
+        self.backend = backend
+        self.interval = interval
+        self.check_interval = check_interval
+        self.lock = Lock()
+        self.waiting = {} # sentinel name -> [Event, job id, return code, times found finished without sentinel]
+        self.n = 0
+        t = Thread(target=self.watch)
+        t.daemon = True
+        t.start()
+
+    def new(self):
+        """
+        Return the path of a new sentinel to wait for
+        """
+        from threading import Event
+        with self.lock:
+            self.n += 1
+            name = 'job-%i-%i' % (os.getpid(), self.n)
+            self.waiting[name] = [Event(), None, None, 0]
+        # leftovers of a previous run with the same pid
+        for path in [os.path.join(self.dir, name), os.path.join(self.dir, name)+'.tmp']:
+            try: os.remove(path)
+            except OSError: pass
+        return os.path.join(self.dir, name)
+
+    def submitted(self, sentinel, jobid):
+        with self.lock:
+            self.waiting[os.path.basename(sentinel)][1] = jobid
+
+    def cancel(self, sentinel):
+        with self.lock:
+            self.waiting.pop(os.path.basename(sentinel), None)
+
+    def wait(self, sentinel, timeout=None):
+        """
+        Return the exit status written in the sentinel, None if not there after timeout seconds
+        """
+        name = os.path.basename(sentinel)
+        event = self.waiting[name][0]
+        event.wait(timeout)
+        if not event.is_set(): return None
+        with self.lock:
+            return self.waiting.pop(name)[2]
+
+    def watch(self):
+        import time
+        t_check = time.time()
+        while True:
+            time.sleep(self.interval)
+            names = set(os.listdir(self.dir))
+            with self.lock:
+                for name, w in self.waiting.items():
+                    if w[0].is_set() or not name in names: continue
+                    try:
+                        with open(os.path.join(self.dir, name)) as f: w[2] = int(f.read().strip())
+                    except (IOError, ValueError): w[2] = -1
+                    os.remove(os.path.join(self.dir, name))
+                    w[0].set()
+                ids = [w[1] for w in self.waiting.values() if not w[0].is_set() and w[1] != None]
+            if self.backend is None or time.time() - t_check < self.check_interval or ids == []: continue
+            t_check = time.time()
+            done = self.backend.finished(ids)
+            with self.lock:
+                for name, w in self.waiting.items():
+                    if w[0].is_set() or w[1] is None: continue
+                    w[3] = w[3]+1 if w[1] in done else 0
+                    if w[3] >= 2: # not in the queue and no sentinel since the previous check
+                        logger.error('Job %s ended without writing its sentinel %s.' % (w[1], name))
+                        w[2] = -1
+                        w[0].set()
+
+
+def run_script(script, argv, log='', log_append=False):
+    """
+    Execute a python script as __main__ in this process, as if called from the shell
+    stdout/stderr are redirected at file descriptor level in the log, so also output of C libraries goes there
+    Return the return code and the resources used, as struct_rusage
+    """
+    import runpy, resource, traceback
+    r0 = resource.getrusage(resource.RUSAGE_SELF)
+    cwd = os.getcwd()
+    syspath = list(sys.path)
+    sys.stdout.flush(); sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    if log != '':
+        fd = os.open(log, os.O_WRONLY|os.O_CREAT|(os.O_APPEND if log_append else os.O_TRUNC), 0o644)
+        os.dup2(fd, 1); os.dup2(fd, 2); os.close(fd)
+    sys.argv = [script]+list(argv)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    returncode = 0
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        if e.code is None: returncode = 0
+        elif isinstance(e.code, int): returncode = e.code
+        else:
+            print >> sys.stderr, e.code
+            returncode = 1
+    except:
+        traceback.print_exc()
+        returncode = 1
+    finally:
+        if 'matplotlib.pyplot' in sys.modules: sys.modules['matplotlib.pyplot'].close('all')
+        sys.stdout.flush(); sys.stderr.flush()
+        os.dup2(saved[0], 1); os.dup2(saved[1], 2)
+        os.close(saved[0]); os.close(saved[1])
+        sys.path = syspath
+        os.chdir(cwd)
+    r1 = resource.getrusage(resource.RUSAGE_SELF)
+    rusage = resource.struct_rusage([r1[i]-r0[i] if i != 2 else r1[i] for i in range(16)]) # maxrss is of the whole worker life
+    return returncode, rusage
+
+
+def wait_process(p, timeout=None):
+    """
+    Wait for the end of process p (a Popen object) at most timeout seconds (None: forever)
+    Return the return code and the resources used by the process and its children, None if still running
+    """
+    import time
+    t_stop = None if timeout is None else time.time()+timeout
+    while True:
+        pid, st, rusage = os.wait4(p.pid, 0 if timeout is None else os.WNOHANG)
+        if pid != 0: break
+        if time.time() >= t_stop: return None
+        time.sleep(min(0.05, timeout))
+    p.returncode = os.WEXITSTATUS(st) if os.WIFEXITED(st) else -os.WTERMSIG(st)
+    return p.returncode, rusage
+
+
+def kill_process(p):
+    """
+    Kill process p, started with preexec_fn=os.setsid, and all its children
+    """
+    import signal
+    try: os.killpg(p.pid, signal.SIGKILL)
+    except OSError: pass
+    try: os.wait4(p.pid, 0)
+    except OSError: pass
+
+
+def pool_worker(conn, preload):
+    """
+    Main loop of a PythonPool process: import the common modules once, then run the scripts received
+    """
+    import logging
+    for module in preload:
+        try: __import__(module)
+        except ImportError: pass
+    while True:
+        task = conn.recv()
+        if task is None: break
+        # every script configures its own logging
+        for h in list(logging.root.handlers): logging.root.removeHandler(h)
+        conn.send(run_script(*task))
+
+
+class PythonPool(object):
+    # modules imported at start by every worker, then shared by all the scripts it runs
+    preload = ['numpy', 'scipy', 'pyrap.tables', 'losoto.h5parm']
+
+    def __init__(self):
+        """
+        Persistent processes that run python scripts (see run_script) without paying
+        interpreter start-up and imports at every call
+        NOTE: workers are daemonic, scripts using multiprocessing cannot run here
+        """
+        from Queue import Queue
+        self.idle = Queue()
+        self.workers = []
+
+    def grow(self, n):
+        """
+        Start workers up to n, must be called when no other thread is running: a fork while other threads
+        hold locks (e.g. of the logging handlers) can deadlock the worker
+        """
+        import multiprocessing
+        while len(self.workers) < n:
+            conn, child_conn = multiprocessing.Pipe()
+            p = multiprocessing.Process(target=pool_worker, args=(child_conn, self.preload))
+            p.daemon = True
+            p.start()
+            w = (p, conn)
+            self.workers.append(w)
+            self.idle.put(w)
+
+    def start(self, script, argv, log='', log_append=False):
+        """
+        Send a script to an idle worker (wait if all are busy) and return the worker
+        Return None if no worker is alive (crashed workers are replaced only by grow())
+        """
+        from Queue import Empty
+        while True:
+            if self.workers == []: return None
+            try: w = self.idle.get(timeout=1.)
+            except Empty: continue
+            if w in self.workers: break
+        w[1].send((script, argv, log, log_append))
+        return w
+
+    def result(self, w, timeout=None):
+        """
+        Return (returncode, rusage) of the script running on worker w, None if not finished within timeout
+        A crashed worker returns -1 and is dropped (the next grow() replaces it)
+        """
+        if timeout != None and not w[1].poll(timeout): return None
+        try:
+            r = w[1].recv()
+            self.idle.put(w)
+        except EOFError:
+            w[0].join()
+            logger.warning('Python worker %i died (exit code %s).' % (w[0].pid, str(w[0].exitcode)))
+            self.workers.remove(w)
+            r = (-1, None)
+        return r
+
+
+class Job(object):
+    def __init__(self, cmd, log='', cmd_type='', deps=[], cores=1, mem=0, inputs=[], outputs=[], plain_cmd=None, log_append=False, micro=False, script=None, \
+            speculate=None, temp=[]):
+        """
+        A command in the scheduler list
+        cmd: the command to run (already with log redirection)
+        plain_cmd: the command as given by the user (default: cmd)
+        log: log file name (with log dir)
+        log_append: the job appends to the log (only the new part is checked)
+        cmd_type: type of command for log checking
+        deps: list of ids of the jobs that must finish before this one can start
+        cores: number of cores used by the job
+        mem: memory used by the job in GB
+        inputs: files/dirs read by the job (for the step cache)
+        outputs: files/dirs created by the job (for the step cache)
+        micro: short job that can be batched with others in a single submission
+        script: [python script, args] to run in the PythonPool instead of cmd
+        speculate: [cmd, outputs, finalize] duplicate to run if the job is a straggler (see Scheduler.add)
+        temp: list of [path, readers, compact] intermediate products created by the job (see Scheduler.add)
+        """
+        self.cmd = cmd
+        self.plain_cmd = str(cmd) if plain_cmd is None else plain_cmd
+        self.log = log
+        self.log_append = log_append
+        self.cmd_type = cmd_type
+        self.deps = list(deps)
+        self.cores = cores
+        self.mem = mem
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.micro = micro
+        self.script = script
+        self.speculate = speculate
+        self.temp = list(temp)
+        self.step = None # name of the step (see Scheduler.get_step), to compare run times and in the concurrency profile
+        self.fingerprint = None
+        self.cached = False
+        self.id = None # position in the list of the run
+        self.status = 'waiting' # waiting, running, done, failed, aborted
+        self.returncode = None
+        self.error = None # first problem found in the log
+        # timeline (unix times) and resources used, see Scheduler.write_timeline()
+        self.t_ready = None # all deps done, from here the job waits only for free resources
+        self.t_start = None
+        self.t_end = None
+        self.rusage = None
 
 
 class Scheduler():
-    def __init__(self, qsub = None, max_threads = None, max_processors = None, log_dir = 'logs', dry = False):
+    # commands that typically last less than a second, batched together when the backend has overhead
+    micro_cmds = ['taql', 'rm', 'mv', 'ln', 'mkdir', 'touch']
+    # python scripts run in the persistent python workers (when not on a queue)
+    # wrappers that run the following command in an environment, the step is the wrapped command
+    env_wrappers = ['run_env.sh']
+    inproc_scripts = ['addcol2ms.py', 'BLsmooth.py', 'BLavg.py', 'mslin2circ.py', 'flag_weight_to_zero.py', 'fixMS_TabRef.py']
+
+    def __init__(self, qsub = None, max_threads = None, max_processors = None, log_dir = 'logs', dry = False, node = None, cache = None, log_patterns = {}, timeline = False, \
+            backend = None, batch_size = 20, inproc = False, straggler_factor = 3., straggler_min = 60., \
+            profile = None, concurrency = {}):
         """
         qsub: if true call a shell script which call qsub and then wait 
         for the process to finish before returning
         max_threads: max number of parallel processes
         dry: don't schedule job
         max_processors: max number of processors in a node (ignored if qsub=False)
+        node: Node object describing the local resources where jobs are packed (ignored if qsub=True),
+        default: max_processors cores and all the memory of this machine
+        cache: json file where completed steps are recorded, jobs with outputs whose fingerprint
+        is in the cache and whose outputs exist are skipped (default: no cache)
+        log_patterns: dict of {cmd_type: {'error':[regexps], 'warning':[regexps], 'required':[regexps]}} that
+        replaces/adds command types in LogScanner.patterns
+        timeline: record times and resources of every job in log_dir/timeline-<date>.json (see plot_timeline.py, default: off)
+        backend: Backend object that runs the jobs (default: SlurmBackend in Hamburg if qsub, PBSBackend if qsub, local otherwise)
+        batch_size: max number of micro jobs sent in a single submission (only with backends with overhead)
+        inproc: run the python scripts in inproc_scripts as function calls in persistent workers (see PythonPool, default: off),
+        ignored with a queue backend
+        straggler_factor, straggler_min: a job is a straggler if it runs for more than straggler_factor times
+        and straggler_min seconds more than the median time of the finished jobs of the same step
+        profile: json file with the throughput of each step at different concurrencies in previous runs
+        (see ConcurrencyProfile, e.g. '~/.PiLL_history.json'), used to choose how many jobs of a step run together (default None: no tuning)
+        concurrency: dict of {step: max jobs running together} that overrides the profile (e.g. {'NDPPP:NDPPP-avg.parset': 4})
         """
         self.cluster = self.get_cluster()
         self.qsub = qsub
@@ -127,17 +879,57 @@ class Scheduler():
         else:
             self.max_processors = max_processors
 
+        if node == None: self.node = Node(cores=self.max_processors)
+        else: self.node = node
+
+        if backend != None: self.backend = backend
+        elif self.qsub and self.cluster == 'Hamburg': self.backend = SlurmBackend()
+        elif self.qsub: self.backend = PBSBackend()
+        else: self.backend = Backend()
+        self.batch_size = batch_size
+        self.straggler_factor = straggler_factor
+        self.straggler_min = straggler_min
+        self.durations = {} # run times of the finished jobs of each step in the current run
+        if profile != None and not dry:
+            self.profile = ConcurrencyProfile(os.path.expanduser(profile))
+            logger.info('Using concurrency profile: '+profile+' ('+str(len(self.profile.steps))+' steps profiled on this host).')
+        else: self.profile = None
+        self.concurrency = dict(concurrency)
+        # intermediate products: path -> [size, readers left (None: all the readers of one run), compact cmd]
+        self.products = {}
+        self.footprint = {'peak': 0, 'removed': 0, 'freed': 0, 'disk_peak': 0} # bytes, see update_footprint()
+
+        if inproc and not self.backend.queue: self.pool = PythonPool()
+        else: self.pool = None
+        if self.backend.sentinel and not dry: self.watcher = SentinelWatcher(log_dir+'/sentinels', self.backend)
+        else: self.watcher = None
+
         self.dry = dry
-        logger.info("Scheduler initialized for cluster "+self.cluster+" (Nproc: "+str(self.max_threads)+", multinode: "+str(self.qsub)+", max_processors: "+str(self.max_processors)+").")
+        logger.info("Scheduler initialized for cluster "+self.cluster+" (Nproc: "+str(self.max_threads)+", multinode: "+str(self.qsub)+", max_processors: "+str(self.max_processors)+", backend: "+str(self.backend)+").")
+        if not self.backend.queue: logger.info("Packing jobs on node: "+str(self.node))
+
+        if cache != None:
+            self.cache = StepCache(cache)
+            logger.info('Using step cache: '+cache+' ('+str(len(self.cache.steps))+' steps done).')
+        else: self.cache = None
+
+        self.log_patterns = dict(LogScanner.patterns)
+        self.log_patterns.update(log_patterns)
 
         self.action_list = []
-        self.log_list = [] # list of 2-lenght tuple of the type: (log filename, type of action)
 
         if not os.path.isdir(log_dir):
             logger.info('Creating log dir "'+log_dir+'".')
             os.makedirs(log_dir)
         self.log_dir = log_dir
 
+        if timeline and not dry:
+            import time
+            self.timeline = log_dir+'/timeline-'+time.strftime('%Y%m%d-%H%M%S')+'.json'
+            logger.info('Job timeline saved in: '+self.timeline)
+        else: self.timeline = None
+        self.batch = 0 # number of calls to run()
+
 
     def get_cluster(self):
         """
@@ -153,7 +945,8 @@ class Scheduler():
             return 'Unknown'
 
 
-    def add(self, cmd='', log='', log_append=False, cmd_type='', processors=None):
+    def add(self, cmd='', log='', log_append=False, cmd_type='', processors=None, deps=[], mem=None, inputs=[], outputs=[], micro=None, inproc=None, \
+            speculate=None, temp=[]):
         """
         Add cmd to the scheduler list
         cmd: the command to run
@@ -161,41 +954,145 @@ class Scheduler():
         log_append: if true append, otherwise replace
         cmd_type: can be a list of known command types as "BBS", "NDPPP"...
         processors: number of processors to use, can be "max" to automatically use max number of processors per node
+        deps: ids (returned by add) of previously added commands that must finish before this one can start
+        mem: memory needed in GB, jobs are started only if they fit in the node memory (default: guess from command)
+        inputs: files/dirs read by cmd, their stamps are part of the step fingerprint
+        outputs: files/dirs created by cmd, if given the step is skipped when already done (see cache) otherwise they are removed before running
+        micro: cmd lasts less than a second and can be batched with others (default: guess from micro_cmds)
+        inproc: run the python script of cmd in the python workers (default: only for inproc_scripts)
+        speculate: [cmd, outputs, finalize] if the job is a straggler run also cmd, that must write its outputs elsewhere.
+        If the duplicate finishes first the original is killed and finalize (shell cmd, e.g. "rm -r x.MS; mv x-dup.MS x.MS") is run,
+        otherwise the duplicate is killed and its outputs removed. Only with the local backend.
+        temp: intermediate products created by cmd, removed as soon as the last job reading them (with the path in inputs) is done.
+        Each one is a path or [path, readers, compact]: readers is the number of jobs that will read it, also in
+        later runs (default: the readers of the first run in which it is read), compact is a shell command run
+        instead of removing it (e.g. dropping a column from an MS)
+        Return the id of the command
         """
+        cores, mem = self.get_resources(cmd, processors, mem)
+        plain_cmd = cmd
+        if micro == None: micro = self.is_micro(cmd)
+        if self.pool != None and inproc != False: script = self.get_script(cmd, force=inproc)
+        else: script = None
+
         if log != '': log = self.log_dir+'/'+log
         if log != '' and not log_append: cmd += ' > '+log+' 2>&1'
         if log != '' and log_append: cmd += ' >> '+log+' 2>&1'
 
-        if processors != None and processors == 'max': processors = self.max_processors
+        if speculate != None and len(speculate) != 3:
+            logger.critical('speculate must be [cmd, outputs, finalize]: '+str(speculate))
+            sys.exit(1)
 
-        if self.qsub:
-            # if number of processors not specified, try to find automatically
-            if processors == None:
-                processors = 1 # default use single CPU
-                if "calibrate-stand-alone" == cmd[:21]: processors = 1
-                if "NDPPP" == cmd[:5]: processors = 1
-                if "wsclean" == cmd[:7]: processors = self.max_processors
-                if "awimager" == cmd[:8]: processors = self.max_processors
-            if processors > self.max_processors: processors = self.max_processors
-            self.action_list.append([str(processors),'\''+cmd+'\''])
-        else:
-            self.action_list.append(cmd)
+        temp = [[t, None, None] if isinstance(t, basestring) else list(t)+[None]*(3-len(t)) for t in temp]
+
+        return self._add_job(cmd, log, cmd_type, deps, cores, mem, inputs, outputs, plain_cmd, log_append, micro, script, speculate, temp)
+
+
+    def is_micro(self, cmd):
+        """
+        True if the command (or the python script it runs) is in micro_cmds
+        """
+        tokens = cmd.split()
+        if tokens == []: return False
+        if tokens[0].startswith('python') and len(tokens) > 1: tokens = tokens[1:]
+        return os.path.basename(tokens[0]) in self.micro_cmds
+
+
+    def get_step(self, cmd):
+        """
+        Name of the step of a command: the executable (the script for python, the wrapped command for env_wrappers)
+        and its parset if any, e.g. NDPPP:NDPPP-avg.parset (NDPPP averaging and calibration are different steps)
+        """
+        tokens = cmd.split()
+        while tokens != [] and (os.path.basename(tokens[0]).startswith('python') or os.path.basename(tokens[0]) in self.env_wrappers):
+            tokens = tokens[1:]
+        if tokens == []: return ''
+        for token in tokens[1:]:
+            if token.endswith('.parset'): return os.path.basename(tokens[0])+':'+os.path.basename(token)
+        return os.path.basename(tokens[0])
+
+
+    def expected_time(self, job):
+        """
+        Median run time of the finished jobs of the same step in the current run, None if less than 3 jobs finished
+        """
+        durations = self.durations.get(job.step, [])
+        if len(durations) < 3: return None
+        return sorted(durations)[len(durations)//2]
+
+
+    def get_script(self, cmd, force=False):
+        """
+        Return [script path, args] if cmd is a plain call of a python script (no pipes, redirections...)
+        that is in inproc_scripts (or force=True), otherwise None
+        """
+        import shlex
+        if any(c in cmd for c in '|;&<>`$()*?~'): return None
+        tokens = shlex.split(cmd)
+        if tokens != [] and os.path.basename(tokens[0]).startswith('python'): tokens = tokens[1:]
+        if tokens == [] or not tokens[0].endswith('.py'): return None
+        if not force and not os.path.basename(tokens[0]) in self.inproc_scripts: return None
+        if os.path.sep in tokens[0]: paths = [tokens[0]]
+        else: paths = [os.path.join(d, tokens[0]) for d in ['']+os.environ.get('PATH', '').split(os.pathsep)]
+        for script in paths:
+            if os.path.isfile(script): return [os.path.abspath(script), tokens[1:]]
+        return None
+
+
+    def get_resources(self, cmd, processors=None, mem=None):
+        """
+        Return cores and memory (GB) needed by a command
+        if not specified they are guessed from the command, unknown commands use 1 core and no memory constrain
+        """
+        if processors == 'max': cores = self.node.cores
+        elif processors != None: cores = processors
+        elif "wsclean" == cmd[:7] or "awimager" == cmd[:8]: cores = self.node.cores
+        else: cores = 1
+
+        if mem == None:
+            if "wsclean" == cmd[:7]: mem = 0.9*self.node.mem # as set with -mem 90
+            else: mem = 0
+
+        # a job larger than the node would never start, let it run alone
+        if cores > self.node.cores:
+            logger.warning('Job needs %i cores but node has %i: %s' % (cores, self.node.cores, cmd))
+            cores = self.node.cores
+        if mem > self.node.mem:
+            logger.warning('Job needs %.1f GB but node has %.1f GB: %s' % (mem, self.node.mem, cmd))
+            mem = self.node.mem
 
-        if log != '':
-            self.log_list.append((log,cmd_type))
+        return cores, mem
 
 
-    def add_casa(self, cmd='', params={}, wkd=None, log='', log_append=False, processors=None):
+    def _add_job(self, cmd, log, cmd_type, deps, cores=1, mem=0, inputs=[], outputs=[], plain_cmd=None, log_append=False, micro=False, script=None, speculate=None, temp=[]):
+        """
+        Append a job to the action list and return its id
+        """
+        for d in deps:
+            if d < 0 or d >= len(self.action_list):
+                logger.critical('Unknown dependency %s for: %s' % (str(d), str(cmd)))
+                sys.exit(1)
+        job = Job(cmd, log, cmd_type, deps, cores, mem, inputs, outputs, plain_cmd, log_append, micro, script, speculate, temp)
+        job.step = self.get_step(job.plain_cmd)
+        self.action_list.append(job)
+        return len(self.action_list)-1
+
+
+    def add_casa(self, cmd='', params={}, wkd=None, log='', log_append=False, processors=None, deps=[], mem=None):
         """
         Run a casa command pickling the parameters passed in params
         NOTE: running casa commands in parallel is a problem for the log file, better avoid
         alternatively all used MS and CASA must be in a separate working dir
 
         wkd = working dir (logs and pickle are in the pipeline dir)
+        deps = ids of commands that must finish before this one can start
+        mem = memory needed in GB
+        Return the id of the command
         """
 
         if processors != None and processors == 'max': processors = self.max_processors
         if processors == None: processors=self.max_processors # default use entire node
+        cores, mem = self.get_resources('casa', processors, mem)
 
         # since CASA can run in another dir, be sure log and pickle are in the pipeline working dir
         if log != '': log = os.getcwd()+'/'+self.log_dir+'/'+log
@@ -210,133 +1107,433 @@ class Scheduler():
             logger.error('Cannot find CASA working dir: '+wkd)
             sys.exit(1)
 
-        if self.qsub:
-            if log != '' and not log_append: casacmd = str(processors)+' \''+casacmd+' > '+log+' 2>&1'
-            elif log != '' and log_append: casacmd = str(processors)+' \''+casacmd+' >> '+log+' 2>&1'
-            else: casacmd = str(processors)+' \''+casacmd
-
-            # clean up casa remnants in Hamburg cluster
-            if self.cluster == 'Hamburg':
-                self.action_list.append(casacmd+'; killall -9 -r dbus-daemon Xvfb python casa\*\'')
-                if processors != self.max_processors:
-                    logger.error('To clean annoying CASA remnants no more than 1 CASA per node is allowed.')
-                    sys.exit(1)
-            else:
-                self.action_list.append(casacmd+'\'')
-        else:
-            if log != '' and not log_append: self.action_list.append(casacmd+' > '+log+' 2>&1')
-            elif log != '' and log_append: self.action_list.append(casacmd+' >> '+log+' 2>&1')
-            else: self.action_list.append(casacmd)
+        if log != '' and not log_append: casacmd = casacmd+' > '+log+' 2>&1'
+        elif log != '' and log_append: casacmd = casacmd+' >> '+log+' 2>&1'
+
+        # clean up casa remnants in Hamburg cluster
+        if self.qsub and self.cluster == 'Hamburg':
+            casacmd = casacmd+'; killall -9 -r dbus-daemon Xvfb python casa\*'
+            if processors != self.max_processors:
+                logger.error('To clean annoying CASA remnants no more than 1 CASA per node is allowed.')
+                sys.exit(1)
 
-        if log != '':
-            self.log_list.append((log,'CASA'))
+        return self._add_job(casacmd, log, 'CASA', deps, cores, mem, log_append=log_append)
 
 
-    def run(self, check=False, max_threads=None):
+    def run(self, check=False, max_threads=None, autotune=True):
         """
-        If check=True then a check is done on every log in the log_list
+        Run all the added commands, each one starts as soon as all its dependencies are done and
+        there are enough free threads, cores and memory on the node
+        Jobs with outputs already done in a previous run (see cache) are skipped
+        Micro jobs ready at the same time are sent together in a single submission if the backend has overhead
+        If check=True the log of every job is scanned while it runs (see LogScanner), a job with errors
+        in the log fails and the jobs depending on it are aborted as soon as the error appears
         if max_thread != None, then it overrides the global values, useful for special commands that need a lower number of threads
+        if autotune=True the number of jobs of each step running together is chosen from the profile (see set_concurrency)
+        Every failed job is logged with its exit code and log, a summary of the failed/aborted jobs is logged
+        at the end of the run and the list of them is returned (the caller decides whether to stop)
         """
-        from threading import Thread
-        from Queue import Queue
-        import subprocess
+        from threading import Thread, Condition
+        import subprocess, time
+
+        cond = Condition()
+
+        def get_scanner(job):
+            if not check or job.log == '': return None
+            if not job.cmd_type in self.log_patterns:
+                logger.warning('Unknown command type for log checking: "'+job.cmd_type+'"')
+                return None
+            offset = os.path.getsize(job.log) if job.log_append and os.path.exists(job.log) else 0
+            return LogScanner(job.log, job.cmd_type, self.log_patterns, offset)
+
+        def report(job, problems):
+            with cond:
+                if job.error is None:
+                    job.error = problems[0]
+                    logger.error('%s run problem on: %s\n%s' % (job.cmd_type, job.log, job.error))
+                    cond.notify() # abort dependents now
+
+        def batch_cmd(group):
+            """
+            Write a script that runs all the jobs of a group one after the other, each one
+            appending its id, return code and end time to a status file
+            """
+            script = os.path.abspath('%s/batch-%i-%i.sh' % (self.log_dir, self.batch, group[0].id))
+            status = script.replace('.sh', '.status')
+            with open(script, 'w') as f:
+                f.write('cd '+os.getcwd()+'\n')
+                for job in group:
+                    f.write('( '+job.cmd+' ); echo "'+str(job.id)+' $? $(date +%s.%N)" >> '+status+'\n')
+            return 'sh '+script, script, status
+
+        def run_group(group):
+            cores = max([job.cores for job in group])
+            if len(group) == 1:
+                cmd_plain = group[0].cmd
+                scanner = get_scanner(group[0])
+            else:
+                cmd_plain, script, status = batch_cmd(group)
+                scanner = None # logs are checked at the end
+            cmd = self.backend.wrap(cmd_plain, cores)
+            t_start = time.time()
+            for job in group: job.t_start = t_start
+            job = group[0]
+            # jobs that may be killed to keep a faster duplicate run in their own process group
+            speculate = len(group) == 1 and job.speculate != None and job.script is None and not self.backend.queue
+            # no python worker left (all crashed): the script runs as a normal command
+            w = self.pool.start(job.script[0], job.script[1], job.log, job.log_append) if len(group) == 1 and job.script != None else None
+            if w != None:
+                poll = lambda timeout: self.pool.result(w, timeout)
+            elif self.watcher != None:
+                # submit and wait for the sentinel
+                sentinel = self.watcher.new()
+                cmd = self.backend.wrap(cmd_plain, cores, sentinel)
+                p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+                out = p.communicate()[0].split()
+                if p.returncode == 0 and out != []:
+                    self.watcher.submitted(sentinel, out[-1])
+                    poll = lambda timeout: (lambda rc: None if rc is None else (rc, None))(self.watcher.wait(sentinel, timeout))
+                else:
+                    logger.error('Submission failed: '+cmd)
+                    self.watcher.cancel(sentinel)
+                    poll = lambda timeout: (p.returncode if p.returncode != 0 else -1, None)
+            else:
+                p = subprocess.Popen(cmd, shell=True, preexec_fn=os.setsid if speculate else None)
+                poll = lambda timeout: wait_process(p, timeout)
+
+            expected = self.expected_time(job) if len(group) == 1 else None
+            if scanner is None and expected is None:
+                returncode, rusage = poll(None)
+            else:
+                wait = 0.1
+                dup = None # duplicate process
+                winner = 'original'
+                while True:
+                    r = poll(wait)
+                    if r != None and (r[0] == 0 or dup is None): break
+                    if r != None:
+                        # the original failed, the duplicate can still make it
+                        logger.warning('Original failed, waiting for the duplicate: '+job.plain_cmd)
+                        p, dup, winner = dup, None, 'duplicate'
+                        continue
+                    if dup != None:
+                        r = wait_process(dup, 0)
+                        if r != None and r[0] == 0:
+                            kill_process(p)
+                            dup, winner = None, 'duplicate'
+                            break
+                        if r != None:
+                            logger.warning('Duplicate failed: '+job.speculate[0])
+                            dup = None
+                    if scanner != None:
+                        problems = scanner.scan()
+                        if problems != []: report(job, problems)
+                    elapsed = time.time() - t_start
+                    if expected != None and elapsed > self.straggler_factor*expected and elapsed - expected > self.straggler_min:
+                        logger.warning('Straggler (running for %.1fs, expected %.1fs): %s' % (elapsed, expected, job.plain_cmd))
+                        expected = None # flag once
+                        if speculate:
+                            dupcmd = job.speculate[0]
+                            if job.log != '': dupcmd = '( '+dupcmd+' ) > '+job.log+'.dup 2>&1'
+                            logger.info('Starting duplicate: '+dupcmd)
+                            dup = subprocess.Popen(dupcmd, shell=True, preexec_fn=os.setsid)
+                    wait = min(2*wait, 1.)
+                returncode, rusage = r
+
+                if dup != None:
+                    kill_process(dup)
+                    check_rm(' '.join(job.speculate[1]))
+                if winner == 'duplicate':
+                    logger.info('Duplicate finished first: '+job.plain_cmd)
+                    if scanner != None: scanner = LogScanner(job.log+'.dup', job.cmd_type, self.log_patterns)
+                    if returncode == 0 and job.speculate[2] != '':
+                        returncode = subprocess.call(job.speculate[2], shell=True)
+            t_end = time.time()
+
+            if len(group) == 1:
+                group[0].t_end = t_end
+                group[0].rusage = rusage
+                group[0].returncode = returncode
+            else:
+                # return code and end time of each job from the status file, a job not there never run
+                done = {}
+                if os.path.exists(status):
+                    with open(status) as f:
+                        for l in f:
+                            i, rc, t = l.split()
+                            done[int(i)] = (int(rc), float(t))
+                for job in group:
+                    job.t_start = t_start
+                    if job.id in done:
+                        job.returncode, job.t_end = done[job.id]
+                        t_start = job.t_end
+                    else:
+                        job.returncode, job.t_end = returncode if returncode != 0 else -1, t_end
+                    logger.debug('Batched job %i returned %i: %s' % (job.id, job.returncode, job.plain_cmd))
+                check_rm(script+' '+status)
+
+            for job in group:
+                if len(group) > 1: scanner = get_scanner(job)
+                if scanner != None:
+                    problems = scanner.scan(final=True)
+                    if problems != []: report(job, problems)
+                    if scanner.warnings != []:
+                        logger.warning('%i warnings in %s, first: %s' % (len(scanner.warnings), job.log, scanner.warnings[0]))
+            sizes = dict((t[0], get_size(t[0])) for job in group for t in job.temp)
+            with cond:
+                for job in group:
+                    job.status = 'done' if job.returncode == 0 and job.error is None else 'failed'
+                    if job.returncode != 0:
+                        logger.error('Failed (exit code %s, log: %s): %s' % (job.returncode, job.log if job.log != '' else '-', job.plain_cmd))
+                    if job.status == 'done' and len(group) == 1:
+                        self.durations.setdefault(job.step, []).append(job.t_end - job.t_start)
+                    if job.status == 'done' and job.fingerprint != None:
+                        self.cache.set_done(job.fingerprint, job.outputs)
+                release = self.release_products(jobs, group, sizes)
+                if release == []: running.remove(group)
+                cond.notify()
+            if release == []: return
+            # remove outside of the lock, rm of large MSs takes time
+            for path, size, compact in release:
+                if compact is None:
+                    logger.debug('Remove intermediate product (%.2f GB): %s' % (size/1024.**3, path))
+                    check_rm(path)
+                else:
+                    logger.debug('Compact intermediate product (%.2f GB): %s' % (size/1024.**3, path))
+                    subprocess.call(compact, shell=True)
+            freed = sum([size for path, size, compact in release if compact is None]) + \
+                    sum([size - get_size(path) for path, size, compact in release if compact != None])
+            with cond:
+                self.footprint['removed'] += len(release)
+                self.footprint['freed'] += freed
+                self.update_footprint()
+                running.remove(group)
+                cond.notify()
+
+        def worker(group):
+            """
+            Run a group in its thread, whatever goes wrong the group leaves running and the main loop is woken up
+            """
+            ok = False
+            try:
+                run_group(group)
+                ok = True
+            except Exception as e:
+                logger.error('Scheduler error (%s: %s) running: %s' % (type(e).__name__, str(e), ', '.join([job.plain_cmd for job in group])))
+            finally:
+                if not ok:
+                    with cond:
+                        for job in group:
+                            if job.status == 'running': job.status = 'failed'
+                        if group in running: running.remove(group)
+                        cond.notify()
+
+        def start(group):
+            for job in group: job.status = 'running'
+            running.append(group)
+            t = Thread(target=worker, args=(group,))
+            t.daemon = True
+            t.start()
+            threads.append(t)
 
-        def worker(queue):
-            for cmd in iter(queue.get, None):
-                if self.qsub and self.cluster == 'Hamburg':
-                    # run in priority nodes
-                    #cmd = 'salloc --job-name LBApipe --reservation=important_science --time=24:00:00 --nodes=1 --tasks-per-node='+cmd[0]+\
-                    #        ' /usr/bin/srun --ntasks=1 --nodes=1 --preserve-env \''+cmd[1]+'\''
-                    # run on all cluster
-                    cmd = 'salloc --job-name LBApipe --time=24:00:00 --nodes=1 --tasks-per-node='+cmd[0]+\
-                            ' /usr/bin/srun --ntasks=1 --nodes=1 --preserve-env \''+cmd[1]+'\''
-                subprocess.call(cmd, shell=True)
-    
         # limit threads only when qsub doesn't do it
         if max_threads != None: max_threads_run = min(max_threads, self.max_threads)
         else: max_threads_run = self.max_threads
 
-        q = Queue()
-        threads = [Thread(target=worker, args=(q,)) for _ in range(max_threads_run)]
-    
-        for i, t in enumerate(threads): # start workers
-            t.daemon = True
-            t.start()
-    
-        for action in self.action_list:
-            if self.dry: continue # don't schedule if dry run
-            q.put_nowait(action)
-        for _ in threads: q.put(None) # signal no more commands
-        for t in threads: t.join()
+        def fits(group):
+            """
+            True if a group of jobs can start without oversubscribing threads/cores/memory
+            (jobs in a group run one after the other), with a queue the resources are handled by the queue
+            """
+            if len(running) >= max_threads_run: return False
+            if len(group) == 1 and group[0].step in limits and \
+                    len([g for g in running if g[0].step == group[0].step]) >= limits[group[0].step]: return False
+            if self.backend.queue: return True
+            return sum([max([j.cores for j in g]) for g in running]) + max([j.cores for j in group]) <= self.node.cores and \
+                   sum([max([j.mem for j in g]) for g in running]) + max([j.mem for j in group]) <= self.node.mem
+
+        jobs = [] if self.dry else self.action_list # don't schedule if dry run
+        self.durations = {} # the same step may process different data in another run
+        for i, job in enumerate(jobs): job.id = i
+        batching = self.backend.overhead > 0 and self.batch_size > 1
+        running = [] # groups of jobs sent together
+        threads = []
+        ninproc = min(len([job for job in jobs if job.script != None]), max_threads_run)
+        # fork the python workers now, before any worker thread runs (the threads of the previous run are joined)
+        # this also replaces the workers crashed in the previous runs
+        if ninproc > 0: self.pool.grow(ninproc)
+        limits = self.set_concurrency(jobs, max_threads_run, autotune) # max jobs of a step running together
+        t_submit = time.time()
+        with cond:
+            while True:
+                # abort jobs depending on failed ones, skip cached ones
+                ready = []
+                for job in jobs:
+                    if job.status != 'waiting': continue
+                    deps_status = [self.action_list[d].status for d in job.deps]
+                    deps_error = [self.action_list[d].error for d in job.deps]
+                    if any(st in ['failed', 'aborted'] for st in deps_status) or any(e != None for e in deps_error):
+                        job.status = 'aborted'
+                        logger.error('Aborted (failed dependency): '+str(job.cmd))
+                        continue
+                    if not all(st == 'done' for st in deps_status): continue
+                    if job.t_ready is None:
+                        job.t_ready = max([t_submit]+[self.action_list[d].t_end for d in job.deps])
+                    if self.cache != None and job.outputs != [] and job.fingerprint is None and self.is_cached(job):
+                        job.status = 'done'
+                        job.cached = True
+                        job.t_start = job.t_end = job.t_ready
+                        logger.info('Skipping (already done): '+job.plain_cmd)
+                        continue
+                    ready.append(job)
+
+                # start the ready ones that fit in order of submission, micro jobs in groups
+                micro = [job for job in ready if batching and job.micro]
+                for job in ready:
+                    if batching and job.micro: continue
+                    if fits([job]): start([job])
+                for i in range(0, len(micro), self.batch_size):
+                    group = micro[i:i+self.batch_size]
+                    if fits(group): start(group)
+
+                if not any(job.status in ['waiting', 'running'] for job in jobs) and running == []: break
+                cond.wait()
+        for t in threads: t.join() # they are leaving, all their groups are out of running
 
-        # check outcomes on logs
-        if check:
-            for log, cmd_type in self.log_list:
-                self.check_run(log, cmd_type)
+        if self.timeline != None and jobs != []: self.write_timeline(t_submit)
+        if self.profile != None and jobs != []: self.profile.record(jobs)
+        if any(job.temp != [] for job in jobs) or self.products != {}:
+            fp = self.footprint
+            logger.info('Disk footprint: intermediates peak %.2f GB, now %.2f GB (%i removed, %.2f GB freed) - disk peak %.2f GB used.' % \
+                    (fp['peak']/1024.**3, sum([p[0] for p in self.products.values()])/1024.**3, fp['removed'], fp['freed']/1024.**3, fp['disk_peak']/1024.**3))
 
         # reset list of commands
         self.action_list = []
-        self.log_list = []
+        self.batch += 1
 
+        failed = [job for job in jobs if job.status in ['failed', 'aborted']]
+        if failed != []:
+            summary = '%i of %i jobs failed or aborted:\n' % (len(failed), len(jobs)) + \
+                      '\n'.join(['%s (log: %s): %s' % (job.status, job.log if job.log != '' else '-', job.plain_cmd) for job in failed])
+            logger.error(summary)
+        return failed
 
-    def check_run(self, log='', cmd_type=''):
+
+    def release_products(self, jobs, group, sizes):
         """
-        Produce a warning if a command didn't close the log properly i.e. it crashed
-        NOTE: grep, -L inverse match, -l return only filename
+        Register the intermediate products of the finished jobs in group and find the ones that are not needed anymore:
+        their last reader is done (a product with a failed reader is kept)
+        jobs: all jobs of the run, sizes: {path: bytes} of the products of group
+        Return the list of [path, size, compact cmd] to remove/compact, they are not tracked anymore
         """
-        import subprocess
+        norm = os.path.normpath
+        for job in group:
+            if job.status != 'done': continue
+            for path, readers, compact in job.temp:
+                self.products[norm(path)] = [sizes[path], readers, compact]
+            for i in set([norm(i) for i in job.inputs]):
+                if i in self.products and self.products[i][1] != None: self.products[i][1] -= 1
+        self.update_footprint()
+
+        release = []
+        for path in set([norm(i) for job in group for i in job.inputs] + [norm(t[0]) for job in group for t in job.temp]):
+            if not path in self.products: continue
+            size, left, compact = self.products[path]
+            readers = [job for job in jobs if path in [norm(i) for i in job.inputs]]
+            if left is None and (readers == [] or any(job.status != 'done' for job in readers)): continue
+            if left != None and (left > 0 or any(job.status in ['waiting', 'running'] for job in readers)): continue
+            release.append([path, size, compact])
+            del self.products[path]
+        return release
+
+
+    def update_footprint(self):
+        """
+        Update the peak size of the intermediate products alive at the same time and the peak usage of the
+        disk of the working dir (everything on that disk, also products not declared as temp)
+        """
+        st = os.statvfs('.')
+        self.footprint['peak'] = max(self.footprint['peak'], sum([p[0] for p in self.products.values()]))
+        self.footprint['disk_peak'] = max(self.footprint['disk_peak'], (st.f_blocks - st.f_bfree) * st.f_frsize)
+
+
+    def set_concurrency(self, jobs, max_threads, autotune=True):
+        """
+        Choose the max number of jobs of each step running together: from the concurrency dict if
+        the step is there, otherwise from the profile of the previous runs (if autotune)
+        Only steps with more jobs than their limit are tuned (the others cannot be slowed down by their own jobs)
+        Return {step: max jobs}
+        """
+        limits = {}
+        steps = {}
+        for job in jobs:
+            if job.micro: continue
+            steps.setdefault(job.step, []).append(job)
+        for step, sjobs in sorted(steps.items()):
+            limit = min(max_threads, len(sjobs))
+            if not self.backend.queue: limit = min(limit, self.node.cores//max([j.cores for j in sjobs]))
+            if limit < 2: continue
+            if step in self.concurrency or step.split(':')[0] in self.concurrency:
+                limits[step] = self.concurrency.get(step, self.concurrency.get(step.split(':')[0]))
+                logger.info('Concurrency of %s: %i (set by user).' % (step, limits[step]))
+            elif autotune and self.profile != None:
+                level, reason = self.profile.choose(step, limit, None if self.backend.queue else self.node.mem)
+                if level is None: continue
+                limits[step] = max(level, 1)
+                logger.info('Concurrency of %s: %i of max %i, %s.' % (step, limits[step], limit, reason))
+        return limits
 
+
+    def write_timeline(self, t_submit):
+        """
+        Append a json line per job of the current batch to the timeline file
+        cpu times are in s, maxrss in MB, read/write in bytes (from the block counts)
+        NOTE: with qsub the resources are the ones of the waiter script, not of the job
+        """
+        import json
+        with open(self.timeline, 'a') as f:
+            for i, job in enumerate(self.action_list):
+                r = job.rusage
+                entry = {'batch': self.batch, 'id': i, 'cmd': job.plain_cmd, 'cmd_type': job.cmd_type, 'log': job.log, \
+                        'deps': job.deps, 'status': job.status, 'cached': job.cached, 'cores': job.cores, 'mem': job.mem, \
+                        't_submit': t_submit, 't_ready': job.t_ready, 't_start': job.t_start, 't_end': job.t_end, \
+                        'cpu_user': r.ru_utime if r else None, 'cpu_sys': r.ru_stime if r else None, \
+                        'maxrss': r.ru_maxrss/1024. if r else None, \
+                        'read': r.ru_inblock*512 if r else None, 'write': r.ru_oublock*512 if r else None}
+                f.write(json.dumps(entry)+'\n')
+
+
+    def is_cached(self, job):
+        """
+        Check if the job was already done, otherwise remove its old outputs and prepare its fingerprint
+        The fingerprint is computed when deps are done, so inputs are final
+        """
+        fingerprint = self.cache.fingerprint(job.plain_cmd, job.inputs, job.outputs)
+        if self.cache.is_done(fingerprint, job.outputs): return True
+        check_rm(' '.join(job.outputs))
+        job.fingerprint = fingerprint
+        return False
+
+
+    def check_run(self, log='', cmd_type=''):
+        """
+        Check a whole log file after the end of a command, produce an error if a command didn't
+        close the log properly i.e. it crashed (see LogScanner for the patterns)
+        Return 1 if there were problems, 0 otherwise
+        """
         if not os.path.exists(log):
             logger.warning('No log file found to check results: '+log)
             return 1
 
-        if cmd_type == 'BBS':
-            out = subprocess.check_output('grep -L success '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            if out != '':
-                logger.error('BBS run problem on:\n'+out.split("\n")[0])
-                return 1
-
-        elif cmd_type == 'NDPPP':
-            out = subprocess.check_output('grep -L "Finishing processing" '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "Exception" '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "**** uncaught exception ****" '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            if out != '':
-                logger.error('NDPPP run problem on:\n'+out.split("\n")[0])
-                return 1
-
-        elif cmd_type == 'CASA':
-            out = subprocess.check_output('grep -l "[a-z]Error" '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "An error occurred running" '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "\*\*\* Error \*\*\*" '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            if out != '':
-                logger.error('CASA run problem on:\n'+out.split("\n")[0])
-                return 1
-
-        elif cmd_type == 'wsclean':
-            out = subprocess.check_output('grep -l "exception occurred" '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            out += subprocess.check_output('grep -L "Cleaning up temporary files..." '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            if out != '':
-                logger.error('WSClean run problem on:\n'+out.split("\n")[0])
-                return 1
-
-        elif cmd_type == 'python':
-            out = subprocess.check_output('grep -l "Traceback (most recent call last):" '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            out += subprocess.check_output('grep -i -l "Error" '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            out += subprocess.check_output('grep -i -l "Critical" '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            if out != '':
-                logger.error('Python run problem on:\n'+out.split("\n")[0])
-                return 1
-
-        elif cmd_type == 'general':
-            out = subprocess.check_output('grep -l -i "error" '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            if out != '':
-                logger.error('Run problem on:\n'+out.split("\n")[0])
-                return 1
-
-        else:
+        if not cmd_type in self.log_patterns:
             logger.warning('Unknown command type for log checking: "'+cmd_type+'"')
             return 1
 
+        problems = LogScanner(log, cmd_type, self.log_patterns).scan(final=True)
+        if problems != []:
+            logger.error('%s run problem on: %s\n%s' % (cmd_type, log, problems[0]))
+            return 1
+
         return 0
 
 
@@ -344,3 +1541,4 @@ from lib_pipeline_ms import *
 from lib_pipeline_img import *
 from lib_pipeline_dd import *
 from lib_pipeline_log import *
+from lib_pipeline_download import *
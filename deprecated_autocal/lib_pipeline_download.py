@@ -0,0 +1,171 @@
+#!/usr/bin/python
+
+import os, sys, time, zlib, hashlib, socket
+import urllib2, httplib
+
+import logging
+logger = logging.getLogger('PiLL')
+
+class ResumableStream(object):
+
+    def __init__(self, url, partfile, retries=10, timeout=60):
+        """
+        File-like object that reads an url saving all the data in a partial file
+        data already in the partial file (e.g. from an interrupted run) are read from there first,
+        then the download continues from that byte. Dropped connections are resumed with HTTP Range requests.
+        url : url to download
+        partfile : file where the downloaded data are kept
+        retries : max number of consecutive failed connections
+        timeout : seconds without data before a connection is considered dropped
+        """
+        self.url = url
+        self.partfile = partfile
+        self.retries = retries
+        self.timeout = timeout
+        self.f = open(partfile, 'ab+') # writes are always appended
+        self.f.seek(0)
+        self.written = os.path.getsize(partfile) # bytes in the partial file
+        self.from_file = self.written > 0
+        if self.from_file: logger.info('%s: resuming after %i bytes.' % (partfile, self.written))
+        self.resp = None
+        self.pos = 0 # bytes read
+        self.size = None # total size, known after the first connection
+        self.adler32 = 1
+        self.md5 = hashlib.md5()
+
+    def connect(self):
+        """
+        Open the connection from the end of the partial file
+        """
+        req = urllib2.Request(self.url)
+        if self.written > 0: req.add_header('Range', 'bytes=%i-' % self.written)
+        try:
+            self.resp = urllib2.urlopen(req, timeout=self.timeout)
+        except urllib2.HTTPError as e:
+            if e.code != 416: raise
+            self.size = self.written # range not satisfiable: the partial file is complete
+            return
+        if self.written > 0 and self.resp.getcode() != 206:
+            # server doesn't support ranges: skip what we already have
+            logger.warning('%s: no resume support, skipping %i bytes.' % (self.url, self.written))
+            skip = self.written
+            while skip > 0:
+                chunk = self.resp.read(min(skip, 1024**2))
+                if chunk == '': raise httplib.IncompleteRead('')
+                skip -= len(chunk)
+        crange = self.resp.info().getheader('Content-Range') # bytes start-end/size
+        length = self.resp.info().getheader('Content-Length')
+        if crange != None and '/' in crange and crange.split('/')[1] != '*':
+            self.size = int(crange.split('/')[1])
+        elif length != None:
+            self.size = int(length) + (self.written if self.resp.getcode() == 206 else 0)
+
+    def read(self, n=1024**2):
+        data = ''
+        if self.from_file:
+            data = self.f.read(n)
+            if len(data) < n:
+                self.from_file = False
+                self.f.seek(0, 2) # needed between a read and a write
+
+        failures = 0
+        while len(data) < n and not self.from_file:
+            if self.size != None and self.written >= self.size: break # all done
+            try:
+                if self.resp is None:
+                    self.connect()
+                    continue
+                chunk = self.resp.read(n-len(data))
+            except (urllib2.URLError, socket.error, httplib.HTTPException) as e:
+                failures += 1
+                if failures > self.retries: raise
+                logger.warning('%s: connection problem (%s), retry %i...' % (self.url, str(e), failures))
+                self.resp = None
+                time.sleep(min(2**failures, 60))
+                continue
+            if chunk == '':
+                if self.size is None: break # unknown size, trust the server
+                self.resp = None # dropped before the end
+                continue
+            failures = 0
+            self.f.write(chunk)
+            self.written += len(chunk)
+            data += chunk
+
+        self.pos += len(data)
+        self.adler32 = zlib.adler32(data, self.adler32)
+        self.md5.update(data)
+        return data
+
+    def close(self):
+        self.f.close()
+        if self.resp != None: self.resp.close()
+
+
+def download(url, partfile, outdir='.', adler32=None, md5=None, retries=10):
+    """
+    Download a tar archive and extract it while it is downloaded
+    url : url of the tar archive
+    partfile : file where the downloaded data are kept, to resume if the download is interrupted.
+    It is removed at the end, also if checksums don't match (the download restarts from zero next time)
+    if anything goes wrong the extracted files are removed
+    outdir : where to extract the archive
+    adler32, md5 : expected checksums (hex strings, None to skip the check)
+    Return True if the archive is complete and the checksums match
+    """
+    import tarfile, shutil
+    stream = ResumableStream(url, partfile, retries=retries)
+    extracted = set() # top level dirs/files of the archive, removed if something goes wrong
+    def clean():
+        for name in extracted:
+            path = os.path.join(outdir, name)
+            if os.path.isdir(path) and not os.path.islink(path): shutil.rmtree(path)
+            elif os.path.lexists(path): os.remove(path)
+
+    try:
+        with tarfile.open(fileobj=stream, mode='r|') as tar:
+            for member in tar:
+                extracted.add(member.name.lstrip('./').split('/')[0])
+                tar.extract(member, outdir)
+        while stream.read() != '': pass # tar padding, needed for size and checksums
+    except (tarfile.TarError, urllib2.URLError, socket.error, httplib.HTTPException, IOError) as e:
+        logger.error('%s: download failed (%s).' % (url, str(e)))
+        stream.close()
+        clean() # the partial file is kept, next time extraction restarts from there
+        return False
+    stream.close()
+
+    ok = True
+    if stream.size != None and stream.pos != stream.size:
+        logger.error('%s: got %i bytes instead of %i.' % (url, stream.pos, stream.size))
+        ok = False
+    if adler32 != None and int(adler32, 16) != stream.adler32 & 0xffffffff:
+        logger.error('%s: wrong adler32 checksum (%08x instead of %s).' % (url, stream.adler32 & 0xffffffff, adler32))
+        ok = False
+    if md5 != None and md5.lower() != stream.md5.hexdigest():
+        logger.error('%s: wrong md5 checksum (%s instead of %s).' % (url, stream.md5.hexdigest(), md5))
+        ok = False
+    os.remove(partfile)
+    if not ok: clean()
+    return ok
+
+
+def download_all(downloads, outdir='.', max_conn=4, retries=10):
+    """
+    Download and extract many tar archives in parallel
+    downloads : list of [url, partfile, adler32, md5] (checksums can be None)
+    max_conn : max number of simultaneous downloads
+    Return the list of urls that failed
+    """
+    from multiprocessing.pool import ThreadPool
+    def worker(d):
+        url, partfile, adler32, md5 = d
+        logger.debug('Downloading: '+url)
+        t = time.time()
+        ok = download(url, partfile, outdir, adler32, md5, retries)
+        if ok: logger.debug('Downloaded in %is: %s' % (time.time()-t, url))
+        return ok
+    pool = ThreadPool(max_conn)
+    results = pool.map(worker, downloads, chunksize=1)
+    pool.close()
+    return [d[0] for d, ok in zip(downloads, results) if not ok]
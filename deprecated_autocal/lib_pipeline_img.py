@@ -44,6 +44,66 @@ class Image(object):
         del lsm
 
 
+class ConvergenceTracker(object):
+    def __init__(self, name='', threshold=0.05, patience=1, boxsize=None, logfile=None):
+        """
+        Follow noise and dynamic range of the images of successive calibration cycles, to stop when they do not improve anymore
+        name : name used in the logs
+        threshold : min relative improvement of noise (decrease) or dynamic range (increase) over the best cycle so far
+        patience : number of cycles in a row without improvement before convergence
+        boxsize : measure the noise in the central box of this size in pixels (see get_noise_img)
+        logfile : json lines file where measures and decisions of every cycle are appended
+        """
+        self.name = name
+        self.threshold = threshold
+        self.patience = patience
+        self.boxsize = boxsize
+        self.logfile = logfile
+        self.cycles = [] # [cycle, rms, peak, dynamic range]
+        self.best = None # index of the best cycle in self.cycles
+        self.stalled = 0 # cycles in a row without improvement
+        self.converged = False
+
+    def add(self, cycle, imagename, residualname=None):
+        """
+        Measure the image of a cycle: rms noise (of the residual if given) and peak flux
+        Return True if converged
+        """
+        import json, time
+        import astropy.io.fits as pyfits
+        rms = get_noise_img(residualname if residualname is not None else imagename, boxsize=self.boxsize)
+        with pyfits.open(imagename) as fits:
+            peak = np.nanmax(fits[0].data)
+        dr = peak/rms
+        self.cycles.append([cycle, rms, peak, dr])
+
+        if self.best is None:
+            decision = 'first cycle'
+            self.best = 0
+        else:
+            best_cycle, best_rms, best_peak, best_dr = self.cycles[self.best]
+            d_rms = (best_rms - rms)/best_rms
+            d_dr = (dr - best_dr)/best_dr
+            if d_rms > self.threshold or d_dr > self.threshold:
+                decision = 'improved over cycle %s (noise %+.1f%%, dynamic range %+.1f%%)' % (str(best_cycle), -100*d_rms, 100*d_dr)
+                self.best = len(self.cycles)-1
+                self.stalled = 0
+            else:
+                self.stalled += 1
+                decision = 'no improvement over cycle %s (noise %+.1f%%, dynamic range %+.1f%%, threshold %.1f%%) for %i cycle(s)' % \
+                        (str(best_cycle), -100*d_rms, 100*d_dr, 100*self.threshold, self.stalled)
+                if self.stalled >= self.patience:
+                    self.converged = True
+                    decision += ' - converged'
+
+        logger.info('%s cycle %s: rms noise %.3f mJy/b, peak %.3f Jy/b, dynamic range %.1f - %s.' % (self.name, str(cycle), rms*1e3, peak, dr, decision))
+        if self.logfile is not None:
+            with open(self.logfile, 'a') as f:
+                f.write(json.dumps({'name': self.name, 'cycle': cycle, 'time': time.time(), 'image': imagename, 'residual': residualname, \
+                        'rms': float(rms), 'peak': float(peak), 'dr': float(dr), 'converged': self.converged, 'decision': decision})+'\n')
+        return self.converged
+
+
 def flatten(f, channel=0, freqaxis=0):
     """ Flatten a fits file so that it becomes a 2D image. Return new header and data """
     from astropy import wcs
@@ -213,34 +273,27 @@ def blank_image_reg(filename, region, outfile=None, inverse=False, blankval=0.,
     logger.debug("%s: Blanking (%s): sum of values: %f -> %f" % (filename, region, sum_before, np.sum(data)))
 
 
-def get_noise_img(filename, boxsize=None, niter=20, eps=1e-5):
+def get_noise_img(filename, boxsize=None, niter=20, eps=1e-5, sample=None):
     """
     Return the rms of all the pixels in an image
     boxsize : limit to central box of this pixelsize
     niter : robust rms estimation
     eps : convergency
+    sample : fraction of image rows to use (None = all), see lib_fits.robust_rms
     """
     import astropy.io.fits as pyfits
-    with pyfits.open(filename) as fits:
+    from lib_fits import robust_rms
+    with pyfits.open(filename, memmap=True) as fits:
         data = fits[0].data
+        if len(data.shape)==4: data = data[0,0]
         if boxsize is None:
             subim = data
         else:
-           if len(data.shape)==4:
-                _,_,ys,xs = data.shape
-                subim = data[0,0,ys/2-boxsize/2:ys/2+boxsize/2,xs/2-boxsize/2:xs/2+boxsize/2].flatten()
-           else:
-                ys,xs = data.shape
-                subim = data[ys/2-boxsize/2:ys/2+boxsize/2,xs/2-boxsize/2:xs/2+boxsize/2].flatten()
-        oldrms = 1.
-        for i in range(niter):
-            rms = np.nanstd(subim)
-            #print len(subim),rms
-            if np.abs(oldrms-rms)/rms < eps:
-                return rms
-            subim=subim[np.abs(subim)<5*rms]
-            oldrms=rms
-        raise Exception('Failed to converge')
+            ys,xs = data.shape
+            subim = data[ys/2-boxsize/2:ys/2+boxsize/2,xs/2-boxsize/2:xs/2+boxsize/2]
+        rms, err = robust_rms(subim, clip=5., niter=niter, eps=eps, sample=sample)
+        if err > 0: logger.debug('%s: rms %.3f +/- %.3f mJy/b (sampled)' % (filename, rms*1e3, err*1e3))
+        return rms
 
 #def nan2zeros(filename):
 #    """
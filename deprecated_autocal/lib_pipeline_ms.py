@@ -159,3 +159,138 @@ def get_phase_centre(ms):
         dec = direction[ ant_no, field_no, 1 ]
     return (ra*180/np.pi, dec*180/np.pi)
 
+
+
+class ScratchStage(object):
+
+    def __init__(self, scratch='/dev/shm', budget=None, ncpu=8):
+        """
+        Copies of MSs on node-local fast storage, to run chains of steps with random I/O (NDPPP, BLsmooth, taql)
+        away from the network filesystem. Only the files changed on the copy are synced back.
+        scratch : local dir (e.g. /dev/shm or a local SSD), copies are in a subdir removed by clean()
+        budget : max GB used in scratch (default: 80% of the free space), the least recently used MSs are
+        synced back and removed to make space
+        ncpu : number of MSs copied at the same time
+        """
+        from collections import OrderedDict
+        self.dir = os.path.join(scratch, 'PiLL-%i' % os.getpid())
+        if not os.path.isdir(self.dir): os.makedirs(self.dir)
+        if budget is None:
+            st = os.statvfs(self.dir)
+            self.budget = 0.8 * st.f_bavail * st.f_frsize
+        else:
+            self.budget = budget * 1024.**3
+        self.ncpu = ncpu
+        self.staged = OrderedDict() # ms -> [local copy, size in bytes, {file: (size, mtime)}, reserved bytes], least recently used first
+        logger.info('Staging MSs in %s (%.1f GB).' % (self.dir, self.budget/1024.**3))
+
+    def snapshot(self, path):
+        """
+        Return {relative file name: (size, mtime)} of all files in a dir
+        """
+        files = {}
+        for root, dirs, fs in os.walk(path):
+            for f in fs:
+                st = os.lstat(os.path.join(root, f))
+                files[os.path.relpath(os.path.join(root, f), path)] = (st.st_size, st.st_mtime)
+        return files
+
+    def used(self):
+        """
+        Bytes taken in scratch, including the space reserved for the growth of each MS
+        """
+        return sum([max(v[1], v[3]) for v in self.staged.values()])
+
+    def get(self, mss, ncols=0):
+        """
+        Stage a list of MSs (the ones already staged are not copied again)
+        ncols : number of data columns the following steps add to each MS, the size of the MS
+        is reserved for each of them (i.e. an MS is admitted only if size*(1+ncols) fits)
+        Return the list of paths to use: the local copies, or the original path of MSs that do not fit in the budget
+        """
+        import shutil
+        from multiprocessing.pool import ThreadPool
+        to_copy = []
+        for ms in mss:
+            if ms in self.staged:
+                self.staged[ms] = self.staged.pop(ms) # most recently used
+                continue
+            size = sum([v[0] for v in self.snapshot(ms).values()])
+            reserved = size * (1 + ncols)
+            # make space removing MSs not needed now
+            while self.used() + sum([c[3] for c in to_copy]) + reserved > self.budget:
+                old = [m for m in self.staged if not m in mss]
+                if old == []: break
+                self.evict(old[0])
+            if self.used() + sum([c[3] for c in to_copy]) + reserved > self.budget:
+                logger.warning('No space to stage %s (%.1f GB with %i new columns), using it in place.' % (ms, reserved/1024.**3, ncols))
+                continue
+            to_copy.append([ms, os.path.join(self.dir, os.path.basename(ms.rstrip('/'))), size, reserved])
+
+        def copy(c):
+            ms, local, size, reserved = c
+            logger.debug('Stage: %s -> %s' % (ms, local))
+            if os.path.exists(local): shutil.rmtree(local)
+            shutil.copytree(ms, local, symlinks=True)
+            return self.snapshot(local)
+
+        pool = ThreadPool(self.ncpu)
+        snapshots = pool.map(copy, to_copy, chunksize=1)
+        pool.close()
+        for (ms, local, size, reserved), snapshot in zip(to_copy, snapshots):
+            self.staged[ms] = [local, size, snapshot, reserved]
+
+        return [self.staged[ms][0] if ms in self.staged else ms for ms in mss]
+
+    def sync(self, mss=None):
+        """
+        Copy back the files changed in the local copies (e.g. new or modified columns, new subtables)
+        and remove the ones removed locally
+        mss : list of MSs to sync (default: all)
+        """
+        import shutil
+        from multiprocessing.pool import ThreadPool
+        if mss is None: mss = self.staged.keys()
+
+        def sync(ms):
+            local, size, old, reserved = self.staged[ms]
+            new = self.snapshot(local)
+            changed = [f for f in new if old.get(f) != new[f]]
+            removed = [f for f in old if not f in new]
+            for f in changed:
+                dst = os.path.join(ms, f)
+                if not os.path.isdir(os.path.dirname(dst)): os.makedirs(os.path.dirname(dst))
+                shutil.copy2(os.path.join(local, f), dst+'.tmp')
+                os.rename(dst+'.tmp', dst) # a crash never leaves a half-written file
+            for f in removed:
+                if os.path.lexists(os.path.join(ms, f)): os.remove(os.path.join(ms, f))
+            # dirs removed locally (e.g. old instrument tables)
+            for root, dirs, fs in os.walk(ms, topdown=False):
+                if not os.path.isdir(os.path.join(local, os.path.relpath(root, ms))) and os.listdir(root) == []: os.rmdir(root)
+            logger.debug('Sync: %s -> %s (%i files changed, %i removed)' % (local, ms, len(changed), len(removed)))
+            return new
+
+        pool = ThreadPool(self.ncpu)
+        snapshots = pool.map(sync, mss, chunksize=1)
+        pool.close()
+        for ms, snapshot in zip(mss, snapshots):
+            self.staged[ms][1] = sum([v[0] for v in snapshot.values()])
+            self.staged[ms][2] = snapshot
+
+    def evict(self, ms):
+        """
+        Sync back and remove the local copy of an MS
+        """
+        import shutil
+        self.sync([ms])
+        logger.debug('Unstage: '+ms)
+        shutil.rmtree(self.staged.pop(ms)[0])
+
+    def clean(self):
+        """
+        Sync back all MSs and remove the scratch dir
+        """
+        import shutil
+        self.sync()
+        self.staged.clear()
+        shutil.rmtree(self.dir)
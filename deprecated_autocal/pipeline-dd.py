@@ -3,6 +3,8 @@
 
 parset_dir = '/home/fdg/scripts/autocal/parset_dd'
 maxniter = 10 # max iteration if not converged
+conv_threshold = 0.05 # converged when noise and dynamic range improve less than this
+scratch = None # node-local dir (e.g. '/dev/shm') where the per-MS steps run, None to work in place
 
 ##########################################################################################
 
@@ -15,7 +17,7 @@ import lsmtool
 
 logger = set_logger('pipeline-dd.logger')
 check_rm('logs')
-s = Scheduler(dry=False)
+s = Scheduler(dry=False, cache='pipeline-dd.cache')
 mss = sorted(glob.glob('mss/TC*[0-9].MS'))
 phasecentre = get_phase_centre(mss[0])
 check_rm('ddcal')
@@ -59,7 +61,7 @@ def clean(c, mss, size=2.):
             -scale '+str(pixscale)+'arcsec -weight briggs 0. -niter 100000 -no-update-model-required -mgain 0.9 -pol I \
             -joinchannels -fit-spectral-pol 2 -channelsout 10 \
             -auto-threshold 20 -minuv-l 30 '+' '.join(mss), \
-            log='wsclean-c'+str(c)+'.log', cmd_type='wsclean', processors='max')
+            log='wsclean-c'+str(c)+'.log', cmd_type='wsclean', processors='max', inputs=mss)
     s.run(check=True)
 
     # make mask
@@ -76,7 +78,7 @@ def clean(c, mss, size=2.):
             -scale '+str(pixscale)+'arcsec -weight briggs 0. -niter 1000000 -no-update-model-required -mgain 0.8 -pol I \
             -joinchannels -fit-spectral-pol 2 -channelsout 10 \
             -auto-threshold 0.1 -save-source-list -minuv-l 30 -fitsmask '+im.maskname+' '+' '.join(mss), \
-            log='wscleanM-c'+str(c)+'.log', cmd_type='wsclean', processors='max')
+            log='wscleanM-c'+str(c)+'.log', cmd_type='wsclean', processors='max', inputs=mss)
     s.run(check=True)
     os.system('cat logs/wscleanM-c'+str(c)+'.log | grep "background noise"')
 
@@ -87,26 +89,35 @@ def clean(c, mss, size=2.):
 logger.info('Copy data...')
 for ms in mss:
     msout = ms.replace('.MS','-cp.MS')
-    if os.path.exists(msout): continue
     s.add('NDPPP '+parset_dir+'/NDPPP-avg.parset msin='+ms+' msout='+msout+' msin.datacolumn=CORRECTED_DATA avg.freqstep=1 avg.timestep=1', \
-                log=msout.split('/')[-1]+'_cp.log', cmd_type='NDPPP')
+                log=msout.split('/')[-1]+'_cp.log', cmd_type='NDPPP', inputs=[ms], outputs=[msout])
 s.run(check=True)
 mss = sorted(glob.glob('mss/TC*-cp.MS'))
        
+if scratch is not None:
+    stage = ScratchStage(scratch)
+    mss_run = stage.get(mss, ncols=3) # CORRECTED_DATA, SUBTRACTED_DATA and SMOOTHED_DATA are added
+else:
+    mss_run = mss
+
 logger.info('Add columns...')
-for ms in mss:
-    s.add('addcol2ms.py -m '+ms+' -c CORRECTED_DATA,SUBTRACTED_DATA', log=ms+'_addcol.log', cmd_type='python')
+for ms, ms_run in zip(mss, mss_run):
+    s.add('addcol2ms.py -m '+ms_run+' -c CORRECTED_DATA,SUBTRACTED_DATA', log=ms+'_addcol.log', cmd_type='python')
 s.run(check=True)
 
 ###############################################################
 logger.info('BL-based smoothing...')
-for ms in mss:
-    s.add('BLsmooth.py -f 1.0 -r -i DATA -o SMOOTHED_DATA '+ms, log=ms+'_smooth.log', cmd_type='python')
+for ms, ms_run in zip(mss, mss_run):
+    s.add('BLsmooth.py -f 1.0 -r -i DATA -o SMOOTHED_DATA '+ms_run, log=ms+'_smooth.log', cmd_type='python')
 s.run(check=True, max_threads=6)
 
+if scratch is not None:
+    logger.info('Sync back staged MSs...')
+    stage.clean()
+
 mosaic_image = Image(sorted(glob.glob('self/images/wide*-[0-9]-MFS-image.fits'))[-1], user_mask = user_mask)
 mosaic_image.select_cc()
-rms_noise_pre = np.inf
+tracker = ConvergenceTracker('DD-cal', threshold=conv_threshold, logfile='ddcal/convergence.json')
 
 for c in xrange(maxniter):
     logger.info('Starting cycle: %i' % c)
@@ -139,23 +150,24 @@ for c in xrange(maxniter):
     # create regions (using cluster directions)
     make_voronoi_reg(directions_clusters, mosaic_image.imagename, outdir='ddcal/regions/', beam_reg='', png='ddcal/skymodels/voronoi%02i.png' % c)
 
+    # outputs are removed by the scheduler if not already done with the same skymodel (see cache)
     skymodel_cl_skydb = skymodel_cl.replace('.txt','.skydb')
-    check_rm(skymodel_cl_skydb)
-    s.add('run_env.sh makesourcedb outtype="blob" format="<" in="%s" out="%s"' % (skymodel_cl, skymodel_cl_skydb), log='makesourcedb_cl.log', cmd_type='general' )
+    s.add('run_env.sh makesourcedb outtype="blob" format="<" in="%s" out="%s"' % (skymodel_cl, skymodel_cl_skydb), log='makesourcedb_cl.log', cmd_type='general', \
+            inputs=[skymodel_cl], outputs=[skymodel_cl_skydb])
     s.run(check=True)
 
     skymodel_voro_skydb = skymodel_voro.replace('.txt','.skydb')
-    check_rm(skymodel_voro_skydb)
-    s.add('run_env.sh makesourcedb outtype="blob" format="<" in="%s" out="%s"' % (skymodel_voro, skymodel_voro_skydb), log='makesourcedb_voro.log', cmd_type='general')
+    s.add('run_env.sh makesourcedb outtype="blob" format="<" in="%s" out="%s"' % (skymodel_voro, skymodel_voro_skydb), log='makesourcedb_voro.log', cmd_type='general', \
+            inputs=[skymodel_voro], outputs=[skymodel_voro_skydb])
     s.run(check=True)
 
     ################################################################
     # Calibration
     logger.info('Calibrating...')
+    # solutions depend on the DATA column, never changed here, and on the skymodel: skipped if already done (see cache)
     for ms in mss:
-        check_rm(ms+'/cal-c'+str(c)+'.h5')
         s.add('run_env.sh NDPPP '+parset_dir+'/NDPPP-solDD.parset msin='+ms+' ddecal.h5parm='+ms+'/cal-c'+str(c)+'.h5 ddecal.sourcedb='+skymodel_cl_skydb, \
-                log=ms+'_solDD-c'+str(c)+'.log', cmd_type='NDPPP')
+                log=ms+'_solDD-c'+str(c)+'.log', cmd_type='NDPPP', inputs=[skymodel_cl], outputs=[ms+'/cal-c'+str(c)+'.h5'])
     s.run(check=True)
 
     # Plot solutions
@@ -167,33 +179,20 @@ for c in xrange(maxniter):
         os.system('mv plots ddcal/plots/plots-c'+str(c)+'-t'+str(i))
 
     ############################################################
-    # Empty the dataset
-    logger.info('Set SUBTRACTED_DATA = DATA...')
-    for ms in mss:
-        s.add('taql "update '+ms+' set SUBTRACTED_DATA = DATA"', log=ms+'_taql1-c'+str(c)+'.log', cmd_type='general')
-    s.run(check=True)
-
-    logger.info('Subtraction...')
+    # Subtract all directions in one pass - ms:DATA - sum(corrupted ms:MODEL_DATA_Dir*) -> ms:SUBTRACTED_DATA
     for i, p in enumerate(patches):
-        # predict - ms:MODEL_DATA
+        # predict - ms:MODEL_DATA_p
         logger.info('Patch '+p+': predict...')
-        #pre.applycal.h5parm='+ms+'/cal-c'+str(c)+'.h5 pre.applycal.direction='+p, \
         for ms in mss:
-            s.add('run_env.sh NDPPP '+parset_dir+'/NDPPP-predict.parset msin='+ms+' pre.sourcedb='+skymodel_voro_skydb+' pre.sources='+p, \
+            s.add('run_env.sh NDPPP '+parset_dir+'/NDPPP-predict.parset msin='+ms+' msout.datacolumn=MODEL_DATA_'+p+' pre.sourcedb='+skymodel_voro_skydb+' pre.sources='+p, \
                    log=ms+'_pre1-c'+str(c)+'-p'+str(p)+'.log', cmd_type='NDPPP')
         s.run(check=True)
 
-        # corrupt - ms:MODEL_DATA -> ms:MODEL_DATA
-        logger.info('Patch '+p+': corrupt...')
-        for ms in mss:
-            s.add('run_env.sh NDPPP '+parset_dir+'/NDPPP-corrupt.parset msin='+ms+' cor1.parmdb='+ms+'/cal-c'+str(c)+'.h5 cor1.direction=['+p+'] cor2.parmdb='+ms+'/cal-c'+str(c)+'.h5 cor2.direction=['+p+']', \
-                 log=ms+'_corrupt1-c'+str(c)+'-p'+str(p)+'.log', cmd_type='NDPPP')
-        s.run(check=True)
-
-        logger.info('Patch '+p+': subtract...')
-        for ms in mss:
-            s.add('taql "update '+ms+' set SUBTRACTED_DATA = SUBTRACTED_DATA - MODEL_DATA"', log=ms+'_taql2-c'+str(c)+'-p'+str(p)+'.log', cmd_type='general')
-        s.run(check=True)
+    logger.info('Subtraction (corrupt and subtract all patches)...')
+    for ms in mss:
+        s.add('ddsub.py -i DATA -o SUBTRACTED_DATA -c '+','.join(['MODEL_DATA_'+p for p in patches])+' -d '+','.join(patches)+' -p '+ms+'/cal-c'+str(c)+'.h5 '+ms, \
+                log=ms+'_ddsub-c'+str(c)+'.log', cmd_type='python')
+    s.run(check=True)
 
     ##############################################################
     # Imaging
@@ -208,24 +207,16 @@ for c in xrange(maxniter):
     #s.run(check=True)
 
     for i, p in enumerate(patches):
-        # predict - ms:MODEL_DATA
-        logger.info('Patch '+p+': predict...')
-        #pre.applycal.h5parm='+ms+'/cal-c'+str(c)+'.h5 pre.applycal.direction='+p, \
-        for ms in mss:
-            s.add('run_env.sh NDPPP '+parset_dir+'/NDPPP-predict.parset msin='+ms+' pre.sourcedb='+skymodel_voro_skydb+' pre.sources='+p, \
-                   log=ms+'_pre2-c'+str(c)+'-p'+str(p)+'.log', cmd_type='NDPPP')
-        s.run(check=True)
-
-        # corrupt - ms:MODEL_DATA -> ms:MODEL_DATA
-        logger.info('Patch '+p+': corrupt...')
+        # add back (re-use the predicted ms:MODEL_DATA_p) - ms:SUBTRACTED_DATA + corrupted ms:MODEL_DATA_p -> ms:CORRECTED_DATA
+        logger.info('Patch '+p+': corrupt and add...')
         for ms in mss:
-            s.add('run_env.sh NDPPP '+parset_dir+'/NDPPP-corrupt.parset msin='+ms+' cor1.parmdb='+ms+'/cal-c'+str(c)+'.h5 cor1.direction=['+p+'] cor2.parmdb='+ms+'/cal-c'+str(c)+'.h5 cor2.direction=['+p+']', \
-                 log=ms+'_corrupt2-c'+str(c)+'-p'+str(p)+'.log', cmd_type='NDPPP')
+            s.add('ddsub.py -a -i SUBTRACTED_DATA -o CORRECTED_DATA -c MODEL_DATA_'+p+' -d '+p+' -p '+ms+'/cal-c'+str(c)+'.h5 '+ms, \
+                log=ms+'_ddadd-c'+str(c)+'-p'+str(p)+'.log', cmd_type='python')
         s.run(check=True)
 
-        logger.info('Patch '+p+': add...')
+        # the predicted column is not used anymore, patches change at every cycle: remove it to free the disk
         for ms in mss:
-            s.add('taql "update '+ms+' set CORRECTED_DATA = SUBTRACTED_DATA + MODEL_DATA"', log=ms+'_taql2-c'+str(c)+'-p'+str(p)+'.log', cmd_type='general')
+            s.add('taql "ALTER TABLE '+ms+' DELETE COLUMN MODEL_DATA_'+p+'"', log=ms+'_ddadd-c'+str(c)+'-p'+str(p)+'.log', cmd_type='general', log_append=True)
         s.run(check=True)
 
         ### TEST
@@ -256,7 +247,7 @@ for c in xrange(maxniter):
             msout = 'mss_dd/'+os.path.basename(ms)
             phasecentre = directions_shifts[p]
             s.add('NDPPP '+parset_dir+'/NDPPP-shiftavg.parset msin='+ms+' msout='+msout+' shift.phasecenter=['+str(phasecentre[0].degree)+'deg,'+str(phasecentre[1].degree)+'deg\]', \
-                log=ms+'_shift-c'+str(c)+'-p'+str(p)+'.log', cmd_type='NDPPP')
+                log=ms+'_shift-c'+str(c)+'-p'+str(p)+'.log', cmd_type='NDPPP', temp=[[msout, 2, None]]) # removed after the 2 cleans
         s.run(check=True)
 
         logger.info('Patch '+p+': imaging...')
@@ -298,8 +289,7 @@ for c in xrange(maxniter):
     os.system('cp img/*M*MFS-image.fits img/mos-MFS-image.fits img/mos-MFS-residual.fits ddcal/images/c'+str(c))
     mosaic_image = Image('ddcal/images/c'+str(c)+'/mos-MFS-image.fits', user_mask = user_mask)
 
-    # get noise, if larger than 95% of prev cycle: break
-    rms_noise = get_noise_img(mosaic_residual)
-    logger.info('RMS noise: %f' % rms_noise)
-    if rms_noise > 0.95 * rms_noise_pre: break
-    rms_noise_pre = rms_noise
+    # get noise and dynamic range, break if they do not improve
+    if tracker.add(c, mosaic_imagename, mosaic_residual):
+        logger.info('DD-calibration converged at cycle %i.' % c)
+        break
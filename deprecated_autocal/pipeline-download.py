@@ -3,6 +3,7 @@
 
 fix_tables = True
 rename = True
+download_threads = 8 # simultaneous downloads
 parset_dir = '/home/fdg/scripts/autocal/parset_download'
 
 ###################################################
@@ -25,11 +26,6 @@ def nu2num(nu):
     nu_clk = 200. # 160 or 200 MHz, clock freq
     n = 1 # nyquist zone (1 for LBA, 2 for HBA low, 3 for HBA mid-high)
 
-    if nu_clk == 200:
-        SBband = 195312.5/1e6
-    elif nu_clk == 160:
-        SBband = 156250.0/1e6
-
     return np.int(np.floor((1024./nu_clk) * (nu - (n-1) * nu_clk/2.)))
 
 def getName(ms):
@@ -77,14 +73,24 @@ if download_file is not None:
             with open('renamed.txt','r') as flog:
                 downloaded += [line.rstrip('\n') for line in flog]
 
+        downloads = []
         for i, line in enumerate(df):
-            ms = re.findall(r'L[0-9]*.*_SB[0-9]*_uv', line)[0]
+            # url [adler32 checksum]
+            fields = line.split()
+            if fields == []: continue
+            url = fields[0]
+            adler32 = fields[1] if len(fields) > 1 else None
+            ms = re.findall(r'L[0-9]*.*_SB[0-9]*_uv', url)[0]
             if ms+'.MS' in downloaded or ms+'.dppp.MS' in downloaded: continue
             if ms+'.MS' in glob.glob('*MS') or ms+'.dppp.MS' in glob.glob('*MS'): continue
-            s.add('wget -nv "'+line[:-1]+'" -O - | tar -x', log=ms+'_download.log', cmd_type='general')
-        #    print 'wget -nv "'+line[:-1]+'" -O - | tar -x'
-            logger.debug('Queue download of: '+line[:-1])
-        s.run(check=True, max_threads=4)
+            logger.debug('Queue download of: '+url)
+            downloads.append([url, ms+'.tar.part', adler32, None])
+
+        failed = download_all(downloads, max_conn=download_threads)
+        if failed != []:
+            for url in failed: logger.error('Download failed: '+url)
+            logger.error('%i downloads failed, re-run to resume them.' % len(failed))
+            sys.exit(1)
 
 mss = sorted(glob.glob('*MS'))
 if len(mss) == 0:
@@ -100,8 +106,8 @@ if fix_tables:
     # only ms created in range (2/2013->2/2014)
     with pt.table(mss[0]+'/OBSERVATION', readonly=True, ack=False) as obs:
         t = Time(obs.getcell('TIME_RANGE',0)[0]/(24*3600.), format='mjd')
-        time = np.int(t.iso.replace('-','')[0:8])
-    if time > 20130200 and time < 20140300:
+        obsdate = np.int(t.iso.replace('-','')[0:8])
+    if obsdate > 20130200 and obsdate < 20140300:
         logger.info('Fix beam table...')
         for ms in mss:
             s.add('/home/fdg/scripts/fixinfo/fixbeaminfo '+ms, log=ms+'_fixbeam.log')
@@ -22,6 +22,7 @@ import lsmtool
 parset_dir = '/home/fdg/scripts/autocal/parset_self/'
 skymodel = '/home/fdg/scripts/model/calib-simple.skymodel'
 niter = 3
+conv_threshold = 0.05 # stop cycling when noise and dynamic range improve less than this (None: always niter cycles)
 user_mask = None
 cc_predict = True
 
@@ -132,11 +133,36 @@ def ft_model_cc(mss, imagename, c, user_mask = None, keep_in_beam=True, model_co
     s.run(check=True)
 
 
+def clean_beam(c):
+    """
+    Beam-corrected and deeper images, done at the last cycle
+    """
+    # beam corrected: -use-differential-lofar-beam' - no baseline avg!
+    logger.info('Cleaning beam (cycle: '+str(c)+')...')
+    imagename = 'img/wideBeam'
+    s.add('wsclean -reorder -name ' + imagename + ' -size 4000 4000 -trim 3500 3500 -mem 90 -j '+str(s.max_processors)+' \
+            -scale 8arcsec -weight briggs 0.0 -auto-mask 10 -auto-threshold 1 -niter 100000 -no-update-model-required -mgain 0.8 \
+            -multiscale -multiscale-scale-bias 0.5 -multiscale-scales 0,3,9 \
+            -pol I -joinchannels -fit-spectral-pol 2 -channelsout 10 -apply-primary-beam -use-differential-lofar-beam -minuv-l 30 '+' '.join(mss), \
+            log='wscleanBeam-c'+str(c)+'.log', cmd_type='wsclean', processors='max')
+    s.run(check=True)
+
+    logger.info('Cleaning beam high-res (cycle: '+str(c)+')...')
+    imagename = 'img/wideBeamHR'
+    s.add('wsclean -reorder -name ' + imagename + ' -size 6000 6000 -trim 5500 5500 -mem 90 -j '+str(s.max_processors)+' \
+            -scale 4arcsec -weight briggs -1.5 -auto-mask 10 -auto-threshold 1 -niter 100000 -no-update-model-required -mgain 0.8 \
+            -multiscale -multiscale-scale-bias 0.5 -multiscale-scales 0,3,9 \
+            -pol I -joinchannels -fit-spectral-pol 2 -channelsout 10 -apply-primary-beam -use-differential-lofar-beam -minuv-l 30 '+' '.join(mss), \
+            log='wscleanBeamHR-c'+str(c)+'.log', cmd_type='wsclean', processors='max')
+    s.run(check=True)
+
+
 #############################################################################
 
 logger = set_logger('pipeline-self.logger')
 check_rm('logs')
-s = Scheduler(dry=False)
+# the per-MS chains below keep the thread limits that the single steps had
+s = Scheduler(dry=False, concurrency={'mslin2circ.py': 4, 'BLsmooth.py': 6})
 
 ##################################################
 # Clear
@@ -195,6 +221,7 @@ s.run(check=True)
 
 #####################################################################################################
 # Self-cal cycle
+tracker = ConvergenceTracker('Self-cal', threshold=conv_threshold, logfile='self/convergence.json')
 for c in xrange(niter):
 
     logger.info('Start selfcal cycle: '+str(c))
@@ -243,25 +270,18 @@ for c in xrange(niter):
     # Cross-delay + Faraday rotation correction
     if c >= 1:
 
+        # each MS goes through its chain as soon as its own previous step is done (see deps)
         # To circular - SB.MS:CORRECTED_DATA -> SB.MS:CORRECTED_DATA (circular)
         # TODO: check -w, is it ok?
-        logger.info('Convert to circular...')
-        for ms in mss:
-            s.add('/home/fdg/scripts/mslin2circ.py -i '+ms+':CORRECTED_DATA -o '+ms+':CORRECTED_DATA', log=ms+'_circ2lin-c'+str(c)+'.log', cmd_type='python')
-        s.run(check=True, max_threads=4)
- 
         # Smooth CORRECTED_DATA -> SMOOTHED_DATA
-        logger.info('BL-based smoothing...')
-        for ms in mss:
-            s.add('BLsmooth.py -r -f 0.5 -i CORRECTED_DATA -o SMOOTHED_DATA '+ms, log=ms+'_smooth2-c'+str(c)+'.log', cmd_type='python')
-        s.run(check=True, max_threads=6)
-
         # Solve G SB.MS:SMOOTHED_DATA (only solve)
-        logger.info('Solving G...')
+        logger.info('Convert to circular, BL-based smoothing and solving G...')
         for ms in mss:
+            circ = s.add('/home/fdg/scripts/mslin2circ.py -i '+ms+':CORRECTED_DATA -o '+ms+':CORRECTED_DATA', log=ms+'_circ2lin-c'+str(c)+'.log', cmd_type='python')
+            smooth = s.add('BLsmooth.py -r -f 0.5 -i CORRECTED_DATA -o SMOOTHED_DATA '+ms, log=ms+'_smooth2-c'+str(c)+'.log', cmd_type='python', deps=[circ])
             check_rm(ms+'/instrument-g')
             s.add('NDPPP '+parset_dir+'/NDPPP-solG.parset msin='+ms+' sol.parmdb='+ms+'/instrument-g sol.solint=30 sol.nchan=8', \
-                    log=ms+'_sol-g1-c'+str(c)+'.log', cmd_type='NDPPP')
+                    log=ms+'_sol-g1-c'+str(c)+'.log', cmd_type='NDPPP', deps=[smooth])
         s.run(check=True)
 
         if multiepoch:
@@ -275,29 +295,18 @@ for c in xrange(niter):
         os.system('mv cal-fr'+str(c)+'*.h5 self/solutions/')
        
         # To linear - SB.MS:CORRECTED_DATA -> SB.MS:CORRECTED_DATA (linear)
-        logger.info('Convert to linear...')
-        for ms in mss:
-            s.add('/home/fdg/scripts/mslin2circ.py -r -i '+ms+':CORRECTED_DATA -o '+ms+':CORRECTED_DATA', log=ms+'_circ2lin-c'+str(c)+'.log', cmd_type='python')
-        s.run(check=True, max_threads=4)
-        
         # Correct FR SB.MS:CORRECTED_DATA->CORRECTED_DATA
-        logger.info('Faraday rotation correction...')
-        for ms in mss:
-            s.add('NDPPP '+parset_dir+'/NDPPP-cor.parset msin='+ms+' cor.parmdb='+ms+'/instrument-fr cor.correction=RotationMeasure', log=ms+'_corFR-c'+str(c)+'.log', cmd_type='NDPPP')
-        s.run(check=True)
-
         # Smooth CORRECTED_DATA -> SMOOTHED_DATA
-        logger.info('BL-based smoothing...')
-        for ms in mss:
-            s.add('BLsmooth.py -r -f 0.5 -i CORRECTED_DATA -o SMOOTHED_DATA '+ms, log=ms+'_smooth3-c'+str(c)+'.log', cmd_type='python')
-        s.run(check=True, max_threads=6)
-
         # Solve G SB.MS:SMOOTHED_DATA (only solve)
-        logger.info('Solving G...')
+        logger.info('Convert to linear, Faraday rotation correction, BL-based smoothing and solving G...')
         for ms in mss:
+            lin = s.add('/home/fdg/scripts/mslin2circ.py -r -i '+ms+':CORRECTED_DATA -o '+ms+':CORRECTED_DATA', log=ms+'_circ2lin-c'+str(c)+'.log', cmd_type='python')
+            corfr = s.add('NDPPP '+parset_dir+'/NDPPP-cor.parset msin='+ms+' cor.parmdb='+ms+'/instrument-fr cor.correction=RotationMeasure', \
+                    log=ms+'_corFR-c'+str(c)+'.log', cmd_type='NDPPP', deps=[lin])
+            smooth = s.add('BLsmooth.py -r -f 0.5 -i CORRECTED_DATA -o SMOOTHED_DATA '+ms, log=ms+'_smooth3-c'+str(c)+'.log', cmd_type='python', deps=[corfr])
             check_rm(ms+'/instrument-g')
             s.add('NDPPP '+parset_dir+'/NDPPP-solG.parset msin='+ms+' sol.parmdb='+ms+'/instrument-g sol.solint=30 sol.nchan=8', \
-                    log=ms+'_sol-g2-c'+str(c)+'.log', cmd_type='NDPPP')
+                    log=ms+'_sol-g2-c'+str(c)+'.log', cmd_type='NDPPP', deps=[smooth])
         s.run(check=True)
 
         if multiepoch:
@@ -371,25 +380,7 @@ for c in xrange(niter):
     # clen on concat.MS:CORRECTED_DATA (FR/TEC corrected, beam corrected)
 
     # do beam-corrected+deeper image at last cycle
-    if c == niter-1:
-        # beam corrected: -use-differential-lofar-beam' - no baseline avg!
-        logger.info('Cleaning beam (cycle: '+str(c)+')...')
-        imagename = 'img/wideBeam'
-        s.add('wsclean -reorder -name ' + imagename + ' -size 4000 4000 -trim 3500 3500 -mem 90 -j '+str(s.max_processors)+' \
-                -scale 8arcsec -weight briggs 0.0 -auto-mask 10 -auto-threshold 1 -niter 100000 -no-update-model-required -mgain 0.8 \
-                -multiscale -multiscale-scale-bias 0.5 -multiscale-scales 0,3,9 \
-                -pol I -joinchannels -fit-spectral-pol 2 -channelsout 10 -apply-primary-beam -use-differential-lofar-beam -minuv-l 30 '+' '.join(mss), \
-                log='wscleanBeam-c'+str(c)+'.log', cmd_type='wsclean', processors='max')
-        s.run(check=True)
-
-        logger.info('Cleaning beam high-res (cycle: '+str(c)+')...')
-        imagename = 'img/wideBeamHR'
-        s.add('wsclean -reorder -name ' + imagename + ' -size 6000 6000 -trim 5500 5500 -mem 90 -j '+str(s.max_processors)+' \
-                -scale 4arcsec -weight briggs -1.5 -auto-mask 10 -auto-threshold 1 -niter 100000 -no-update-model-required -mgain 0.8 \
-                -multiscale -multiscale-scale-bias 0.5 -multiscale-scales 0,3,9 \
-                -pol I -joinchannels -fit-spectral-pol 2 -channelsout 10 -apply-primary-beam -use-differential-lofar-beam -minuv-l 30 '+' '.join(mss), \
-                log='wscleanBeamHR-c'+str(c)+'.log', cmd_type='wsclean', processors='max')
-        s.run(check=True)
+    if c == niter-1: clean_beam(c)
 
     # clean mask clean (cut at 5k lambda)
     # no MODEL_DATA update with -baseline-averaging
@@ -426,6 +417,13 @@ for c in xrange(niter):
     s.run(check=True)
     os.system('cat logs/wscleanM-c'+str(c)+'.log | grep "background noise"')
 
+    # every cycle is measured (c=0 is the reference), convergence can stop any cycle before the last
+    if conv_threshold is not None and c != niter-1 and \
+            tracker.add(c, imagename+'-MFS-image.fits', imagename+'-MFS-residual.fits'):
+        logger.info('Self-calibration converged at cycle %i, skipping cycles %i-%i.' % (c, c+1, niter-1))
+        clean_beam(c)
+        break
+
     if c > 0 and c != niter:
         if cc_predict:
             ft_model_cc(mss, imagename, c, user_mask=user_mask, keep_in_beam=True, model_column='MODEL_DATA')
@@ -495,8 +493,9 @@ for c in xrange(niter):
 os.system('~/opt/src/makeavgpb/build/wsbeam.py img/wideBeam')
 
 # Copy images
-[ os.system('mv img/wideM-'+str(c)+'-MFS-image.fits self/images') for c in xrange(niter) ]
-if cc_predict: [ os.system('mv img/wideM-'+str(c)+'-sources.txt self/images') for c in xrange(niter) ]
+ncycles = c+1 # cycles done
+[ os.system('mv img/wideM-'+str(c)+'-MFS-image.fits self/images') for c in xrange(ncycles) ]
+if cc_predict: [ os.system('mv img/wideM-'+str(c)+'-sources.txt self/images') for c in xrange(ncycles) ]
 os.system('mv img/wide-lr-MFS-image.fits self/images')
 os.system('mv img/wideBeam-MFS-image.fits  img/wideBeam-MFS-image-pb.fits self/images')
 os.system('mv img/wideBeamHR-MFS-image.fits  img/wideBeamHR-MFS-image-pb.fits self/images')
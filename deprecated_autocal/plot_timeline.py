@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 - Francesco de Gasperin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Usage: plot_timeline.py [-o timeline.png] logs/timeline-20180101-120000.json
+# Summarise where the wall time of a pipeline run goes, from the timeline
+# written by the Scheduler: time and resources per step, the critical path
+# of every batch (s.run() call) and a plot of all the jobs in time.
+
+import os, sys
+import optparse
+import logging
+import json
+logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+
+
+def step_name(cmd):
+    """
+    Name of the step: the executable, or the script for python/casa
+    """
+    tokens = cmd.replace(';', ' ').split()
+    if tokens == []: return '?'
+    name = os.path.basename(tokens[0])
+    if name in ['python', 'casa', 'cd'] or name.startswith('python'):
+        for t in tokens[1:]:
+            if t.endswith('.py'): return os.path.basename(t)
+    return name
+
+
+def critical_path(jobs):
+    """
+    Chain of jobs that determined the end of a batch: start from the last job to end
+    and go back through the dependency that ended last
+    Return the list of jobs in order of execution
+    """
+    ended = [j for j in jobs if j['t_end'] is not None]
+    if ended == []: return []
+    byid = dict((j['id'], j) for j in jobs)
+    path = [max(ended, key=lambda j: j['t_end'])]
+    while path[-1]['deps'] != []:
+        path.append(max([byid[d] for d in path[-1]['deps']], key=lambda j: j['t_end']))
+    return path[::-1]
+
+
+def hms(t):
+    return '%i:%02i:%02i' % (t//3600, (t%3600)//60, t%60)
+
+
+opt = optparse.OptionParser(usage="%prog [options] timeline.json", version="%prog 0.1")
+opt.add_option('-o', '--output', help='Output plot [default: timeline.png]', type='string', default='timeline.png')
+opt.add_option('-n', '--nsteps', help='Number of steps in the summary [default: 20]', type='int', default=20)
+(options, args) = opt.parse_args()
+
+if len(args) != 1:
+    opt.print_help()
+    sys.exit(0)
+if not os.path.exists(args[0]):
+    logging.error("Cannot find timeline file.")
+    sys.exit(1)
+
+with open(args[0]) as f:
+    jobs = [json.loads(l) for l in f if l.strip() != '']
+run = [j for j in jobs if j['t_start'] is not None and not j['cached']]
+if run == []:
+    logging.error("No job run in this timeline.")
+    sys.exit(1)
+for j in jobs: j['step'] = step_name(j['cmd'])
+
+t0 = min(j['t_submit'] for j in jobs)
+t1 = max(j['t_end'] for j in run)
+logging.info('Wall time: %s - %i jobs run, %i cached, %i failed, %i aborted' % (hms(t1-t0), len(run), \
+        sum(j['cached'] for j in jobs), sum(j['status'] == 'failed' for j in jobs), sum(j['status'] == 'aborted' for j in jobs)))
+
+# per step summary, sorted by total time
+logging.info('%-25s %5s %10s %10s %10s %9s %9s %9s' % ('step', 'jobs', 'wall', 'queue', 'cpu', 'rss[GB]', 'read[GB]', 'write[GB]'))
+steps = {}
+for j in run: steps.setdefault(j['step'], []).append(j)
+for step, sj in sorted(steps.items(), key=lambda x: -sum(j['t_end']-j['t_start'] for j in x[1]))[:options.nsteps]:
+    wall = sum(j['t_end']-j['t_start'] for j in sj)
+    queue = sum(j['t_start']-j['t_ready'] for j in sj)
+    cpu = sum((j['cpu_user'] or 0)+(j['cpu_sys'] or 0) for j in sj)
+    rss = max(j['maxrss'] or 0 for j in sj)/1024.
+    read = sum(j['read'] or 0 for j in sj)/1024.**3
+    write = sum(j['write'] or 0 for j in sj)/1024.**3
+    logging.info('%-25s %5i %10s %10s %10s %9.2f %9.2f %9.2f' % (step[:25], len(sj), hms(wall), hms(queue), hms(cpu), rss, read, write))
+
+# critical path of each batch, batches run one after the other
+logging.info('Critical path:')
+batches = sorted(set(j['batch'] for j in jobs))
+on_path = []
+t_sched = 0; t_prev = t0
+for b in batches:
+    bj = [j for j in jobs if j['batch'] == b]
+    path = critical_path(bj)
+    if path == []: continue
+    t_sub = bj[0]['t_submit']; t_end = path[-1]['t_end']
+    t_sched += t_end - t_sub
+    if t_sub - t_prev > 1: logging.info('  %s outside the scheduler' % hms(t_sub-t_prev))
+    t_prev = t_end
+    for j in path:
+        on_path.append((j['batch'], j['id']))
+        logging.info('  [%i] %s: run %s, queued %s - %s' % (b, j['step'], hms(j['t_end']-j['t_start']), \
+                hms(j['t_start']-j['t_ready']), j['cmd'][:80]))
+logging.info('Time in scheduler batches: %s (%.0f%% of wall time)' % (hms(t_sched), 100.*t_sched/(t1-t0)))
+
+# plot: one bar per job, jobs packed in lanes
+import matplotlib as mpl
+mpl.use("Agg")
+import matplotlib.pyplot as plt
+
+run.sort(key=lambda j: j['t_start'])
+lanes = [] # end time of the last job in each lane
+names = sorted(steps.keys())
+colors = [plt.cm.tab20(i/float(max(len(names)-1, 1))) for i in range(len(names))]
+fig = plt.figure(figsize=(12, 6))
+ax = fig.add_subplot(111)
+for j in run:
+    lane = [l for l, t in enumerate(lanes) if t <= j['t_start']]
+    if lane == []:
+        lanes.append(0); lane = len(lanes)-1
+    else: lane = lane[0]
+    lanes[lane] = j['t_end']
+    crit = (j['batch'], j['id']) in on_path
+    ax.barh(lane, (j['t_end']-j['t_start'])/60., left=(j['t_start']-t0)/60., height=0.8, \
+            color=colors[names.index(j['step'])], edgecolor='r' if crit else 'none', linewidth=1.5)
+for i, name in enumerate(names):
+    ax.barh(0, 0, color=colors[i], label=name)
+ax.set_xlabel('Time [min]')
+ax.set_ylabel('Parallel jobs')
+ax.set_title('%s (critical path in red)' % os.path.basename(args[0]))
+ax.legend(loc='upper right', fontsize='small', ncol=2)
+fig.savefig(options.output, bbox_inches='tight')
+logging.info('Plot saved in %s.' % options.output)
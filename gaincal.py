@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 - Francesco de Gasperin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Usage: gaincal.py -s 30 -n 8 -m diagonal -o cal.h5 vis.MS
+# Solve antenna-based gains comparing a data column with a model column.
+# The MS is read in chunks of one solution interval in time and every chunk
+# is solved independently (in parallel) with a StEFCal-like alternating
+# least-squares iteration: V_pq = g_p M_pq g_q^*
+# Solutions are written in an H5parm (amplitude000, phase000).
+
+import os, sys
+import optparse
+import logging
+import numpy as np
+import pyrap.tables as pt
+from lib_multiproc import multiprocManager
+logging.basicConfig(level=logging.DEBUG)
+
+
+def stefcal(vis, mod, wgt, ant1, ant2, nant, niter=50, tol=1e-6):
+    """
+    Solve for one complex gain per antenna
+    vis, mod, wgt : 1D arrays of data, model and weights (flagged data must have weight 0)
+    ant1, ant2 : 1D arrays with the antenna indexes of each sample
+    nant : number of antennas
+    Return the gains (nan for antennas with no data) and the number of iterations
+    """
+    # every baseline enters twice: as p-q and as q-p (V_qp = V_pq^*)
+    a = np.concatenate([ant1, ant2])
+    b = np.concatenate([ant2, ant1])
+    v = np.concatenate([vis, np.conj(vis)])
+    m = np.concatenate([mod, np.conj(mod)])
+    w = np.concatenate([wgt, wgt])
+
+    g = np.ones(nant, dtype=np.complex128)
+    for i in xrange(niter):
+        g_old = g.copy()
+        z = m * np.conj(g[b])
+        zv = w*np.conj(z)*v
+        num = np.bincount(a, weights=zv.real, minlength=nant) + 1j*np.bincount(a, weights=zv.imag, minlength=nant)
+        den = np.bincount(a, weights=w*np.abs(z)**2, minlength=nant)
+        g = np.where(den > 0, num/np.where(den > 0, den, 1), g_old)
+        # StEFCal: average every second iteration to avoid oscillations
+        if i % 2 == 1: g = 0.5*(g + g_old)
+        if np.linalg.norm(g - g_old) / np.linalg.norm(g) < tol: break
+
+    # antennas without data
+    den = np.bincount(a, weights=w, minlength=nant)
+    g[den == 0] = np.nan
+    return g, i+1
+
+
+def solve_chunk(msfile, tidx, startrow, nrow, nchan_sol, datacol, modelcol, mode, nant, refant, niter, tol, outQueue):
+    """
+    Read a solution interval in time from the MS and solve it for each frequency interval
+    Put in the outQueue: [tidx, gains] where gains has shape (nfreq_sol, nant, npol_sol)
+    """
+    with pt.table(msfile, ack=False) as t:
+        ant1 = t.getcol('ANTENNA1', startrow, nrow)
+        ant2 = t.getcol('ANTENNA2', startrow, nrow)
+        vis = t.getcol(datacol, startrow, nrow)
+        mod = t.getcol(modelcol, startrow, nrow)
+        flag = t.getcol('FLAG', startrow, nrow)
+        if 'WEIGHT_SPECTRUM' in t.colnames() and t.iscelldefined('WEIGHT_SPECTRUM', startrow):
+            wgt = t.getcol('WEIGHT_SPECTRUM', startrow, nrow)
+        else:
+            # one weight per correlation, the same for all channels
+            wgt = np.repeat(t.getcol('WEIGHT', startrow, nrow)[:,None,:], vis.shape[1], axis=1)
+
+    # remove autocorrelations
+    cross = (ant1 != ant2)
+    ant1, ant2, vis, mod, flag, wgt = ant1[cross], ant2[cross], vis[cross], mod[cross], flag[cross], wgt[cross]
+    flag |= np.isnan(vis) | np.isnan(mod)
+    wgt[flag] = 0
+    vis[flag] = 0; mod[flag] = 0
+
+    nchan = vis.shape[1]
+    nfreq_sol = int(np.ceil(nchan/float(nchan_sol)))
+    if mode == 'scalar': pols = [[0,3]]
+    else: pols = [[0],[3]]
+    gains = np.zeros((nfreq_sol, nant, len(pols)), dtype=np.complex128)
+
+    for f in xrange(nfreq_sol):
+        chans = slice(f*nchan_sol, min((f+1)*nchan_sol, nchan))
+        for p, pol in enumerate(pols):
+            v = vis[:,chans][:,:,pol]
+            a1 = np.broadcast_to(ant1[:,None,None], v.shape).ravel()
+            a2 = np.broadcast_to(ant2[:,None,None], v.shape).ravel()
+            g, it = stefcal(v.ravel(), mod[:,chans][:,:,pol].ravel(), wgt[:,chans][:,:,pol].ravel(), a1, a2, nant, niter, tol)
+            # reference phases
+            if not np.isnan(g[refant]): g *= np.conj(g[refant])/np.abs(g[refant])
+            gains[f,:,p] = g
+
+    logging.debug('Solved time interval %i (%i rows).' % (tidx, nrow))
+    outQueue.put([tidx, gains])
+
+
+def write_h5parm(h5parmfile, solsetname, antnames, antpos, times, freqs, pols, gains):
+    """
+    Write amplitude000 and phase000 soltabs
+    gains : shape (time, freq, ant, pol)
+    """
+    import losoto.h5parm as lh5
+
+    h5 = lh5.h5parm(h5parmfile, readonly=False)
+    solset = h5.makeSolset(solsetName=solsetname)
+    antennaTable = solset.obj._f_get_child('antenna')
+    for name, pos in zip(antnames, antpos):
+        antennaTable.append([(name, pos)])
+
+    weights = (~np.isnan(gains)).astype(np.float16)
+    gains = np.nan_to_num(gains)
+    if pols is None:
+        axes = ['time','freq','ant']
+        vals = [times, freqs, antnames]
+        gains = gains[...,0]; weights = weights[...,0]
+    else:
+        axes = ['time','freq','ant','pol']
+        vals = [times, freqs, antnames, pols]
+    solset.makeSoltab('amplitude', 'amplitude000', axesNames=axes, axesVals=vals, vals=np.abs(gains), weights=weights)
+    solset.makeSoltab('phase', 'phase000', axesNames=axes, axesVals=vals, vals=np.angle(gains), weights=weights)
+    h5.close()
+
+
+opt = optparse.OptionParser(usage="%prog [options] MS", version="%prog 0.1")
+opt.add_option('-d', '--datacol', help='Data column [default: DATA]', type='string', default='DATA')
+opt.add_option('-c', '--modelcol', help='Model column [default: MODEL_DATA]', type='string', default='MODEL_DATA')
+opt.add_option('-s', '--solint', help='Solution interval in timeslots [default: 1]', type='int', default=1)
+opt.add_option('-n', '--nchan', help='Solution interval in channels, 0 means all channels [default: 0]', type='int', default=0)
+opt.add_option('-m', '--mode', help='Solve mode: "scalar" or "diagonal" [default: diagonal]', type='string', default='diagonal')
+opt.add_option('-r', '--refant', help='Reference antenna index [default: 0]', type='int', default=0)
+opt.add_option('-i', '--niter', help='Max number of iterations [default: 50]', type='int', default=50)
+opt.add_option('-t', '--tol', help='Convergence tolerance [default: 1e-6]', type='float', default=1e-6)
+opt.add_option('-j', '--ncpu', help='Number of parallel solution intervals [default: 4]', type='int', default=4)
+opt.add_option('-o', '--h5parm', help='Output H5parm [default: MS/cal.h5]', type='string', default='')
+opt.add_option('-S', '--solset', help='Output solset [default: sol000]', type='string', default='sol000')
+(options, msfile) = opt.parse_args()
+
+if msfile == []:
+    opt.print_help()
+    sys.exit(0)
+msfile = msfile[0]
+
+if not os.path.exists(msfile):
+    logging.error("Cannot find MS file.")
+    sys.exit(1)
+
+if options.mode not in ['scalar','diagonal']:
+    logging.error("Unknown solve mode: %s" % options.mode)
+    sys.exit(1)
+
+if options.h5parm == '': options.h5parm = msfile+'/cal.h5'
+if os.path.exists(options.h5parm):
+    logging.error("H5parm %s already exists." % options.h5parm)
+    sys.exit(1)
+
+with pt.table(msfile+'/ANTENNA', ack=False) as t:
+    antnames = t.getcol('NAME')
+    antpos = t.getcol('POSITION')
+nant = len(antnames)
+
+with pt.table(msfile+'/SPECTRAL_WINDOW', ack=False) as t:
+    chan_freq = t.getcol('CHAN_FREQ')[0]
+nchan = len(chan_freq)
+if options.nchan == 0 or options.nchan > nchan: options.nchan = nchan
+
+with pt.table(msfile+'/POLARIZATION', ack=False) as t:
+    ncorr = t.getcol('NUM_CORR')[0]
+if ncorr != 4:
+    logging.error("Only MS with 4 correlations are supported.")
+    sys.exit(1)
+
+with pt.table(msfile, ack=False) as t:
+    times = t.getcol('TIME')
+
+# check if ms is time-ordered
+if np.any(np.diff(times) < 0):
+    logging.critical('This code cannot handle MS that are not time-sorted.')
+    sys.exit(1)
+
+# rows where each timeslot starts
+utimes, tstart = np.unique(times, return_index=True)
+tstart = np.append(tstart, len(times))
+del times
+
+# frequency/time of each solution
+freqs = np.array([ np.mean(chan_freq[f:f+options.nchan]) for f in xrange(0, nchan, options.nchan) ])
+solstart = range(0, len(utimes), options.solint)
+soltimes = np.array([ np.mean(utimes[s:s+options.solint]) for s in solstart ])
+logging.info('Solving %i time x %i freq intervals (%s mode)...' % (len(soltimes), len(freqs), options.mode))
+
+mpm = multiprocManager(options.ncpu, solve_chunk)
+for tidx, t in enumerate(solstart):
+    startrow = tstart[t]
+    nrow = tstart[min(t+options.solint, len(utimes))] - startrow
+    mpm.put([msfile, tidx, startrow, nrow, options.nchan, options.datacol, options.modelcol, options.mode, \
+            nant, options.refant, options.niter, options.tol])
+mpm.wait()
+
+npol = 1 if options.mode == 'scalar' else 2
+gains = np.zeros((len(soltimes), len(freqs), nant, npol), dtype=np.complex128)
+for tidx, g in mpm.get():
+    gains[tidx] = g
+
+logging.info('Writing %s...' % options.h5parm)
+if options.mode == 'scalar': pols = None
+else: pols = ['XX','YY']
+write_h5parm(options.h5parm, options.solset, antnames, antpos, soltimes, freqs, pols, gains)
+
+logging.info("Done.")
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 - Francesco de Gasperin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Usage: h5parm_concat.py -o cal.h5 cal-SB000.h5 cal-SB001.h5 ...
+# Concatenate H5parms with the same solsets and soltabs but covering different
+# times/frequencies/antennas (e.g. one H5parm per subband imported in parallel).
+# Axis values are merged (numerical axes are sorted) and every input is put in
+# its place, points not covered by any input have weight 0.
+
+import os, sys
+import optparse
+import logging
+import numpy as np
+import losoto.h5parm as lh5
+logging.basicConfig(level=logging.DEBUG)
+
+
+def merge_axis(values):
+    """
+    Union of the values of an axis: sorted for numerical axes, in order of appearance otherwise
+    """
+    if np.issubdtype(values[0].dtype, np.number):
+        return np.unique(np.concatenate(values))
+    merged = []
+    for vals in values:
+        merged += [v for v in vals if not v in merged]
+    return np.array(merged)
+
+
+def axis_index(merged, vals):
+    """
+    Position of vals in the merged axis
+    """
+    if np.issubdtype(merged.dtype, np.number):
+        return np.searchsorted(merged, vals)
+    pos = dict((v, i) for i, v in enumerate(merged))
+    return np.array([pos[v] for v in vals])
+
+
+opt = optparse.OptionParser(usage="%prog -o output.h5 input1.h5 input2.h5 ...", version="%prog 0.1")
+opt.add_option('-o', '--output', help='Output H5parm', type='string', default='')
+opt.add_option('-c', '--clobber', help='Overwrite the output H5parm if it exists [default: False]', action="store_true", default=False)
+(options, h5files) = opt.parse_args()
+
+if options.output == '' or h5files == []:
+    opt.print_help()
+    sys.exit(0)
+
+for h5file in h5files:
+    if not os.path.exists(h5file):
+        logging.error("Cannot find H5parm file: %s." % h5file)
+        sys.exit(1)
+
+if os.path.exists(options.output):
+    if options.clobber: os.remove(options.output)
+    else:
+        logging.error("H5parm %s already exists." % options.output)
+        sys.exit(1)
+
+h5s = [lh5.h5parm(h5file) for h5file in h5files]
+h5out = lh5.h5parm(options.output, readonly=False)
+
+for solsetname in h5s[0].getSolsetNames():
+    logging.info('Solset: %s' % solsetname)
+    solsets = [h5.getSolset(solsetname) for h5 in h5s]
+    solsetout = h5out.makeSolset(solsetName=solsetname)
+
+    # antennas and sources of all the inputs
+    ants = {}; sous = {}
+    for solset in solsets:
+        ants.update(solset.getAnt())
+        sous.update(solset.getSou())
+    solsetout.obj._f_get_child('antenna').append(sorted(ants.items()))
+    solsetout.obj._f_get_child('source').append(sorted(sous.items()))
+
+    for soltabname in solsets[0].getSoltabNames():
+        soltabs = [solset.getSoltab(soltabname) for solset in solsets]
+        axes = soltabs[0].getAxesNames()
+        if any(st.getAxesNames() != axes for st in soltabs):
+            logging.error('Soltab %s has different axes in the inputs.' % soltabname)
+            sys.exit(1)
+
+        axesvals = [merge_axis([st.getAxisValues(axis) for st in soltabs]) for axis in axes]
+        shape = tuple(len(v) for v in axesvals)
+        logging.debug('Soltab: %s - axes: %s - shape: %s' % (soltabname, ','.join(axes), str(shape)))
+        vals = np.zeros(shape)
+        weights = np.zeros(shape, dtype=np.float16)
+        for st in soltabs:
+            idx = np.ix_(*[axis_index(merged, st.getAxisValues(axis)) for axis, merged in zip(axes, axesvals)])
+            vals[idx] = st.getValues(retAxesVals=False)
+            weights[idx] = st.getValues(retAxesVals=False, weight=True)
+
+        solsetout.makeSoltab(soltabs[0].getType(), soltabname, axesNames=axes, axesVals=axesvals, vals=vals, weights=weights)
+
+for h5 in h5s: h5.close()
+h5out.close()
+logging.info("Done.")
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 - Francesco de Gasperin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Usage: h5parm_lin2circ.py -s sol000 -a amplitude000 -p phase000 in.h5 out.h5
+# Rotate full-Jones solutions (amplitude + phase soltabs with a 4-element pol axis)
+# from linear to circular basis (or the reverse with -r), same convention as mslin2circ.py.
+# The pols may be in any order, the output is in the order XX,XY,YX,YY (RR,RL,LR,LL).
+# The soltabs are processed in chunks along their longest axis, so the whole
+# table is never loaded in memory.
+
+import os, sys, shutil
+import optparse
+import logging
+import numpy as np
+import tables
+logging.basicConfig(level=logging.DEBUG)
+
+# out_pol = sum_in M[out_pol, in_pol] * in_pol (see mslin2circ.py)
+lin2circ = 0.5*np.array([[1, -1j, 1j,  1],
+                         [1,  1j, 1j, -1],
+                         [1, -1j,-1j, -1],
+                         [1,  1j,-1j,  1]])
+circ2lin = 0.5*np.array([[ 1,   1,   1,   1],
+                         [1j, -1j,  1j, -1j],
+                         [-1j,-1j,  1j,  1j],
+                         [ 1,  -1,  -1,   1]])
+
+
+def chunks(shape, axis, chunksize):
+    """
+    Yield slices covering an array of this shape in chunks along axis
+    """
+    for start in xrange(0, shape[axis], chunksize):
+        sl = [slice(None)]*len(shape)
+        sl[axis] = slice(start, min(start+chunksize, shape[axis]))
+        yield tuple(sl)
+
+
+def rotate(h5, solset, amptab, phtab, matrix, inpols, newpols, chunksize):
+    """
+    Apply matrix to the pol axis of the amplitude and phase soltabs, in place
+    inpols : pol order expected by matrix, the pol axis of the soltabs is reordered to it if needed
+    newpols : pol names after the rotation
+    """
+    amp = h5.get_node('/%s/%s' % (solset, amptab))
+    ph = h5.get_node('/%s/%s' % (solset, phtab))
+
+    decode = lambda s: s.decode() if isinstance(s, bytes) else s
+    axes = decode(amp.val.attrs['AXES']).split(',')
+    if decode(ph.val.attrs['AXES']).split(',') != axes or amp.val.shape != ph.val.shape:
+        logging.error('%s and %s must have the same axes.' % (amptab, phtab))
+        sys.exit(1)
+    if not 'pol' in axes or amp.val.shape[axes.index('pol')] != 4:
+        logging.error('Full-Jones solutions are needed (4 pols: %s).' % ','.join(inpols))
+        sys.exit(1)
+    pols = [decode(p) for p in amp.pol[:]]
+    if sorted(pols) != sorted(inpols):
+        logging.error('Input pols must be %s, found: %s.' % (','.join(inpols), ','.join(pols)))
+        sys.exit(1)
+    order = [pols.index(p) for p in inpols]
+    logging.info('Input pols: %s -> %s' % (','.join(pols), ','.join(newpols)))
+
+    polaxis = axes.index('pol')
+    shape = amp.val.shape
+    # chunk along the longest non-pol axis
+    chunkaxis = np.argmax([s if i != polaxis else 0 for i, s in enumerate(shape)])
+    nchunks = int(np.ceil(shape[chunkaxis]/float(chunksize)))
+    logging.debug('Shape: %s - chunking on "%s" (%i chunks)' % (str(shape), axes[chunkaxis], nchunks))
+
+    for i, sl in enumerate(chunks(shape, chunkaxis, chunksize)):
+        g = np.take(amp.val[sl] * np.exp(1j*ph.val[sl]), order, axis=polaxis)
+        w = (amp.weight[sl] != 0) & (ph.weight[sl] != 0)
+        # vectorised on all other axes: move pol last and apply the 4x4 matrix
+        g = np.moveaxis(np.tensordot(g, matrix, axes=([polaxis],[1])), -1, polaxis)
+        # a flagged pol contaminates all the rotated ones
+        w = np.repeat(np.all(w, axis=polaxis, keepdims=True), 4, axis=polaxis)
+        amp.val[sl] = np.abs(g)
+        ph.val[sl] = np.angle(g)
+        amp.weight[sl] = w
+        ph.weight[sl] = w
+        if i % 10 == 0: logging.debug('Chunk %i/%i done.' % (i+1, nchunks))
+
+    amp.pol[:] = newpols
+    ph.pol[:] = newpols
+
+
+opt = optparse.OptionParser(usage="%prog [options] input.h5 [output.h5]", version="%prog 0.1")
+opt.add_option('-s', '--solset', help='Solset name [default: sol000]', type='string', default='sol000')
+opt.add_option('-a', '--amptab', help='Amplitude soltab [default: amplitude000]', type='string', default='amplitude000')
+opt.add_option('-p', '--phtab', help='Phase soltab [default: phase000]', type='string', default='phase000')
+opt.add_option('-r', '--reverse', help='Convert from circular to linear [default: False]', action="store_true", default=False)
+opt.add_option('-c', '--chunksize', help='Number of elements per chunk along the chunked axis [default: 100]', type='int', default=100)
+(options, args) = opt.parse_args()
+
+if len(args) < 1 or len(args) > 2:
+    opt.print_help()
+    sys.exit(0)
+h5in = args[0]
+h5out = args[1] if len(args) == 2 else h5in
+
+if not os.path.exists(h5in):
+    logging.error("Cannot find H5parm file.")
+    sys.exit(1)
+
+if h5out != h5in:
+    logging.info('Copy %s -> %s' % (h5in, h5out))
+    shutil.copyfile(h5in, h5out)
+
+if options.reverse:
+    matrix = circ2lin; inpols = ['RR','RL','LR','LL']; newpols = ['XX','XY','YX','YY']
+else:
+    matrix = lin2circ; inpols = ['XX','XY','YX','YY']; newpols = ['RR','RL','LR','LL']
+
+h5 = tables.open_file(h5out, 'r+')
+rotate(h5, options.solset, options.amptab, options.phtab, matrix, inpols, newpols, options.chunksize)
+h5.close()
+
+logging.info("Done.")
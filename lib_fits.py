@@ -3,18 +3,73 @@ from astropy.io import fits as pyfits
 import numpy as np
 import os, sys, logging
 
+# header and data layout of every fits file opened in this process, by path (see fits_info)
+fits_cache = {}
+# convolution kernels by (beam, target beam, pixel size), see Image.convolve
+kernel_cache = {}
+kernel_cache_size = 4 # max kernels kept, the fft ones are as large as the image
+# kernels larger than this (pixels per side) are applied with fft
+fft_min_kernel = 15
+
+def fits_info(filename):
+    """
+    Return a dict with the header (beam keywords fixed), frequency and data offset of the primary hdu of a fits file
+    Each file is opened and parsed once per process, the cache is refreshed if the file changes (mtime/size)
+    NOTE: the returned header is shared, copy it before changing it (see get_header)
+    """
+    path = os.path.abspath(filename)
+    st = os.stat(path)
+    stamp = (st.st_mtime, st.st_size)
+    if path in fits_cache and fits_cache[path][0] == stamp: return fits_cache[path][1]
+    with pyfits.open(path, memmap=True) as f:
+        header = correct_beam_header(f[0].header.copy())
+        offset = f[0].fileinfo()['datLoc']
+    info = {'header': header, 'freq': find_freq(header), 'offset': offset}
+    fits_cache[path] = [stamp, info]
+    return info
+
+
+def get_header(filename):
+    """ Return a copy of the header of a fits file, from the cache """
+    return fits_info(filename)['header'].copy()
+
+
+def get_data(filename):
+    """
+    Return the data of a fits file as a copy-on-write memory map, without reading it: pixels are read
+    when used and changes stay in memory. Every call returns an independent array.
+    Return None for scaled/integer data (BSCALE, BZERO, BLANK) that cannot be used directly from the file
+    NOTE: the map keeps reading the file until the array is deleted, a file that is mapped must not be
+    rewritten in place (truncating it gives SIGBUS, changing it gives mixed data). Replace it instead:
+    write a new file and rename it over the old one (as TiledImage does), the map keeps the old content
+    and the next call sees the new file (the cache is refreshed when mtime/size change, see fits_info)
+    """
+    info = fits_info(filename)
+    h = info['header']
+    if h['BITPIX'] > 0 or h.get('BSCALE', 1) != 1 or h.get('BZERO', 0) != 0: return None
+    shape = tuple([h['NAXIS%i' % i] for i in range(h['NAXIS'], 0, -1)])
+    dtype = {-32: '>f4', -64: '>f8'}[h['BITPIX']]
+    return np.memmap(os.path.abspath(filename), dtype=dtype, mode='c', offset=info['offset'], shape=shape)
+
+
 def flatten(filename, channel=0, freqaxis=0):
-    """ Flatten a fits file so that it becomes a 2D image. Return new header and data """
+    """ Flatten a fits file so that it becomes a 2D image. Return new header and data
+    The file is memory mapped: the header comes from the cache (see fits_info) and only the bytes of the requested
+    plane are read (data are returned as a copy-on-write memory map, pixels are read when used, see get_data
+    for its lifetime). Scaled/integer data are read in memory. """
 
-    f = pyfits.open(filename)
+    f_header = fits_info(filename)['header']
+    data = get_data(filename)
 
-    naxis=f[0].header['NAXIS']
+    naxis=f_header['NAXIS']
     if naxis<2:
         raise RadioError('Can\'t make map from this')
     if naxis==2:
-        return f[0].header,f[0].data
+        if data is None:
+            with pyfits.open(filename) as f: data = np.array(f[0].data)
+        return f_header.copy(), data
 
-    w = pywcs(f[0].header)
+    w = pywcs(f_header)
     wn = pywcs(naxis=2)
 
     wn.wcs.crpix[0]=w.wcs.crpix[0]
@@ -26,11 +81,11 @@ def flatten(filename, channel=0, freqaxis=0):
 
     header = wn.to_header()
     header["NAXIS"]=2
-    header["NAXIS1"]=f[0].header['NAXIS1'] # Test
-    header["NAXIS2"]=f[0].header['NAXIS2'] # Test
+    header["NAXIS1"]=f_header['NAXIS1'] # Test
+    header["NAXIS2"]=f_header['NAXIS2'] # Test
     copy=('EQUINOX','EPOCH')
     for k in copy:
-        r=f[0].header.get(k)
+        r=f_header.get(k)
         if r:
             header[k]=r
 
@@ -44,14 +99,17 @@ def flatten(filename, channel=0, freqaxis=0):
             slice.append(0)
 
     # slice=(0,)*(naxis-2)+(np.s_[:],)*2
-    return header, f[0].data[slice]
+    # read only this plane, not the whole cube (section also scales BSCALE/BZERO data)
+    if data is None:
+        with pyfits.open(filename) as f: return header, np.array(f[0].section[tuple(slice)])
+    return header, data[tuple(slice)]
 
 
 def correct_beam_header(header):
     """ 
     Find the primary beam headers following AIPS convenction
     """
-    import pyfits, re
+    import re
     if ('BMAJ' in header) and ('BMIN' in header) and ('PA' in header): return header
     elif 'HISTORY' in header:
         for hist in header['HISTORY']:
@@ -78,15 +136,349 @@ def find_freq(header):
                 return header.get('CRVAL%i' % i)
 
     return None # no freq information found
- 
+
+
+def robust_rms(data, clip=3., niter=1000, eps=None, sample=None, pix_per_beam=1., chunksize=2**22):
+    """
+    Robust rms: std of the pixels with |value| < clip*rms, iterated until convergence, but done in two linear passes
+    so that it works on memory mapped images without copies of the data:
+    1. the MAD of ~1e6 pixels gives the noise scale, used only to choose the bins (see noise_scale)
+    2. |value| are binned (fine bins up to 10*clip*MAD, 1% log bins above) collecting number, sum and sum of squares,
+    the clipping is then iterated on the cumulative bins (see noise_bins and noise_clip)
+    NaNs are ignored
+    data : array (the last axis is the image row)
+    clip : clipping threshold in rms
+    eps : convergency criterion on the relative rms change, if None is 0.1% of initial rms (as it was for Image.calc_noise)
+    sample : fraction of the rows to use (None = all)
+    pix_per_beam : number of correlated pixels, to compute the error when sampling
+    Return rms and its statistical error due to sampling (0 if all pixels are used)
+    """
+    data = data.reshape(-1, data.shape[-1])
+    step = 1 if sample is None else max(1, int(round(1./sample)))
+    scale = noise_scale(data)
+    if not scale > 0: return scale, scale # 0 or nan
+    rms, num = noise_clip(noise_bins(data, clip*scale, step, chunksize=chunksize), clip*scale, clip, niter, eps)
+    err = 0. if step == 1 else rms/np.sqrt(2*num/pix_per_beam)
+    return rms, err
+
+
+def noise_scale(data):
+    """ Noise scale of a 2D array from the MAD of a subset of ~1e6 pixels (rows), nan if all NaNs """
+    ny, nx = data.shape
+    sub = np.asarray(data[::max(1, ny*nx // 10**6)], dtype=np.float64)
+    sub = sub[np.isfinite(sub)]
+    if len(sub) == 0: return np.nan
+    scale = 1.4826*np.median(np.abs(sub - np.median(sub)))
+    if scale == 0: scale = np.std(sub) # e.g. mostly zeros
+    return scale
+
+
+def noise_bins(data, binscale, step=1, first=0, chunksize=2**22):
+    """
+    Histogram of |value| of the pixels of a 2D array for noise_clip: 30000 bins up to 10*binscale, then 1% log bins
+    step, first : use only one row every step, starting from first
+    Return [number, sum, sum of squares] per bin, arrays of a different lengths are combined with sum_bins
+    """
+    ny, nx = data.shape
+    rows = max(1, chunksize // nx)
+    nlin = 30000
+    width = 10.*binscale/nlin
+    logstep = np.log(1.01)
+    n = np.zeros(nlin); s1 = np.zeros(nlin); s2 = np.zeros(nlin)
+    for r in xrange(first, ny, rows*step):
+        a = np.asarray(data[r:r+rows*step:step]).ravel()
+        a = a[np.isfinite(a)]
+        absa = np.abs(a)
+        a = a.astype(np.float64) # for the moments
+        idx = (absa/width).astype(np.int64)
+        tail = idx >= nlin
+        if np.any(tail): idx[tail] = nlin + (np.log(absa[tail]/(10.*binscale))/logstep).astype(np.int64)
+        nbins = max(len(n), idx.max()+1) if len(idx) > 0 else len(n)
+        if nbins > len(n):
+            n, s1, s2 = [np.append(x, np.zeros(nbins-len(x))) for x in (n, s1, s2)]
+        n += np.bincount(idx, minlength=nbins)
+        s1 += np.bincount(idx, weights=a, minlength=nbins)
+        s2 += np.bincount(idx, weights=a*a, minlength=nbins)
+    return [n, s1, s2]
+
+
+def sum_bins(bins):
+    """ Sum the histograms of noise_bins of different parts of an image """
+    nbins = max(len(b[0]) for b in bins)
+    return [np.sum([np.append(b[i], np.zeros(nbins-len(b[i]))) for b in bins], axis=0) for i in range(3)]
+
+
+def noise_clip(bins, binscale, clip=3., niter=1000, eps=None):
+    """
+    Iterate the clipping on the histogram of noise_bins (partial bins are interpolated)
+    Return rms and number of pixels used
+    """
+    n, s1, s2 = bins
+    nlin = 30000
+    logstep = np.log(1.01)
+    edges = np.append(np.arange(nlin)*10.*binscale/nlin, 10.*binscale*np.exp(np.arange(len(n)-nlin+1)*logstep))
+    cn, cs1, cs2 = [np.append(0, np.cumsum(x)) for x in (n, s1, s2)]
+
+    def moments(t):
+        """ number, sum and sum of squares of the pixels with |value| < t """
+        j = min(np.searchsorted(edges, t, side='right')-1, len(n))
+        if j == len(n): return cn[-1], cs1[-1], cs2[-1]
+        f = (t - edges[j])/(edges[j+1] - edges[j])
+        return cn[j] + f*n[j], cs1[j] + f*s1[j], cs2[j] + f*s2[j]
+
+    t = np.inf
+    oldrms = 1.
+    for i in xrange(niter):
+        num, sm, sm2 = moments(t)
+        rms = np.sqrt(max(sm2/num - (sm/num)**2, 0))
+        if eps is None: eps = rms*1e-3
+        if rms == 0 or np.abs(oldrms-rms)/rms < eps:
+            return rms, num
+        t = clip*rms
+        oldrms = rms
+    raise Exception('Noise estimation failed to converge.')
+
+
+def fft_size(n):
+    """ Smallest 2^a*3^b*5^c >= n, fast sizes for fft """
+    best = 2*n
+    f5 = 1
+    while f5 < best:
+        f35 = f5
+        while f35 < best:
+            f = f35
+            while f < n: f *= 2
+            best = min(best, f)
+            f35 *= 3
+        f5 *= 5
+    return best
+
+
+def gaussian_fft(stddev_maj, stddev_min, position_angle, shape):
+    """
+    Fourier transform (rfft2 layout) of a normalised elliptical Gaussian centred on pixel 0,0
+    with the same parameters of EllipticalGaussian2DKernel (stddevs in pixels, position angle in rad)
+    """
+    c, s = np.cos(position_angle), np.sin(position_angle)
+    cxx = (c*stddev_maj)**2 + (s*stddev_min)**2
+    cyy = (s*stddev_maj)**2 + (c*stddev_min)**2
+    cxy = c*s*(stddev_maj**2 - stddev_min**2)
+    fy = np.fft.fftfreq(shape[0])[:,np.newaxis]
+    fx = np.fft.rfftfreq(shape[1])[np.newaxis,:]
+    # the kernel is sampled on pixels: narrow kernels need the aliases of the nearby frequencies to match the direct one
+    aliases = [-1, 0, 1] if stddev_min < 4 else [0]
+    ft = 0
+    for ay in aliases:
+        for ax in aliases:
+            ft = ft + np.exp(-2*np.pi**2 * (cxx*(fx+ax)**2 + 2*cxy*(fx+ax)*(fy+ay) + cyy*(fy+ay)**2))
+    return ft/ft[0,0] # normalised
+
+
+def convolve_fft(data, ft_kernel, kernel_shape, fft_shape, zero_tol=1e-8):
+    """
+    Convolve with a kernel given in Fourier space, same result of astropy convolve(boundary=None) with a normalised kernel:
+    NaNs are interpolated (kernel renormalised on valid pixels) and pixels closer to the edge than half kernel are 0
+    Pixels where the valid part of the kernel is < zero_tol are NaN
+    ft_kernel : rfft2 of the kernel with shape fft_shape, which must be >= data.shape + kernel_shape/2 to avoid wrapping
+    """
+    ny, nx = data.shape
+    nans = np.isnan(data)
+    top = np.fft.irfft2(np.fft.rfft2(np.where(nans, 0, data).astype(np.float64), fft_shape) * ft_kernel, fft_shape)[:ny,:nx]
+    if nans.any():
+        bot = np.fft.irfft2(np.fft.rfft2((~nans).astype(np.float64), fft_shape) * ft_kernel, fft_shape)[:ny,:nx]
+        bad = bot < zero_tol
+        bot[bad] = 1.
+        top /= bot
+        top[bad] = np.nan
+    wky, wkx = kernel_shape[0]//2, kernel_shape[1]//2
+    top[:wky] = 0; top[ny-wky:] = 0
+    top[:,:wkx] = 0; top[:,nx-wkx:] = 0
+    return top
+
+
+def get_kernel(beam, target_beam, pixsize):
+    """
+    Kernel to convolve from beam to target_beam (both [bmaj, bmin, bpa] in deg) on pixels of pixsize deg, cached in kernel_cache
+    Return a dict with the convolving beam, the gaussian parameters in pixels, the astropy kernel and its ffts by image shape
+    """
+    from lib_beamdeconv import deconvolve_ell, EllipticalGaussian2DKernel
+
+    key = (tuple(beam), tuple(target_beam), pixsize)
+    if not key in kernel_cache:
+        # first find beam to convolve with
+        convolve_beam = deconvolve_ell(target_beam[0], target_beam[1], target_beam[2], beam[0], beam[1], beam[2])
+        if convolve_beam[0] is None:
+            logging.error('Cannot deconvolve this beam.')
+            sys.exit(1)
+        bmaj, bmin, bpa = convolve_beam
+        fwhm2sigma = 1./np.sqrt(8.*np.log(2.))
+        params = ((bmaj*fwhm2sigma)/pixsize, (bmin*fwhm2sigma)/pixsize, (90+bpa)*np.pi/180.) # bmaj and bmin are in pixels
+        if len(kernel_cache) >= kernel_cache_size: del kernel_cache[list(kernel_cache.keys())[0]]
+        kernel_cache[key] = {'beam': convolve_beam, 'params': params, 'kernel': EllipticalGaussian2DKernel(*params), 'fft': {}}
+    return kernel_cache[key]
+
+
+def convolve_data(data, kern, method='auto'):
+    """
+    Convolve a 2D array with a kernel from get_kernel, NaNs are interpolated and pixels closer to the edges than
+    half kernel are 0 (as astropy convolve with boundary=None)
+    method : 'direct' (astropy), 'fft' or 'auto' (fft for kernels larger than fft_min_kernel pixels)
+    the two give the same result, but fft leaves NaN where the kernel has < 1e-8 of its weight on valid pixels (see convolve_fft)
+    """
+    from astropy import convolution
+
+    kernel_shape = kern['kernel'].shape
+    if method == 'auto':
+        # sub-pixel gaussians are not well described by their analytic transform
+        method = 'fft' if max(kernel_shape) > fft_min_kernel and kern['params'][1] >= 1 else 'direct'
+    if method == 'fft':
+        ny, nx = data.shape
+        fft_shape = (fft_size(ny+kernel_shape[0]//2+1), fft_size(nx+kernel_shape[1]//2+1))
+        if not fft_shape in kern['fft']:
+            if len(kern['fft']) >= 4: kern['fft'] = {} # a few image (or tile) shapes per kernel
+            kern['fft'][fft_shape] = gaussian_fft(*(kern['params']+(fft_shape,)))
+        return convolve_fft(data, kern['fft'][fft_shape], kernel_shape, fft_shape)
+    else:
+        return convolution.convolve(data, kern['kernel'], boundary=None)
+
+
+def tiles(shape, tilesize=2048, halo=0):
+    """
+    Split a 2D image in tiles of about tilesize pixels per side (all tiles have similar sizes)
+    Yield for each tile the slices of: the part of the image done by this tile, the part to read
+    (tile plus halo pixels per side, clipped at the image edges) and the tile inside the part read
+    """
+    def edges(n):
+        return np.linspace(0, n, max(1, int(np.ceil(n/float(tilesize))))+1).astype(int)
+    for y0, y1 in zip(edges(shape[0])[:-1], edges(shape[0])[1:]):
+        for x0, x1 in zip(edges(shape[1])[:-1], edges(shape[1])[1:]):
+            py0, py1 = max(0, y0-halo), min(shape[0], y1+halo)
+            px0, px1 = max(0, x0-halo), min(shape[1], x1+halo)
+            yield (slice(y0, y1), slice(x0, x1)), (slice(py0, py1), slice(px0, px1)), \
+                    (slice(y0-py0, y1-py0), slice(x0-px0, x1-px0))
+
+
+def open_memmap(desc, mode='r'):
+    """ Memory map a 2D image from a descriptor [filename, dtype, offset, shape], which can be sent to other processes """
+    filename, dtype, offset, shape = desc
+    return np.memmap(filename, dtype=dtype, mode=mode, offset=offset, shape=tuple(shape))
+
+
+def new_fits(filename, header, shape, bitpix=-64):
+    """
+    Create a fits file for a 2D image without writing the data (all 0), to be filled through a memory map
+    header : header of the image (the data keywords are replaced)
+    Return the descriptor of the data for open_memmap
+    """
+    h = pyfits.PrimaryHDU().header
+    h['BITPIX'] = bitpix
+    h['NAXIS'] = 2
+    h['NAXIS1'] = shape[1]
+    h['NAXIS2'] = shape[0]
+    for card in header.cards:
+        if card.keyword in ['SIMPLE', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'EXTEND', 'BSCALE', 'BZERO', 'BLANK', 'END']: continue
+        h.append(card)
+    hstr = h.tostring().encode('ascii')
+    size = shape[0]*shape[1]*abs(bitpix)//8
+    with open(filename, 'wb') as f:
+        f.write(hstr)
+        f.seek(len(hstr) + int(np.ceil(size/2880.))*2880 - 1)
+        f.write(b'\0')
+    return [os.path.abspath(filename), {-32: '>f4', -64: '>f8'}[bitpix], len(hstr), list(shape)]
+
+
+def tile_worker(func, src, dst, tile, padded, inner, args, outQueue=None):
+    """
+    Run func(data, padded, *args) on a tile (see tiles) of the image src and write the tile part of the result in dst
+    (src and dst are descriptors for open_memmap, if dst is None the result of func is returned/put in the outQueue)
+    """
+    data = np.asarray(open_memmap(src)[padded])
+    result = func(data, padded, *args)
+    if dst is not None:
+        out = open_memmap(dst, mode='r+')
+        out[tile] = result[inner]
+        out.flush()
+        del out
+        result = None
+    if outQueue is not None: outQueue.put(result)
+    return result
+
+
+def run_tiles(func, src, dst, args=(), tilesize=2048, halo=0, ncpu=1):
+    """
+    Process an image tile by tile (see tile_worker), from memory mapped input to memory mapped output
+    func : function(data, padded, *args) that processes the data of a tile plus halo, padded are the slices of that part
+    of the image. It must be defined at module level to be run in other processes
+    src, dst : descriptors of input and output (see open_memmap), they can be the same file if halo is 0
+    ncpu : number of processes
+    Return the list of results of func if dst is None
+    """
+    jobs = [[func, src, dst, tile, padded, inner, args] for tile, padded, inner in tiles(src[3], tilesize, halo)]
+    logging.debug('Processing %i tiles of %s with %i processes...' % (len(jobs), os.path.basename(src[0]), ncpu))
+    if ncpu == 1 or len(jobs) == 1:
+        return [tile_worker(*job) for job in jobs]
+
+    from lib_multiproc import multiprocManager
+    mpm = multiprocManager(min(ncpu, len(jobs)), tile_worker)
+    for job in jobs: mpm.put(job)
+    mpm.wait()
+    return list(mpm.get())
+
+
+def tile_convolve(data, padded, beam, target_beam, pixsize, method):
+    """ Tile version of Image.convolve (halo: half kernel) """
+    return convolve_data(data, get_kernel(beam, target_beam, pixsize), method) * (target_beam[0]*target_beam[1])/(beam[0]*beam[1])
+
+
+def tile_region(data, padded, header, regionfile, blankvalue, invert):
+    """ Tile version of Image.apply_region, header is the header of the whole image """
+    import pyregion
+    h = header.copy()
+    h['CRPIX1'] -= padded[1].start
+    h['CRPIX2'] -= padded[0].start
+    h['NAXIS1'], h['NAXIS2'] = data.shape[1], data.shape[0]
+    mask = pyregion.open(regionfile).get_mask(header=h, shape=data.shape)
+    data = data.copy()
+    if invert: data[~mask] = blankvalue
+    else: data[mask] = blankvalue
+    return data
+
+
+def tile_mask(data, padded, maskfile, blankvalue, invert):
+    """
+    Tile version of Image.apply_mask, the mask is a .npy file (boolean array) or the first plane of a fits file
+    (not 0 = masked)
+    """
+    if maskfile.endswith('.npy'):
+        mask = np.load(maskfile, mmap_mode='r')[padded]
+    else:
+        with pyfits.open(maskfile, memmap=True) as f:
+            naxis = f[0].header['NAXIS']
+            mask = f[0].section[(0,)*(naxis-2)+tuple(padded)] != 0
+    data = data.copy()
+    if invert: data[~mask] = blankvalue
+    else: data[mask] = blankvalue
+    return data
+
+
+def tile_blank(data, padded, threshold, blankvalue):
+    """ Blank pixels <= threshold """
+    data = data.copy()
+    data[data <= threshold] = blankvalue
+    return data
+
+
+def tile_noise(data, padded, binscale, step):
+    """ Tile version of noise_bins, rows are sampled as for the whole image """
+    return noise_bins(data, binscale, step, first=(-padded[0].start) % step)
+
 
 class Image(object):
 
     def __init__(self, imagefile):
 
         self.imagefile = imagefile
-        header = pyfits.open(imagefile)[0].header
-        header = correct_beam_header(header)
+        header = fits_info(imagefile)['header'] # beam keywords already fixed
 
         try:
             beam = [header['BMAJ'], header['BMIN'], header['BPA']]
@@ -96,13 +488,14 @@ class Image(object):
         logging.debug('%s: Beam: %.1f" %.1f" (pa %.1f deg)' % \
                 (self.imagefile, beam[0]*3600., beam[1]*3600., beam[2]))
 
-        self.freq = find_freq(header)
+        self.freq = fits_info(imagefile)['freq']
         if self.freq is None:
             logging.error('%s: No frequency information found.' % self.imagefile)
             sys.exit(1)
         logging.debug('%s: Frequency: %.0f MHz' % (self.imagefile, self.freq/1e6))
 
         self.noise = None
+        self.noise_err = None
         self.img_hdr, self.img_data = flatten(self.imagefile)
         self.set_beam(beam)
         self.set_freq(self.freq)
@@ -151,53 +544,49 @@ class Image(object):
         else: self.img_data[mask] = blankvalue
 
 
-    def calc_noise(self, niter=1000, eps=None):
+    def blank(self, threshold, blankvalue=np.nan):
+        """
+        Blank pixels <= threshold (e.g. nsigma*noise)
+        """
+        logging.debug('%s: Blank below %f' % (self.imagefile, threshold))
+        self.img_data[self.img_data <= threshold] = blankvalue
+
+
+    def calc_noise(self, niter=1000, eps=None, sample=None):
         """
         Return the rms of all the pixels in an image
         niter : robust rms estimation
         eps : convergency criterion, if None is 0.1% of initial rms
+        sample : fraction of image rows to use (None = all), see robust_rms
         """
-        if eps == None: eps = np.nanstd(self.img_data)*1e-3
-        data = self.img_data[ ~np.isnan(self.img_data) ] # remove nans
-        oldrms = 1.
-        for i in range(niter):
-            rms = np.nanstd(data)
-            if np.abs(oldrms-rms)/rms < eps:
-                self.noise = rms
-                logging.debug('%s: Noise: %.3f mJy/b' % (self.imagefile, self.noise*1e3))
-                return
-
-            data = data[np.abs(data)<3*rms]
-            oldrms = rms
-        raise Exception('Noise estimation failed to converge.')
+        bmaj, bmin, bpa = self.get_beam()
+        pix_per_beam = np.pi/(4*np.log(2.)) * bmaj*bmin / abs(self.img_hdr['CDELT1']*self.img_hdr['CDELT2'])
+        self.noise, self.noise_err = robust_rms(self.img_data, clip=3., niter=niter, eps=eps, sample=sample, pix_per_beam=pix_per_beam)
+        if self.noise_err > 0:
+            logging.debug('%s: Noise: %.3f +/- %.3f mJy/b' % (self.imagefile, self.noise*1e3, self.noise_err*1e3))
+        else:
+            logging.debug('%s: Noise: %.3f mJy/b' % (self.imagefile, self.noise*1e3))
 
-    def convolve(self, target_beam):
+    def convolve(self, target_beam, method='auto'):
         """
         Convolve *to* this rsolution
         beam = [bmaj, bmin, bpa]
+        method : 'direct' (astropy), 'fft' or 'auto' (see convolve_data)
         """
-        from lib_beamdeconv import deconvolve_ell, EllipticalGaussian2DKernel
-        from astropy import convolution
-
         # if difference between beam is negligible <1%, skip - it mostly happens when beams are exactly the same
         beam = self.get_beam()
         if (np.abs((target_beam[0]/beam[0])-1) < 1e-2) and (np.abs((target_beam[1]/beam[1])-1) < 1e-2) and (np.abs(target_beam[2] - beam[2]) < 1):
             logging.debug('%s: do not convolve. Same beam.' % self.imagefile)
             return
-        # first find beam to convolve with
-        convolve_beam = deconvolve_ell(target_beam[0], target_beam[1], target_beam[2], beam[0], beam[1], beam[2])
-        if convolve_beam[0] is None:
-            logging.error('Cannot deconvolve this beam.')
-            sys.exit(1)
+        assert abs(self.img_hdr['CDELT1']) == abs(self.img_hdr['CDELT2'])
+        pixsize = abs(self.img_hdr['CDELT1'])
+        kern = get_kernel(beam, target_beam, pixsize)
+        convolve_beam = kern['beam']
         logging.debug('%s: Convolve beam: %.3f" %.3f" (pa %.1f deg)' \
                 % (self.imagefile, convolve_beam[0]*3600, convolve_beam[1]*3600, convolve_beam[2]))
+
         # do convolution on data
-        bmaj, bmin, bpa = convolve_beam
-        assert abs(self.img_hdr['CDELT1']) == abs(self.img_hdr['CDELT2'])
-        pixsize = abs(self.img_hdr['CDELT1'])
-        fwhm2sigma = 1./np.sqrt(8.*np.log(2.))
-        gauss_kern = EllipticalGaussian2DKernel((bmaj*fwhm2sigma)/pixsize, (bmin*fwhm2sigma)/pixsize, (90+bpa)*np.pi/180.) # bmaj and bmin are in pixels
-        self.img_data = convolution.convolve(self.img_data, gauss_kern, boundary=None)
+        self.img_data = convolve_data(self.img_data, kern, method)
         self.img_data *= (target_beam[0]*target_beam[1])/(beam[0]*beam[1]) # since we are in Jt/b we need to renormalise
         self.set_beam(target_beam) # update beam
 
@@ -212,3 +601,122 @@ class Image(object):
         self.img_hdr['CRVAL1'] += dra/(np.cos(np.pi*dec/180.))
         self.img_hdr['CRVAL2'] += ddec
 
+
+class TiledImage(Image):
+    """
+    Image too large for the memory: the data stay in fits files and every operation goes tile by tile (see run_tiles)
+    in ncpu processes. Every operation writes a temporary file that replaces outfile when complete (files are never
+    changed in place, see get_data), img_data is always a copy-on-write memory map of the current data
+    """
+
+    def __init__(self, imagefile, outfile, tilesize=2048, ncpu=1):
+        Image.__init__(self, imagefile)
+        self.outfile = outfile
+        self.tilesize = tilesize
+        self.ncpu = ncpu
+        info = fits_info(imagefile)
+        if get_data(imagefile) is None:
+            logging.error('%s: Tiled processing needs float data without BSCALE/BZERO.' % self.imagefile)
+            sys.exit(1)
+        # first plane of the file (see flatten)
+        self.src = [os.path.abspath(imagefile), {-32: '>f4', -64: '>f8'}[info['header']['BITPIX']], info['offset'], list(self.img_data.shape)]
+
+    def run(self, func, args=(), halo=0, header=None):
+        """
+        Run func on all tiles (see run_tiles), the output goes in outfile (with header if given)
+        Return the results of func for func that do not return images (header=False)
+        """
+        if header is False: return run_tiles(func, self.src, None, args, self.tilesize, halo, self.ncpu)
+        tmpfile = self.outfile+'.tmp'
+        # same BITPIX of the input, float32 images stay float32
+        bitpix = {'>f4': -32, '>f8': -64}[self.src[1]]
+        dst = new_fits(tmpfile, self.img_hdr if header is None else header, self.src[3], bitpix)
+        run_tiles(func, self.src, dst, args, self.tilesize, halo, self.ncpu)
+        # the old file stays readable by the maps still open on it
+        os.rename(tmpfile, self.outfile)
+        dst[0] = os.path.abspath(self.outfile)
+        self.src = dst
+        self.img_data = open_memmap(self.src, mode='c')
+
+    def apply_region(self, regionfile, blankvalue=np.nan, invert=False):
+        """
+        Blank inside mask
+        invert: blank outside region
+        """
+        if not os.path.exists(regionfile):
+            logging.error('%s: Region file not found.' % regionfile)
+            sys.exit(1)
+        logging.debug('%s: Apply region %s' % (self.imagefile, regionfile))
+        self.run(tile_region, (self.img_hdr, os.path.abspath(regionfile), blankvalue, invert))
+
+    def apply_mask(self, mask, blankvalue=np.nan, invert=False):
+        """
+        Blank inside mask
+        mask: boolean array as in Image.apply_mask, or name of a fits file with the mask (not 0 = masked)
+        invert: blank outside mask
+        """
+        if isinstance(mask, str):
+            logging.debug('%s: Apply mask %s' % (self.imagefile, mask))
+            self.run(tile_mask, (os.path.abspath(mask), blankvalue, invert))
+            return
+        # the array goes to a file the tiles can map
+        logging.debug('%s: Apply mask' % self.imagefile)
+        maskfile = os.path.abspath(self.outfile+'.mask.npy')
+        np.save(maskfile, np.asarray(mask, dtype=bool))
+        try:
+            self.run(tile_mask, (maskfile, blankvalue, invert))
+        finally:
+            os.remove(maskfile)
+
+    def blank(self, threshold, blankvalue=np.nan):
+        """
+        Blank pixels <= threshold (e.g. nsigma*noise)
+        """
+        logging.debug('%s: Blank below %f' % (self.imagefile, threshold))
+        self.run(tile_blank, (threshold, blankvalue))
+
+    def calc_noise(self, niter=1000, eps=None, sample=None):
+        """
+        Return the rms of all the pixels in an image (see Image.calc_noise), the histograms of the tiles are made in parallel
+        """
+        bmaj, bmin, bpa = self.get_beam()
+        pix_per_beam = np.pi/(4*np.log(2.)) * bmaj*bmin / abs(self.img_hdr['CDELT1']*self.img_hdr['CDELT2'])
+        step = 1 if sample is None else max(1, int(round(1./sample)))
+        clip = 3.
+        scale = noise_scale(self.img_data)
+        if not scale > 0:
+            self.noise, self.noise_err = scale, scale
+        else:
+            bins = sum_bins(self.run(tile_noise, (clip*scale, step), header=False))
+            self.noise, num = noise_clip(bins, clip*scale, clip, niter, eps)
+            self.noise_err = 0. if step == 1 else self.noise/np.sqrt(2*num/pix_per_beam)
+        if self.noise_err > 0:
+            logging.debug('%s: Noise: %.3f +/- %.3f mJy/b' % (self.imagefile, self.noise*1e3, self.noise_err*1e3))
+        else:
+            logging.debug('%s: Noise: %.3f mJy/b' % (self.imagefile, self.noise*1e3))
+
+    def convolve(self, target_beam, method='auto'):
+        """
+        Convolve *to* this rsolution
+        beam = [bmaj, bmin, bpa]
+        method : 'direct' (astropy), 'fft' or 'auto' (see convolve_data)
+        """
+        beam = self.get_beam()
+        if (np.abs((target_beam[0]/beam[0])-1) < 1e-2) and (np.abs((target_beam[1]/beam[1])-1) < 1e-2) and (np.abs(target_beam[2] - beam[2]) < 1):
+            logging.debug('%s: do not convolve. Same beam.' % self.imagefile)
+            return
+        assert abs(self.img_hdr['CDELT1']) == abs(self.img_hdr['CDELT2'])
+        pixsize = abs(self.img_hdr['CDELT1'])
+        kern = get_kernel(beam, target_beam, pixsize)
+        convolve_beam = kern['beam']
+        logging.debug('%s: Convolve beam: %.3f" %.3f" (pa %.1f deg)' \
+                % (self.imagefile, convolve_beam[0]*3600, convolve_beam[1]*3600, convolve_beam[2]))
+
+        halo = max(kern['kernel'].shape)//2
+        header = self.img_hdr.copy()
+        header['BMAJ'], header['BMIN'], header['BPA'] = target_beam
+        tilesize = self.tilesize
+        self.tilesize = max(tilesize, 4*halo) # tiles must be larger than the kernel
+        self.run(tile_convolve, (beam, target_beam, pixsize, method), halo=halo, header=header)
+        self.tilesize = tilesize
+        self.set_beam(target_beam) # update beam
@@ -21,7 +21,7 @@
 
 import os.path, sys, pickle, glob, argparse, re, logging
 import numpy as np
-from lib_fits import flatten
+from lib_fits import flatten, get_header
 from astropy.io import fits as pyfits
 from astropy.wcs import WCS as pywcs
 from astropy.table import Table
@@ -318,7 +318,7 @@ isum /= wsum
 isum[~mask] = np.nan
 
 for ch in ('BMAJ', 'BMIN', 'BPA'):
-    regrid_hdr[ch] = pyfits.open(directions[0].imagefile)[0].header[ch]
+    regrid_hdr[ch] = get_header(directions[0].imagefile)[ch]
     regrid_hdr['ORIGIN'] = 'pill-pipe-mosaic'
     regrid_hdr['UNITS'] = 'Jy/beam'
 
@@ -1,10 +1,24 @@
 #!/bin/bash
-# run the argument in qsub and return when the process is finished
+# run the argument in qsub and return when the process is finished, with its exit status
+# usage: qsub_waiter.sh [-s sentinel] processors cmd
+# the job writes its exit status in a sentinel file when done, the end of the job is seen from that file
+# with -s the script returns just after the submission printing the job id, whoever called it watches the sentinel
 # check if the called program might use more CPUs or not
 
-sleep_time=10 # seconds; don't make this too short! don't want to tax system with excessive qstat calls
+check_time=300 # seconds; how often qstat is called to check that the job did not die without writing the sentinel
 shopt -s expand_aliases
 
+# sentinel file, must be on a filesystem shared with the nodes
+submit_only=0
+if [ "$1" == "-s" ]; then
+    sentinel=$2
+    submit_only=1
+    shift 2
+else
+    sentinel=`mktemp -u $PWD/.qsub_waiter_XXXXXX`
+fi
+rm -f $sentinel $sentinel.tmp
+
 # get number of processors
 proc=$1
 shift
@@ -34,7 +48,9 @@ echo \"\${PBS_JOBID} (proc:${proc}, node: \`/bin/hostname\`) - \'${escapedcmd}\'
 source /net/para34/data1/oonk/tjd_upd/lofim.sh
 export PATH=\"${PATH}\"
 export PYTHONPATH=\"${PYTHONPATH}\"
-${@}"""
+trap 'echo 143 > ${sentinel}.tmp; mv ${sentinel}.tmp ${sentinel}; exit 143' TERM
+( ${@} )
+echo \$? > ${sentinel}.tmp; mv ${sentinel}.tmp ${sentinel}"""
 
     # call the command and capture the stdout
     id=`qsub -q lofarq /dev/stdin << EOF | perl -pe 's:^\D+(\d+).*$:$1:'
@@ -46,11 +62,30 @@ EOF`
     sleep 1
 done
 
-# status starts as Q (queue) and becomes E (executing)
-status=`qstat $id | grep $id | awk '{print $5}'`
+if [ $submit_only == 1 ]; then
+    echo $id
+    exit 0
+fi
 
-while [ "$status" != 'C' ] # while $status is not "C" (complete)
+# wait for the sentinel (a local stat, not a qstat)
+n=0
+while [ ! -e $sentinel ]
     do
-        sleep $sleep_time
-        status=`qstat $id | grep $id | awk '{print $5}'`
+        sleep 1
+        n=$((n+1))
+        if [ $((n % check_time)) -eq 0 ]; then
+            # status starts as Q (queue), becomes E (executing) and then C (complete)
+            status=`qstat $id 2>/dev/null | grep $id | awk '{print $5}'`
+            if [ "$status" == 'C' ] || [ "$status" == '' ]; then
+                sleep 30 # the sentinel can take a while to appear on network filesystems
+                if [ ! -e $sentinel ]; then
+                    echo "Job $id ended without writing $sentinel" >&2
+                    exit 1
+                fi
+            fi
+        fi
     done
+
+rc=`cat $sentinel`
+rm -f $sentinel
+exit $rc
@@ -1,199 +1,167 @@
-#! /usr/bin/env python
-
-import sys
-import pydal as dal
-from pylab import *
-from numpy import *
-from scipy import *
-
-# check usage
-if len(sys.argv) < 4 or len(sys.argv) > 12:
-        print "Usage:"
-        print "\tsidereal_difference.py <file> x 3 <antenna1> <antenna2> " + \
-	      "[sub-band [channel begin:channel end [start time " + \
-              "[ time adv [polarization]]]]]"
-        print "\t<> required"
-        print ""
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 - Francesco de Gasperin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Usage: sidereal_difference.py [-o DIFF_DATA] [-m out.MS] obs1.MS obs2.MS
+# Subtract from obs1 the visibilities of obs2 taken at the same local sidereal
+# time on the same baseline (e.g. the same field observed on different nights).
+# Both MSs are read in chunks: timeslots are matched in LST and rows are joined
+# on (timeslot, baseline) with a vectorised sorted-key search.
+# Unmatched or flagged rows are set to 0 (and flagged if a new MS is written).
+
+import os, sys
+import optparse
+import logging
+import numpy as np
+import pyrap.tables as pt
+logging.basicConfig(level=logging.DEBUG)
+
+sidereal_ratio = 1.00273790935 # solar to sidereal time
+sidereal_day = 86400. / sidereal_ratio # in solar seconds
+
+
+def addcol(ms, incol, outcol):
+    if outcol not in ms.colnames():
+        logging.info('Adding column: '+outcol)
+        coldmi = ms.getdminfo(incol)
+        coldmi['NAME'] = outcol
+        ms.addcols(pt.makecoldesc(outcol, ms.getcoldesc(incol)), coldmi)
+
+
+def timeslots(ms):
+    """
+    Return times and starting row of each timeslot (plus the total number of rows)
+    """
+    times = ms.getcol('TIME')
+    if np.any(np.diff(times) < 0):
+        logging.critical('This code cannot handle MS that are not time-sorted.')
         sys.exit(1)
-
-# other customizations
-data_name = "DATA"
-timecut = (23+56/60.)/24    # 1 sidereal day, 23h56m
-
-# set default values
-print "File 1: ", sys.argv[1]
-print "File 2: ", sys.argv[2]
-print "File 3: ", sys.argv[3]
-print "Antenna 1: ", sys.argv[4]
-print "Antenna 2: ", sys.argv[5]
-if len(sys.argv) < 7:  subband = str(0)
-else:
-	subband = sys.argv[6]
-	print "Sub-band: ", sys.argv[6]
-if len(sys.argv) < 8:  range_plot = [0]
-elif len((sys.argv[7]).split(':')) > 1:
-        range_plot = range(int((sys.argv[7]).split(':')[0]),int((sys.argv[7]).split(':')[1])+1)
-	print "Channels: ", sys.argv[7]
-else:
-	range_plot = [int(sys.argv[7])]
-	print "Channels: ", sys.argv[7]
-if len(sys.argv) < 9:  start_time = 0
-else:
-	start_time = int(sys.argv[8])
-	print "Start time: ", sys.argv[8]
-if len(sys.argv) < 10:  time_adv = 0
-else:	
-	time_adv = int(sys.argv[9])
-	print "Time adv: ", sys.argv[9]
-if len(sys.argv) < 11:
-	pol = 0
-else:	
-	pol = int(sys.argv[10])
-	print "Polarisation: ", sys.argv[10]
-
-# open files
-msds1 = dal.dalDataset()
-if ( True != msds1.open(sys.argv[1]) ):
-        print "ERROR: Could not open file: " + sys.argv[1]
-        print "       Please check the file and try again."
-        sys.exit(1)
-msds2 = dal.dalDataset()
-if ( True != msds2.open(sys.argv[2]) ):
-        print "ERROR: Could not open file: " + sys.argv[2]
-        print "       Please check the file and try again."
-        sys.exit(1)
-msds3 = dal.dalDataset()
-if ( True != msds3.open(sys.argv[3]) ):
-        print "ERROR: Could not open file: " + sys.argv[3]
-        print "       Please check the file and try again."
+    utimes, tstart = np.unique(times, return_index=True)
+    return utimes, np.append(tstart, len(times))
+
+
+def match_lst(times1, times2, tol):
+    """
+    For each timeslot of obs1 find the timeslot of obs2 closest in LST
+    The site is the same, so LST differences are sidereal-time differences (up to whole days)
+    Return an array of obs2 indexes, -1 where no timeslot is within tol seconds
+    """
+    # LST phase in solar seconds relative to the first timeslot of obs1
+    lst1 = np.mod(times1 - times1[0], sidereal_day)
+    lst2 = np.mod(times2 - times1[0], sidereal_day)
+    order = np.argsort(lst2)
+    lst2s = np.concatenate([lst2[order][-1:] - sidereal_day, lst2[order], lst2[order][:1] + sidereal_day]) # wrap
+    orders = np.concatenate([order[-1:], order, order[:1]])
+    idx = np.clip(np.searchsorted(lst2s, lst1), 1, len(lst2s)-1)
+    left = np.abs(lst1 - lst2s[idx-1]); right = np.abs(lst2s[idx] - lst1)
+    best = np.where(left < right, idx-1, idx)
+    match = orders[best]
+    match[np.minimum(left, right) > tol] = -1
+    return match
+
+
+opt = optparse.OptionParser(usage="%prog [options] obs1.MS obs2.MS", version="%prog 0.1")
+opt.add_option('-c', '--col', help='Column to difference [default: DATA]', type='string', default='DATA')
+opt.add_option('-o', '--outcol', help='Output column [default: DIFF_DATA]', type='string', default='DIFF_DATA')
+opt.add_option('-m', '--outms', help='Write in a copy of obs1 with this name instead of in obs1 [default: None]', type='string', default='')
+opt.add_option('-n', '--ntimes', help='Number of timeslots read per chunk [default: 100]', type='int', default=100)
+opt.add_option('-t', '--tol', help='Max LST mismatch in seconds [default: half integration time]', type='float', default=None)
+(options, msfiles) = opt.parse_args()
+
+if len(msfiles) != 2:
+    opt.print_help()
+    sys.exit(0)
+ms1file, ms2file = msfiles
+
+for msfile in msfiles:
+    if not os.path.exists(msfile):
+        logging.error("Cannot find MS file: %s." % msfile)
         sys.exit(1)
 
-
-# open tables
-tablename = "MAIN";
-msds1.setFilter( "TIME," + data_name, \
-        "ANTENNA1 = " + sys.argv[4] + " AND ANTENNA2 = " + sys.argv[5] + \
-        " AND DATA_DESC_ID = " + subband )
-maintable1 = msds1.openTable( tablename );
-msds2.setFilter( "TIME," + data_name, \
-        "ANTENNA1 = " + sys.argv[4] + " AND ANTENNA2 = " + sys.argv[5] + \
-        " AND DATA_DESC_ID = " + subband )
-maintable2 = msds2.openTable( tablename );
-msds3.setFilter( "TIME," + data_name, \
-        "ANTENNA1 = " + sys.argv[4] + " AND ANTENNA2 = " + sys.argv[5] + \
-        " AND DATA_DESC_ID = " + subband )
-maintable3 = msds3.openTable( tablename );
-
-# get times
-print "Getting time..."
-time_col = maintable1.getColumn("TIME")
-time = time_col.data()
-time = array(time[start_time:]/(24*3600))    # convert from MJD in seconds to days
-
-# get datasets
-print "Getting data 1..."
-data_col = maintable1.getColumn(data_name)
-data1 = array(data_col.data()[start_time:,range_plot,:])
-data1_reduce = add.reduce(array=data1[:,:,:],axis=1)/len(range_plot)
-print "Getting data 2..."
-data_col = maintable2.getColumn(data_name)
-data2 = array(data_col.data()[start_time:,range_plot,:])
-data2_reduce = add.reduce(array=data2[:,:,:],axis=1)/len(range_plot)
-print "Getting data 3..."
-data_col = maintable3.getColumn(data_name)
-data3 = array(data_col.data()[start_time:,range_plot,:])
-data3_reduce = add.reduce(array=data3[:,:,:],axis=1)/len(range_plot)
-
-# get filtered data and time (new way;  assumes all time bins are same size)
-indices_day1 = where((time-time[0]) <= timecut)[0]
-time_day1 = time[indices_day1]
-data1_day1 = data1_reduce[indices_day1,:]
-data2_day1 = data2_reduce[indices_day1,:]
-data3_day1 = data3_reduce[indices_day1,:]
-time_day2 = time[indices_day1+len(indices_day1)]
-data1_day2 = data1_reduce[indices_day1+len(indices_day1),:]
-data2_day2 = data2_reduce[indices_day1+len(indices_day1),:]
-data3_day2 = data3_reduce[indices_day1+len(indices_day1),:]
-
-print 'Start of data (MJD from 1Jan2000): ' + str(time[0]-51544)
-print 'Start of data (MJD from 17Oct2007): ' + str(time[0]-54390) + '.  Fractional day is ' + str(24*(time[0]-int(time[0]))) + ' hrs'
-print 'Total length of data (integrations): ' + str(len(time)+start_time) + ', Day 1 (hrs): ' + str((time_day1[-1]-time_day1[0])*24) + ', Day 2 (hrs): ' + str((time_day2[-1]-time_day2[0])*24)
-
-# time adveraging
-if time_adv != 0:
-	print "Time adveraging..."
-	num = len(time_day1)/time_adv
-	for i in range(num):
-		data1_day1[i,:] = mean(data1_day1[i*time_adv:(i+1)*time_adv],axis=0)
-		data2_day1[i,:] = mean(data2_day1[i*time_adv:(i+1)*time_adv],axis=0)
-		data3_day1[i,:] = mean(data3_day1[i*time_adv:(i+1)*time_adv],axis=0)
-		data1_day2[i,:] = mean(data1_day2[i*time_adv:(i+1)*time_adv],axis=0)
-		data2_day2[i,:] = mean(data2_day2[i*time_adv:(i+1)*time_adv],axis=0)
-		data3_day2[i,:] = mean(data3_day2[i*time_adv:(i+1)*time_adv],axis=0)
-		time_day1[i] = time_day1[i*time_adv+time_adv/2]
-		time_day2[i] = time_day2[i*time_adv+time_adv/2]
-	data1_day1 = data1_day1[:num,:]
-	data2_day1 = data2_day1[:num,:]
-	data3_day1 = data3_day1[:num,:]
-	data1_day2 = data1_day2[:num,:]
-	data2_day2 = data2_day2[:num,:]
-	data3_day2 = data3_day2[:num,:]
-	time_day1 = time_day1[:num]
-	time_day2 = time_day2[:num]
-
-print "Plotting..."
-# set plot label and title
-titlestring = "Amplitude and Division, 118 MHz - 149 MHz - 180 MHz - File1:"+sys.argv[1]
-ylabelstring = "Intensity"
-
-current_value1_day1 = hypot((data1_day1[:,pol]).real,(data1_day1[:,pol]).imag)
-current_value2_day1 = hypot((data2_day1[:,pol]).real,(data2_day1[:,pol]).imag)
-current_value3_day1 = hypot((data3_day1[:,pol]).real,(data3_day1[:,pol]).imag)
-current_value1_day2 = hypot((data1_day2[:,pol]).real,(data1_day2[:,pol]).imag)
-current_value2_day2 = hypot((data2_day2[:,pol]).real,(data2_day2[:,pol]).imag)
-current_value3_day2 = hypot((data3_day2[:,pol]).real,(data3_day2[:,pol]).imag)
-
-params = {
-	'axes.labelsize': 10,
-	'text.fontsize': 10,
-        'legend.fontsize': 8,
-        'xtick.labelsize': 8,
-        'ytick.labelsize': 8,
-        'figure.figsize': [12,8]}
-rcParams.update(params)
-
-figure(1)
-
-subplot(121)
-plot( time_day1, current_value1_day1 + 0.01, ",", label="Day 1 + 0.010 @ 118 MHz")
-plot( time_day2-timecut, current_value1_day2 + 0.008, ",", label="Day 2 + 0.008 @ 118 MHz" )
-plot( time_day1, current_value2_day1 + 0.006, ",", label="Day 1 + 0.006 @ 149 MHz")
-plot( time_day2-timecut, current_value2_day2 + 0.004, ",", label="Day 2  + 0.004 @ 149 MHz" )
-plot( time_day1, current_value3_day1 + 0.002, ",", label="Day 1 + 0.002 @ 180 MHz")
-plot( time_day2-timecut, current_value3_day2, ",", label="Day 2 @ 180 MHz" )
-title(titlestring)
-ylabel(ylabelstring)
-axis([time_day1[0], time_day1[-1], 0, 0.016])
-leg = legend(numpoints=10)
-frame = leg.get_frame()
-frame.set_alpha(0.7) # make it semi-transparent
-
-subplot(122)
-plot( time_day1, (current_value1_day2-current_value1_day1)/(0.5*(current_value1_day2+current_value1_day1)) + 0.1, "-", label="+0.2 @ 118 MHz")
-plot( time_day1, (current_value2_day2-current_value2_day1)/(0.5*(current_value2_day2+current_value2_day1)), "-", label="@ 149 MHz" )
-plot( time_day1, (current_value3_day2-current_value3_day1)/(0.5*(current_value3_day2+current_value3_day1)) - 0.1, "-", label="-0.2 @ 180 MHz" )
-ylabel("Day1-Day2/mean")
-xlabel("Time (MJD)")
-axis([time_day1[0], time_day1[-1], -0.2, 0.2])
-leg = legend(numpoints=10)
-frame = leg.get_frame()
-frame.set_alpha(0.7) # make it semi-transparent
-
-outputfile = "out.png"
-print "\nSaving output file as: ", outputfile
-savefig( outputfile )
-show()
-
-#print "Computing displacement..."
-#displacement = (current_value_day1[:] - current_value_day2[:]) / ((current_value_day1[:] + current_value_day2[:])/2)
-#print "Mean displacement: ", mean(displacement), "%"
+if options.outms != '':
+    logging.info('Copy %s -> %s' % (ms1file, options.outms))
+    with pt.table(ms1file, ack=False) as t:
+        t.copy(options.outms, deep=True)
+    ms1file = options.outms
+    write_flags = True
+else:
+    write_flags = False
+
+for msfile in msfiles:
+    with pt.table(msfile+'/ANTENNA', ack=False) as t:
+        if msfile == msfiles[0]: antnames = t.getcol('NAME')
+        elif list(t.getcol('NAME')) != list(antnames):
+            logging.error('The two MSs must have the same antennas.')
+            sys.exit(1)
+nant = len(antnames)
+
+ms1 = pt.table(ms1file, readonly=False, ack=False)
+ms2 = pt.table(ms2file, ack=False)
+addcol(ms1, options.col, options.outcol)
+
+utimes1, tstart1 = timeslots(ms1)
+utimes2, tstart2 = timeslots(ms2)
+if options.tol is None: options.tol = ms1.getcell('INTERVAL', 0)/2.
+match = match_lst(utimes1, utimes2, options.tol)
+logging.info('Matched %i/%i timeslots in LST.' % (np.sum(match >= 0), len(utimes1)))
+
+nmissing = 0
+for t in xrange(0, len(utimes1), options.ntimes):
+    startrow = tstart1[t]
+    nrow = tstart1[min(t+options.ntimes, len(utimes1))] - startrow
+    logging.debug('Processing timeslots %i-%i...' % (t, t+options.ntimes))
+
+    # obs1 rows: key = (matched obs2 timeslot, baseline)
+    slot1 = np.searchsorted(utimes1, ms1.getcol('TIME', startrow, nrow))
+    key1 = match[slot1] * nant**2 + ms1.getcol('ANTENNA1', startrow, nrow) * nant + ms1.getcol('ANTENNA2', startrow, nrow)
+    data = ms1.getcol(options.col, startrow, nrow)
+    flag = ms1.getcol('FLAG', startrow, nrow)
+
+    # obs2 rows of all matched timeslots
+    slots2 = np.unique(match[t:t+options.ntimes])
+    slots2 = slots2[slots2 >= 0]
+    if len(slots2) > 0:
+        rows2 = np.concatenate([np.arange(tstart2[s], tstart2[s+1]) for s in slots2])
+        sel = ms2.selectrows(rows2)
+        slot2 = np.searchsorted(utimes2, sel.getcol('TIME'))
+        key2 = slot2 * nant**2 + sel.getcol('ANTENNA1') * nant + sel.getcol('ANTENNA2')
+        data2 = sel.getcol(options.col)
+        flag2 = sel.getcol('FLAG')
+        sel.close()
+
+        # join
+        order = np.argsort(key2)
+        key2 = key2[order]
+        idx = np.clip(np.searchsorted(key2, key1), 0, len(key2)-1)
+        found = (key2[idx] == key1) & (match[slot1] >= 0)
+        idx = order[idx]
+        data[found] -= data2[idx[found]]
+        flag[found] |= flag2[idx[found]]
+    else:
+        found = np.zeros(nrow, dtype=bool)
+
+    flag[~found] = True
+    nmissing += np.sum(~found)
+    data[flag] = 0
+    ms1.putcol(options.outcol, data, startrow, nrow)
+    if write_flags: ms1.putcol('FLAG', flag, startrow, nrow)
+
+logging.info('Rows without a match: %i/%i' % (nmissing, tstart1[-1]))
+ms1.close()
+ms2.close()
+logging.info("Done.")
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 - Francesco de Gasperin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Test the resumable downloads of lib_pipeline_download against a local
+# http server that supports Range requests and drops connections mid-transfer
+
+import os, sys, shutil, socket, tarfile, tempfile, threading, unittest, zlib
+import BaseHTTPServer, SocketServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'deprecated_autocal'))
+from lib_pipeline_download import ResumableStream, download
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serve server.data with Range support, the first server.drops connections
+    are closed after half of the requested bytes
+    """
+    def do_GET(self):
+        data = self.server.data
+        start = 0
+        if self.headers.getheader('Range') != None:
+            start = int(self.headers.getheader('Range').split('=')[1].split('-')[0])
+        self.server.requests.append(start)
+        if start > 0:
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %i-%i/%i' % (start, len(data)-1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data)-start))
+        self.end_headers()
+        if self.server.drops > 0:
+            self.server.drops -= 1
+            self.wfile.write(data[start:start+(len(data)-start)//2])
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_RDWR)
+            self.close_connection = 1
+            return
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.requests = []
+        self.url = 'http://127.0.0.1:%i/L123456_SB000_uv.tar' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def test_resume_stream(self):
+        self.server.data = os.urandom(300*1024+17)
+        self.server.drops = 2
+        partfile = os.path.join(self.tmp, 'data.part')
+        stream = ResumableStream(self.url, partfile, retries=2, timeout=5)
+        read = ''
+        while True:
+            chunk = stream.read(64*1024)
+            if chunk == '': break
+            read += chunk
+        stream.close()
+
+        self.assertEqual(read, self.server.data)
+        with open(partfile, 'rb') as f:
+            self.assertEqual(f.read(), self.server.data)
+        self.assertEqual(stream.size, len(self.server.data))
+        self.assertEqual(stream.adler32 & 0xffffffff, zlib.adler32(self.server.data) & 0xffffffff)
+        # one full request, then resumed twice from where the connection dropped
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.server.requests[0], 0)
+        self.assertTrue(0 < self.server.requests[1] < self.server.requests[2] < len(self.server.data))
+
+    def test_resume_partfile(self):
+        # a partial file left by an interrupted run is read first, then the download continues
+        self.server.data = os.urandom(100*1024)
+        self.server.drops = 0
+        partfile = os.path.join(self.tmp, 'data.part')
+        with open(partfile, 'wb') as f: f.write(self.server.data[:12345])
+        stream = ResumableStream(self.url, partfile, retries=2, timeout=5)
+        read = ''
+        while True:
+            chunk = stream.read()
+            if chunk == '': break
+            read += chunk
+        stream.close()
+
+        self.assertEqual(read, self.server.data)
+        self.assertEqual(self.server.requests, [12345])
+        with open(partfile, 'rb') as f:
+            self.assertEqual(f.read(), self.server.data)
+
+    def test_download_tar(self):
+        content = os.urandom(200*1024)
+        src = os.path.join(self.tmp, 'src')
+        os.makedirs(src+'/L123456_SB000_uv.MS')
+        with open(src+'/L123456_SB000_uv.MS/table.f0', 'wb') as f: f.write(content)
+        tarname = os.path.join(self.tmp, 'archive.tar')
+        with tarfile.open(tarname, 'w') as tar:
+            tar.add(src+'/L123456_SB000_uv.MS', arcname='L123456_SB000_uv.MS')
+        with open(tarname, 'rb') as f: self.server.data = f.read()
+        self.server.drops = 1
+
+        outdir = os.path.join(self.tmp, 'out')
+        os.makedirs(outdir)
+        partfile = os.path.join(outdir, 'L123456_SB000_uv.tar.part')
+        adler32 = '%08x' % (zlib.adler32(self.server.data) & 0xffffffff)
+        self.assertTrue(download(self.url, partfile, outdir, adler32=adler32, retries=2))
+
+        self.assertFalse(os.path.exists(partfile))
+        self.assertEqual(len(self.server.requests), 2)
+        with open(outdir+'/L123456_SB000_uv.MS/table.f0', 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 - Francesco de Gasperin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Test gaincal.py recovering the gains injected in a small simulated MS
+
+import os, sys, shutil, subprocess, tempfile, unittest
+import numpy as np
+try:
+    import pyrap.tables as pt
+    import losoto.h5parm as lh5
+except ImportError:
+    pt = None
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'gaincal.py')
+
+
+def make_ms(msname, gains, ntime=4, nchan=4, weight_spectrum=False):
+    """
+    Write an MS (only the columns and subtables read by gaincal.py) with all the baselines and autocorrelations,
+    data = g_p M_pq g_q^* for a random model of the XX and YY correlations
+    gains : shape (ant, 2) for XX and YY
+    Rows of the first baseline at the first time have weight 0 and corrupted data
+    """
+    nant = gains.shape[0]
+    ant1, ant2 = np.triu_indices(nant)
+    nbl = len(ant1)
+    np.random.seed(1)
+    mod = np.zeros((ntime*nbl, nchan, 4), dtype=np.complex64)
+    mod[:,:,[0,3]] = np.random.normal(1, 0.3, (ntime*nbl, nchan, 2)) + 1j*np.random.normal(0, 0.3, (ntime*nbl, nchan, 2))
+    a1, a2 = np.tile(ant1, ntime), np.tile(ant2, ntime)
+    vis = np.zeros_like(mod)
+    for p, pol in enumerate([0,3]):
+        vis[:,:,pol] = gains[a1,None,p] * mod[:,:,pol] * np.conj(gains[a2,None,p])
+    wgt = np.ones((ntime*nbl, 4), dtype=np.float32)
+    bad = (a1 == 0) & (a2 == 1) & (np.arange(ntime*nbl) < nbl)
+    vis[bad] = 100.
+    wgt[bad] = 0.
+
+    cols = [pt.makescacoldesc('TIME', 0.), pt.makescacoldesc('ANTENNA1', 0), pt.makescacoldesc('ANTENNA2', 0), \
+            pt.makearrcoldesc('DATA', 0j, ndim=2), pt.makearrcoldesc('MODEL_DATA', 0j, ndim=2), \
+            pt.makearrcoldesc('FLAG', False, ndim=2), pt.makearrcoldesc('WEIGHT', 0., ndim=1)]
+    if weight_spectrum: cols.append(pt.makearrcoldesc('WEIGHT_SPECTRUM', 0., ndim=2))
+    with pt.table(msname, pt.maketabdesc(cols), nrow=ntime*nbl, ack=False) as t:
+        t.putcol('TIME', np.repeat(4.9e9 + 10.*np.arange(ntime), nbl))
+        t.putcol('ANTENNA1', a1)
+        t.putcol('ANTENNA2', a2)
+        t.putcol('DATA', vis)
+        t.putcol('MODEL_DATA', mod)
+        t.putcol('FLAG', np.zeros(vis.shape, dtype=bool))
+        t.putcol('WEIGHT', wgt)
+        if weight_spectrum: t.putcol('WEIGHT_SPECTRUM', np.repeat(wgt[:,None,:], nchan, axis=1))
+    desc = pt.maketabdesc([pt.makescacoldesc('NAME', ''), pt.makearrcoldesc('POSITION', 0., shape=[3])])
+    with pt.table(msname+'/ANTENNA', desc, nrow=nant, ack=False) as t:
+        t.putcol('NAME', ['CS%03i' % i for i in range(nant)])
+        t.putcol('POSITION', np.random.normal(0, 1e3, (nant, 3)))
+    with pt.table(msname+'/SPECTRAL_WINDOW', pt.maketabdesc([pt.makearrcoldesc('CHAN_FREQ', 0., ndim=1)]), nrow=1, ack=False) as t:
+        t.putcol('CHAN_FREQ', 140e6 + 1e6*np.arange(nchan)[None,:])
+    with pt.table(msname+'/POLARIZATION', pt.maketabdesc([pt.makescacoldesc('NUM_CORR', 0)]), nrow=1, ack=False) as t:
+        t.putcol('NUM_CORR', [4])
+
+
+@unittest.skipIf(pt is None, 'pyrap and losoto are needed')
+class TestGaincal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        np.random.seed(2)
+        nant = 6
+        self.gains = np.random.uniform(0.5, 2., (nant, 2)) * np.exp(1j*np.random.uniform(-np.pi, np.pi, (nant, 2)))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def solve(self, weight_spectrum):
+        msname = os.path.join(self.tmp, 'test.MS')
+        h5parm = os.path.join(self.tmp, 'cal.h5')
+        make_ms(msname, self.gains, weight_spectrum=weight_spectrum)
+        with open(os.devnull, 'w') as null:
+            subprocess.check_call([sys.executable, script, '-s', '2', '-n', '2', '-j', '2', '-o', h5parm, msname], \
+                    stdout=null, stderr=null)
+
+        h5 = lh5.h5parm(h5parm)
+        solset = h5.getSolset('sol000')
+        amp = solset.getSoltab('amplitude000').getValues(retAxesVals=False)
+        ph = solset.getSoltab('phase000').getValues(retAxesVals=False)
+        self.assertEqual(solset.getSoltab('phase000').getAxesNames(), ['time', 'freq', 'ant', 'pol'])
+        h5.close()
+
+        # 2 solution intervals in time and in frequency, phases referenced to the first antenna
+        self.assertEqual(amp.shape, (2, 2, 6, 2))
+        ref = self.gains / self.gains[0] * np.abs(self.gains[0])
+        np.testing.assert_allclose(amp, np.broadcast_to(np.abs(self.gains), amp.shape), rtol=1e-4)
+        np.testing.assert_allclose(np.angle(np.exp(1j*(ph - np.angle(ref)))), 0., atol=1e-4)
+
+    def test_weight(self):
+        # no WEIGHT_SPECTRUM: WEIGHT is used for all channels
+        self.solve(weight_spectrum=False)
+
+    def test_weight_spectrum(self):
+        self.solve(weight_spectrum=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
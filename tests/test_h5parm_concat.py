@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 - Francesco de Gasperin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Test h5parm_concat.py on two H5parms with interleaved time and frequency axes
+
+import os, sys, shutil, subprocess, tempfile, unittest
+import numpy as np
+import losoto.h5parm as lh5
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'h5parm_concat.py')
+
+
+def make_h5parm(filename, times, freqs, ants, vals, weights):
+    """
+    Write an H5parm with a single phase soltab with axes time, freq, ant
+    """
+    h5 = lh5.h5parm(filename, readonly=False)
+    solset = h5.makeSolset(solsetName='sol000')
+    solset.obj._f_get_child('antenna').append([(a, [0., 0., i]) for i, a in enumerate(ants)])
+    solset.obj._f_get_child('source').append([('pointing', [0., 0.])])
+    solset.makeSoltab('phase', 'phase000', axesNames=['time', 'freq', 'ant'], \
+            axesVals=[times, freqs, ants], vals=vals, weights=weights)
+    h5.close()
+
+
+class TestH5parmConcat(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_interleaved(self):
+        ants = ['CS001', 'CS002']
+        # first input on even times and low freqs, second on odd times and interleaved freqs
+        times1, freqs1 = np.array([0., 2., 4.]), np.array([10., 30.])
+        times2, freqs2 = np.array([1., 3.]), np.array([20., 30., 40.])
+        vals1 = np.arange(3*2*2, dtype=float).reshape(3, 2, 2) + 1.
+        vals2 = -np.arange(2*3*2, dtype=float).reshape(2, 3, 2) - 1.
+        weights1 = np.ones(vals1.shape)
+        weights2 = np.ones(vals2.shape)
+        weights2[0, 1, 0] = 0.
+        h5file1 = os.path.join(self.tmp, 'in1.h5')
+        h5file2 = os.path.join(self.tmp, 'in2.h5')
+        outfile = os.path.join(self.tmp, 'out.h5')
+        make_h5parm(h5file1, times1, freqs1, ants, vals1, weights1)
+        make_h5parm(h5file2, times2, freqs2, ants, vals2, weights2)
+
+        with open(os.devnull, 'w') as null:
+            subprocess.check_call([sys.executable, script, '-o', outfile, h5file1, h5file2], stdout=null, stderr=null)
+
+        h5 = lh5.h5parm(outfile)
+        soltab = h5.getSolset('sol000').getSoltab('phase000')
+        times = soltab.getAxisValues('time')
+        freqs = soltab.getAxisValues('freq')
+        vals = soltab.getValues(retAxesVals=False)
+        weights = soltab.getValues(retAxesVals=False, weight=True)
+        self.assertEqual(sorted(h5.getSolset('sol000').getAnt().keys()), ants)
+        h5.close()
+
+        np.testing.assert_array_equal(times, [0., 1., 2., 3., 4.])
+        np.testing.assert_array_equal(freqs, [10., 20., 30., 40.])
+        self.assertEqual(vals.shape, (5, 4, 2))
+
+        expected_vals = np.zeros((5, 4, 2))
+        expected_weights = np.zeros((5, 4, 2))
+        # inputs go in their place: times1 -> 0,2,4 freqs1 -> 0,2; times2 -> 1,3 freqs2 -> 1,2,3
+        expected_vals[np.ix_([0, 2, 4], [0, 2])] = vals1
+        expected_weights[np.ix_([0, 2, 4], [0, 2])] = weights1
+        expected_vals[np.ix_([1, 3], [1, 2, 3])] = vals2
+        expected_weights[np.ix_([1, 3], [1, 2, 3])] = weights2
+        np.testing.assert_array_equal(vals, expected_vals)
+        np.testing.assert_array_equal(weights, expected_weights)
+        # points not covered by any input are flagged
+        self.assertEqual(weights[0, 1, 0], 0)
+        self.assertEqual(weights[1, 0, 1], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 - Francesco de Gasperin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Test that lib_fits.TiledImage gives the same results of the in-memory Image on a small synthetic image
+
+import os, sys, shutil, tempfile, unittest
+import numpy as np
+from astropy.io import fits as pyfits
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import lib_fits
+
+
+def make_image(filename, shape=(150, 130), dtype=np.float32):
+    """
+    Write a 4D (stokes, freq, dec, ra) image with noise and a few point sources, 5" beam
+    """
+    np.random.seed(1)
+    data = np.random.normal(0, 1e-3, shape)
+    for y, x in [(10, 20), (75, 65), (140, 120), (74, 66)]: data[y, x] += 0.1
+    hdu = pyfits.PrimaryHDU(data.astype(dtype).reshape((1, 1)+shape))
+    for k, v in [('CTYPE1', 'RA---SIN'), ('CRPIX1', shape[1]//2), ('CDELT1', -0.0003), ('CRVAL1', 10.), \
+            ('CTYPE2', 'DEC--SIN'), ('CRPIX2', shape[0]//2), ('CDELT2', 0.0003), ('CRVAL2', 50.), \
+            ('CTYPE3', 'FREQ'), ('CRPIX3', 1), ('CDELT3', 1e6), ('CRVAL3', 1.4e8), \
+            ('CTYPE4', 'STOKES'), ('CRPIX4', 1), ('CDELT4', 1), ('CRVAL4', 1), \
+            ('BMAJ', 5/3600.), ('BMIN', 5/3600.), ('BPA', 0.)]:
+        hdu.header[k] = v
+    hdu.writeto(filename)
+
+
+class TestTiledImage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.imagefile = os.path.join(self.tmp, 'image.fits')
+        make_image(self.imagefile)
+        # small tiles, so that the image is split in several of them
+        self.tiled = lib_fits.TiledImage(self.imagefile, os.path.join(self.tmp, 'out.fits'), tilesize=40)
+        self.image = lib_fits.Image(self.imagefile)
+        self.image.img_data = np.array(self.image.img_data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def assertSameImage(self, tol=0.):
+        data = np.array(lib_fits.flatten(self.tiled.outfile)[1])
+        np.testing.assert_array_equal(np.isnan(data), np.isnan(self.image.img_data))
+        np.testing.assert_allclose(data, self.image.img_data, rtol=0, atol=tol)
+        # same data type of the input
+        self.assertEqual(pyfits.getheader(self.tiled.outfile)['BITPIX'], -32)
+        self.assertFalse(os.path.exists(self.tiled.outfile+'.tmp'))
+
+    def test_blank(self):
+        self.tiled.blank(1e-3)
+        self.image.blank(1e-3)
+        self.assertSameImage()
+
+    def test_apply_region(self):
+        try:
+            import pyregion
+        except ImportError:
+            raise unittest.SkipTest('pyregion not available')
+        regionfile = os.path.join(self.tmp, 'region.reg')
+        with open(regionfile, 'w') as f:
+            f.write('fk5\ncircle(10.0,50.0,40")\n')
+        # the region crosses the tiles: each tile gets its own part of the mask
+        self.tiled.ncpu = 2
+        self.tiled.apply_region(regionfile)
+        self.image.apply_region(regionfile)
+        self.assertSameImage()
+        self.assertTrue(np.isnan(self.image.img_data).sum() > 100)
+
+    def test_apply_mask(self):
+        mask = np.zeros(self.image.img_data.shape, dtype=bool)
+        mask[30:100, 20:50] = True
+        self.tiled.apply_mask(mask, blankvalue=0., invert=True)
+        self.image.apply_mask(mask, blankvalue=0., invert=True)
+        self.assertSameImage()
+        self.assertFalse(os.path.exists(self.tiled.outfile+'.mask.npy'))
+
+        # mask from a fits file
+        maskfile = os.path.join(self.tmp, 'mask.fits')
+        pyfits.PrimaryHDU(mask.astype(np.int16)[::-1].reshape((1, 1)+mask.shape)).writeto(maskfile)
+        self.tiled.apply_mask(maskfile)
+        self.image.apply_mask(mask[::-1])
+        self.assertSameImage()
+
+    def test_convolve(self):
+        for method, target_beam in [('direct', [10/3600., 8/3600., 30.]), ('fft', [14/3600., 12/3600., 30.])]:
+            self.tiled.convolve(target_beam, method=method)
+            self.image.convolve(target_beam, method=method)
+            # float32 output
+            self.assertSameImage(tol=1e-6)
+            self.assertEqual(self.tiled.get_beam(), self.image.get_beam())
+            self.assertAlmostEqual(pyfits.getheader(self.tiled.outfile)['BMAJ'], target_beam[0])
+
+    def test_calc_noise(self):
+        self.tiled.calc_noise()
+        self.image.calc_noise()
+        self.assertAlmostEqual(self.tiled.noise, self.image.noise, delta=1e-3*self.image.noise)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 - Francesco de Gasperin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Test the job scheduling of lib_pipeline.Scheduler with shell commands (sleep, echo, false...):
+# packing of the jobs on the node resources, batching of micro jobs, sentinel completion and dependencies
+
+import os, sys, shutil, tempfile, time, unittest, logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'deprecated_autocal'))
+try:
+    import lib_pipeline
+    from lib_pipeline import Scheduler, Node, FakeClusterBackend, SentinelWatcher
+except ImportError as e:
+    # lib_pipeline needs the full LOFAR environment (lsmtool, casacore...)
+    lib_pipeline = None
+    missing = str(e)
+
+logging.getLogger('PiLL').setLevel(logging.CRITICAL)
+
+
+def max_usage(jobs, attr):
+    """
+    Max sum of attr (e.g. cores, mem) of the jobs running together, from their start and end times
+    """
+    return max([sum([getattr(j, attr) for j in jobs if j.t_start <= job.t_start < j.t_end]) for job in jobs])
+
+
+@unittest.skipIf(lib_pipeline is None, 'lib_pipeline cannot be imported: %s' % (missing if lib_pipeline is None else ''))
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def scheduler(self, **kwargs):
+        return Scheduler(qsub=False, max_threads=10, log_dir=os.path.join(self.tmp, 'logs'), **kwargs)
+
+    def test_packing(self):
+        s = self.scheduler(node=Node('test', cores=4, mem=8))
+        for i in range(4): s.add('sleep 0.3', log='mem%i.log' % i, cmd_type='general', mem=4) # 2 at a time by memory
+        s.add('sleep 0.3', log='cores.log', cmd_type='general', processors=4) # alone
+        for i in range(3): s.add('sleep 0.3', log='small%i.log' % i, cmd_type='general', processors=2)
+        jobs = list(s.action_list)
+        self.assertEqual(s.run(check=True), [])
+
+        self.assertTrue(all(job.status == 'done' for job in jobs))
+        self.assertEqual(max_usage(jobs, 'mem'), 8)
+        self.assertEqual(max_usage(jobs, 'cores'), 4)
+        self.assertEqual(max_usage(jobs[:4], 'mem'), 8) # the node is used
+        # the job with all the cores runs alone
+        big = jobs[4]
+        self.assertEqual([j for j in jobs if j.t_start < big.t_end and big.t_start < j.t_end], [big])
+
+    def test_micro_batching(self):
+        # one thread at a time: every submission waits the backend delay
+        s = self.scheduler(backend=FakeClusterBackend(delay=0.3), batch_size=3)
+        for i in range(7): s.add('touch f%i' % i, log='touch%i.log' % i, cmd_type='general')
+        s.add('rm not_there', log='rm.log', cmd_type='general')
+        s.add('touch f7', log='touch7.log', cmd_type='general')
+        jobs = list(s.action_list)
+        self.assertTrue(all(job.micro for job in jobs))
+        t0 = time.time()
+        failed = s.run(max_threads=1)
+        elapsed = time.time() - t0
+
+        # 3 submissions of 3 jobs, not 9 submissions
+        self.assertTrue(elapsed < 6*0.3, 'micro jobs not batched (%.1fs)' % elapsed)
+        self.assertEqual(failed, [jobs[7]])
+        self.assertNotEqual(jobs[7].returncode, 0)
+        # the failure of a job does not stop the others of its batch
+        self.assertTrue(all(job.status == 'done' for job in jobs[:7]+jobs[8:]))
+        self.assertTrue(all(os.path.exists('f%i' % i) for i in range(8)))
+        self.assertEqual([f for f in os.listdir('logs') if f.startswith('batch-')], [])
+
+    def test_sentinel(self):
+        s = self.scheduler(backend=FakeClusterBackend(delay=0.1, sentinel=True))
+        s.watcher = SentinelWatcher(os.path.join(self.tmp, 'logs', 'sentinels'), s.backend, interval=0.1)
+        a = s.add('sh -c "sleep 0.5; echo a > a.txt"', log='a.log', cmd_type='general')
+        b = s.add('false', log='b.log', cmd_type='general')
+        c = s.add('cat a.txt', log='c.log', cmd_type='general', deps=[a])
+        jobs = list(s.action_list)
+        failed = s.run(check=True)
+
+        self.assertEqual(failed, [jobs[b]])
+        self.assertEqual(jobs[b].returncode, 1)
+        self.assertEqual([jobs[a].status, jobs[c].status], ['done', 'done'])
+        self.assertTrue(jobs[c].t_start >= jobs[a].t_end)
+        with open(os.path.join(self.tmp, 'logs', 'c.log')) as f: self.assertEqual(f.read(), 'a\n')
+        # no sentinel left
+        self.assertEqual(os.listdir(os.path.join(self.tmp, 'logs', 'sentinels')), [])
+
+    def test_dependency_abort(self):
+        s = self.scheduler()
+        a = s.add('false', log='a.log', cmd_type='general')
+        b = s.add('echo b', log='b.log', cmd_type='general', deps=[a])
+        c = s.add('echo c', log='c.log', cmd_type='general', deps=[b])
+        d = s.add('echo d', log='d.log', cmd_type='general')
+        # an error in the log aborts the dependents while the job is still running
+        e = s.add('sh -c "echo ERROR: bad data; sleep 3"', log='e.log', cmd_type='general')
+        f = s.add('echo f', log='f.log', cmd_type='general', deps=[e, d])
+        jobs = list(s.action_list)
+        failed = s.run(check=True)
+
+        self.assertEqual([job.status for job in jobs], ['failed', 'aborted', 'aborted', 'done', 'failed', 'aborted'])
+        self.assertEqual(failed, [jobs[i] for i in [a, b, c, e, f]])
+        self.assertTrue(jobs[e].error.startswith('ERROR'))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'logs', 'b.log')))
+        # the scheduler is ready for the next run
+        self.assertEqual(s.action_list, [])
+        s.add('echo g', log='g.log', cmd_type='general')
+        self.assertEqual(s.run(check=True), [])
+
+
+if __name__ == '__main__':
+    unittest.main()